@@ -4,25 +4,41 @@
 Code for training and validating NN's, as well as evaluating them.
 """
 
+import collections
+import itertools
+import multiprocessing
+import os
+import queue
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
 import h5py
 import numpy as np
+import keras as ks
 import matplotlib.pyplot as plt
 from matplotlib.backends.backend_pdf import PdfPages
 
 from orcanet.utilities.layer_plotting import plot_activations, plot_weights
 from orcanet.logging import BatchLogger
-from orcanet.in_out import h5_get_number_of_rows
-from orcanet.h5_generator import get_h5_generator
+from orcanet.distributed import get_shard
+from orcanet.in_out import concatenate_h5_files
+from orcanet.h5_generator import get_h5_generator, get_shuffle_buffer, \
+    get_n_buffers, ProcessLoader, ShuffleBuffer
 
 # for debugging
 # from tensorflow.python import debug as tf_debug
 # K.set_session(tf_debug.LocalCLIDebugWrapperSession(tf.Session()))
 
 
-def train_model(orga, model, epoch, batch_logger=False):
+def train_model(orga, model, epoch, batch_logger=False, comm=None):
     """
     Train a model on one file and return the history.
 
+    If a communicator is given, every worker trains on its own part of
+    the file, and the gradients are averaged over all workers.
+
     Parameters
     ----------
     orga : object Organizer
@@ -33,6 +49,8 @@ def train_model(orga, model, epoch, batch_logger=False):
         Current epoch and the no of the file to train on.
     batch_logger : bool
         Use the orcanet batchlogger to log the training.
+    comm : orcanet.distributed.Communicator, optional
+        For training distributed over several worker processes.
 
     Returns
     -------
@@ -42,48 +60,154 @@ def train_model(orga, model, epoch, batch_logger=False):
 
     """
     files_dict = orga.io.get_file("train", epoch[1])
+    training_generator = None
+    try:
+        if orga.cfg.n_events is not None:
+            # TODO Can throw an error if n_events is larger than the file
+            f_size = orga.cfg.n_events  # for testing purposes
+        else:
+            f_size = orga.io.get_file_sizes("train")[epoch[1] - 1]
+
+        if comm is not None:
+            return _train_model_distributed(
+                orga, model, epoch, files_dict, f_size, batch_logger, comm)
+
+        if orga.cfg.shuffle_buffer_files is not None:
+            training_generator = get_shuffle_buffer(
+                orga, epoch[1],
+                zero_center=orga.cfg.zero_center_folder is not None)
+            if orga.cfg.n_events is not None:
+                f_size = min(f_size, training_generator.n_samples)
+            else:
+                f_size = training_generator.n_samples
+            generator = iter(training_generator)
+        else:
+            training_generator = get_h5_generator(
+                orga, files_dict, f_size=f_size,
+                zero_center=orga.cfg.zero_center_folder is not None,
+                shuffle=orga.cfg.shuffle_train)
+            if orga.cfg.loader_processes is not None:
+                training_generator = ProcessLoader(
+                    training_generator, orga.cfg.loader_processes)
+                generator = iter(training_generator)
+            else:
+                generator = training_generator
+
+        callbacks = []
+        if batch_logger:
+            logger = BatchLogger(orga, epoch, generator=training_generator)
+            generator = logger.time_generator(generator)
+            callbacks.append(logger)
+        if orga.cfg.callback_train is not None:
+            try:
+                callbacks.extend(orga.cfg.callback_train)
+            except TypeError:
+                callbacks.append(orga.cfg.callback_train)
+
+        history = model.fit_generator(
+            generator,
+            steps_per_epoch=int(f_size / orga.cfg.batchsize),
+            verbose=orga.cfg.verbose_train,
+            max_queue_size=orga.cfg.max_queue_size,
+            class_weight=orga.cfg.class_weight,
+            callbacks=callbacks,
+            initial_epoch=epoch[0] - 1,
+            epochs=epoch[0],
+            # prefetching and chunk-wise shuffling need the batches to be
+            # requested in order
+            shuffle=(orga.cfg.prefetch_batches == 0 and
+                     orga.cfg.shuffle_train != "chunks"),
+        )
+    finally:
+        # also stop the worker processes and threads if the training failed
+        if training_generator is not None:
+            training_generator.close()
+        orga.io.release_files(files_dict)
+        if isinstance(training_generator, ShuffleBuffer):
+            for generator in training_generator.generators:
+                orga.io.release_files(generator.files_dict)
 
-    if orga.cfg.n_events is not None:
-        # TODO Can throw an error if n_events is larger than the file
-        f_size = orga.cfg.n_events  # for testing purposes
-    else:
-        f_size = orga.io.get_file_sizes("train")[epoch[1] - 1]
+    # get a dict with losses and metrics
+    # only trained for one epoch, so value is list of len 1
+    history = {key: value[0] for key, value in history.history.items()}
+    return history
 
-    callbacks = []
-    if batch_logger:
-        callbacks.append(BatchLogger(orga, epoch))
-    if orga.cfg.callback_train is not None:
-        try:
-            callbacks.extend(orga.cfg.callback_train)
-        except TypeError:
-            callbacks.append(orga.cfg.callback_train)
 
+def _train_model_distributed(orga, model, epoch, files_dict, f_size,
+                             batch_logger, comm):
+    """
+    Train a model on one file, distributed over several workers.
+
+    Each worker reads its own part of the file, with the same number of
+    batches. Only the worker with rank 0 logs the training.
+
+    """
+    if orga.cfg.shuffle_buffer_files is not None:
+        raise ValueError("shuffle_buffer_files can not be used for "
+                         "distributed training")
+    if orga.cfg.class_weight is not None:
+        raise ValueError("class_weight can not be used for "
+                         "distributed training")
+    f_offset, shard_size = get_shard(f_size, orga.cfg.batchsize, comm)
     training_generator = get_h5_generator(
-        orga, files_dict, f_size=f_size,
+        orga, files_dict, f_size=shard_size, f_offset=f_offset,
         zero_center=orga.cfg.zero_center_folder is not None,
         shuffle=orga.cfg.shuffle_train)
+    if orga.cfg.loader_processes is not None:
+        training_generator = ProcessLoader(
+            training_generator, orga.cfg.loader_processes)
+    steps = int(shard_size / orga.cfg.batchsize)
 
-    history = model.fit_generator(
-        training_generator,
-        steps_per_epoch=int(f_size / orga.cfg.batchsize),
-        verbose=orga.cfg.verbose_train,
-        max_queue_size=orga.cfg.max_queue_size,
-        class_weight=orga.cfg.class_weight,
-        callbacks=callbacks,
-        initial_epoch=epoch[0] - 1,
-        epochs=epoch[0],
-    )
+    train_step = orga._get_train_step(model, comm)
 
-    # get a dict with losses and metrics
-    # only trained for one epoch, so value is list of len 1
-    history = {key: value[0] for key, value in history.history.items()}
-    return history
+    generator = iter(training_generator)
+    callbacks = []
+    if comm.rank == 0:
+        if batch_logger:
+            logger = BatchLogger(orga, epoch, generator=training_generator,
+                                 n_workers=comm.world_size)
+            generator = logger.time_generator(generator)
+            callbacks.append(logger)
+        if orga.cfg.callback_train is not None:
+            try:
+                callbacks.extend(orga.cfg.callback_train)
+            except TypeError:
+                callbacks.append(orga.cfg.callback_train)
+    callbacks = ks.callbacks.CallbackList(
+        callbacks, add_progbar=comm.rank == 0 and orga.cfg.verbose_train != 0,
+        model=model, verbose=orga.cfg.verbose_train, epochs=epoch[0],
+        steps=steps)
+
+    model.reset_metrics()
+    logs = {}
+    callbacks.on_train_begin()
+    callbacks.on_epoch_begin(epoch[0] - 1)
+    try:
+        for batch, (xs, ys) in enumerate(generator):
+            callbacks.on_train_batch_begin(batch)
+            logs = train_step(xs, ys)
+            callbacks.on_train_batch_end(batch, logs)
+    finally:
+        training_generator.close()
+    # e.g. the moving statistics of BatchNormalization, before rank 0
+    # saves the model
+    train_step.sync_non_trainable()
+    callbacks.on_epoch_end(epoch[0] - 1, logs)
+    callbacks.on_train_end(logs)
+    return logs
 
 
 def validate_model(orga, model):
     """
     Validates a model on all validation files and return the history.
 
+    All val files are streamed through one pipeline, which reads the batches
+    in a background thread while the model evaluates them. Every sample
+    is used, including the ones of the last partial batch of each file,
+    and the metrics are averaged weighted with the number of samples
+    per batch. The results of each file are printed to the log if there
+    is more than one val file.
+
     Parameters
     ----------
     orga : object Organizer
@@ -98,38 +222,260 @@ def validate_model(orga, model):
         loss values and metrics values.
 
     """
-    # One history for each val file
-    histories = []
+    f_sizes = _get_val_file_sizes(orga)
+
+    # for each file: the sum of the batch metrics times the batch size
+    metric_sums = [0. for i in range(len(f_sizes))]
+    n_samples = [0 for i in range(len(f_sizes))]
+    if orga.cfg.verbose_val:
+        progbar = ks.utils.Progbar(sum(f_sizes))
+    else:
+        progbar = None
+
+    for file_no, xs, ys in _yield_val_batches(orga, f_sizes):
+        batch_sums, batch_size = _test_on_batch(model, xs, ys)
+        metric_sums[file_no] = metric_sums[file_no] + batch_sums
+        n_samples[file_no] += batch_size
+        if progbar is not None:
+            progbar.add(batch_size)
+
+    return _combine_val_metrics(
+        orga, model.metrics_names, metric_sums, n_samples)
+
+
+def parallel_validation(orga, epoch, fileno):
+    """
+    Validate a saved model on all validation files, with several processes.
+
+    The val files are split into parts of whole batches, which are spread
+    over orga.cfg.validation_processes worker processes. Each worker loads
+    the saved model, and sums up the metrics of each part weighted with
+    the number of samples per batch. The sums of all parts are then
+    combined exactly like in validate_model.
+
+    The workers are spawned instead of forked, since tensorflow has usually
+    been used in this process already, e.g. for training. So the orga has
+    to be picklable, i.e. the modifiers have to be defined at the top
+    level of a module.
+
+    Parameters
+    ----------
+    orga : object Organizer
+        Contains all the configurable options in the OrcaNet scripts.
+    epoch : int
+        Epoch of the saved model.
+    fileno : int
+        File number of the saved model.
+
+    Returns
+    -------
+    history : dict
+        The history of the validation on all files. A record of validation
+        loss values and metrics values.
+
+    """
+    f_sizes = _get_val_file_sizes(orga)
+    row_ranges = get_row_ranges(f_sizes, orga.cfg.validation_processes,
+                                orga.cfg.batchsize)
+    files = orga.io.get_local_files("val")
+    # the files are only staged when their first part is started
+    jobs = []
+    for file_no in range(len(f_sizes)):
+        files_dict = {key: files[key][file_no] for key in files}
+        for f_offset, f_size in row_ranges[file_no]:
+            jobs.append((file_no + 1, (file_no, files_dict, f_offset, f_size)))
+    if len(jobs) == 0:
+        raise ValueError("Can not validate: No validation files given")
+    n_processes = min(orga.cfg.validation_processes, len(jobs))
+    orga.io.print_log("Validating on {} parts of {} files with {} "
+                      "processes".format(len(jobs), len(f_sizes), n_processes))
+
+    metric_sums = [0. for i in range(len(f_sizes))]
+    n_samples = [0 for i in range(len(f_sizes))]
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(n_processes, initializer=_init_worker,
+                      initargs=(orga, epoch, fileno)) as pool:
+        for file_no, metric_names, part_sums, part_samples in _imap_staged(
+                orga, pool, _validation_worker, "val", jobs, n_processes):
+            metric_sums[file_no] = metric_sums[file_no] + part_sums
+            n_samples[file_no] += part_samples
+
+    return _combine_val_metrics(orga, metric_names, metric_sums, n_samples)
+
+
+def _validation_worker(job):
+    """ Get the summed up metrics of a part of a file in a worker process
+    of parallel_validation. """
+    file_no, files_dict, f_offset, f_size = job
+    orga, model = _worker_state["orga"], _worker_state["model"]
+    generator = get_h5_generator(
+        orga, files_dict, f_size=f_size, f_offset=f_offset,
+        zero_center=orga.cfg.zero_center_folder is not None,
+        reuse_buffers=True)
+    metric_sums, n_samples = 0., 0
+    try:
+        for xs, ys in BackgroundIterator(generator,
+                                         maxsize=orga.cfg.max_queue_size):
+            batch_sums, batch_size = _test_on_batch(model, xs, ys)
+            metric_sums = metric_sums + batch_sums
+            n_samples += batch_size
+    finally:
+        generator.close()
+    return file_no, model.metrics_names, metric_sums, n_samples
+
+
+def _get_val_file_sizes(orga):
+    """ Get the number of samples to validate on in each val file. """
     f_sizes = orga.io.get_file_sizes("val")
+    if orga.cfg.n_events is not None:
+        # for testing purposes
+        f_sizes = [min(orga.cfg.n_events, f_size) for f_size in f_sizes]
+    return f_sizes
 
-    for i, files_dict in enumerate(orga.io.yield_files("val")):
-        f_size = f_sizes[i]
-        if orga.cfg.n_events is not None:
-            f_size = orga.cfg.n_events  # for testing purposes
 
-        val_generator = get_h5_generator(
-            orga, files_dict, f_size=f_size,
-            zero_center=orga.cfg.zero_center_folder is not None)
+def _test_on_batch(model, xs, ys):
+    """ Get the metrics of one batch times the number of samples in it,
+    and the number of samples. """
+    batch_metrics = model.test_on_batch(xs, ys)
+    batch_size = len(next(iter(xs.values())))
+    return np.atleast_1d(batch_metrics).astype("float64") * batch_size, \
+        batch_size
 
-        history_file = model.evaluate_generator(
-            val_generator,
-            steps=int(f_size / orga.cfg.batchsize),
-            max_queue_size=orga.cfg.max_queue_size,
-            verbose=orga.cfg.verbose_val)
-        if not isinstance(history_file, list):
-            history_file = [history_file, ]
-        histories.append(history_file)
 
-    # average over all val files
-    history = weighted_average(histories, f_sizes)
+def _combine_val_metrics(orga, metric_names, metric_sums, n_samples):
+    """
+    Get the validation history from the summed up metrics of each file,
+    and print the results of each file to the log.
 
+    """
+    histories = [metric_sum / n for metric_sum, n in zip(
+        metric_sums, n_samples)]
     # This history is just a list, not a dict like with fit_generator
     # so transform to dict
-    history = dict(zip(model.metrics_names, history))
-
+    history = dict(zip(metric_names, weighted_average(histories, n_samples)))
+
+    if len(histories) > 1:
+        orga.io.print_log("Validation results per file:")
+        for file_no, file_history in enumerate(histories):
+            orga.io.print_log("  File {} ({} samples): {}".format(
+                file_no + 1, n_samples[file_no], ", ".join(
+                    "{}: {:.4g}".format(name, value) for name, value in zip(
+                        metric_names, file_history))))
     return history
 
 
+def get_row_ranges(f_sizes, n_parts, batchsize):
+    """
+    Split files into ranges of rows, to spread them over worker processes.
+
+    If there are fewer files than parts, every file is split into the same
+    number of parts, so that there are at least n_parts in total. Every part
+    starts at a multiple of the batchsize.
+
+    Parameters
+    ----------
+    f_sizes : List
+        The number of samples in each file.
+    n_parts : int
+        The minimum number of parts in total.
+    batchsize : int
+        The batchsize.
+
+    Returns
+    -------
+    row_ranges : List
+        For each file, a list with the first row and the number of rows
+        of each of its parts.
+
+    """
+    parts_per_file = int(np.ceil(n_parts / max(len(f_sizes), 1)))
+    row_ranges = []
+    for f_size in f_sizes:
+        n_batches = int(np.ceil(f_size / batchsize))
+        n_file_parts = max(min(parts_per_file, n_batches), 1)
+        bounds = np.linspace(0, n_batches, n_file_parts + 1).astype(int)
+        bounds = np.minimum(bounds * batchsize, f_size)
+        row_ranges.append([(int(start), int(stop - start))
+                           for start, stop in zip(bounds[:-1], bounds[1:])])
+    return row_ranges
+
+
+def _yield_val_batches(orga, f_sizes):
+    """
+    Read all batches of all val files in a background thread.
+
+    The generator of the next file is opened while the batches of the
+    previous one are still being evaluated.
+
+    Parameters
+    ----------
+    orga : object Organizer
+        Contains all the configurable options in the OrcaNet scripts.
+    f_sizes : List
+        The number of samples to read from each val file.
+
+    Yields
+    ------
+    file_no : int
+        The index of the val file the batch is from.
+    xs, ys : dict
+        One batch of samples and labels.
+
+    """
+    batches = queue.Queue(maxsize=max(orga.cfg.max_queue_size, 1))
+    stop = threading.Event()
+
+    def put(item):
+        """ Put in the queue, unless the consumer has stopped. """
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def read_files():
+        try:
+            for file_no, files_dict in enumerate(orga.io.yield_files("val")):
+                val_generator = None
+                try:
+                    val_generator = get_h5_generator(
+                        orga, files_dict, f_size=f_sizes[file_no],
+                        zero_center=orga.cfg.zero_center_folder is not None,
+                        reuse_buffers=True)
+                    if orga.cfg.loader_processes is not None:
+                        # the batches are used in order, through a
+                        # queue of limited size
+                        val_generator = ProcessLoader(
+                            val_generator, orga.cfg.loader_processes,
+                            n_keep=get_n_buffers(orga), copy=False)
+                    for xs, ys in iter(val_generator):
+                        if stop.is_set():
+                            return
+                        put(("batch", file_no, xs, ys))
+                finally:
+                    if val_generator is not None:
+                        val_generator.close()
+                    orga.io.release_files(files_dict)
+            put(("done", ))
+        except BaseException as e:
+            put(("error", e))
+
+    reader = threading.Thread(target=read_files, daemon=True)
+    reader.start()
+    try:
+        while True:
+            item = batches.get()
+            if item[0] == "done":
+                break
+            elif item[0] == "error":
+                raise item[1]
+            yield item[1:]
+    finally:
+        stop.set()
+        reader.join()
+
+
 def weighted_average(histories, f_sizes):
     """
     Average multiple histories, weighted with the file size.
@@ -178,12 +524,15 @@ def save_actv_wghts_plot(orga, model, epoch, samples=1):
     """
     plt.ioff()
 
-    file = next(orga.io.yield_files("val"))
-    generator = iter(get_h5_generator(
-        orga, file, f_size=samples,
-        zero_center=orga.cfg.zero_center_folder is not None,
-        keras_mode=True))
-    xs, ys = next(generator)
+    file = orga.io.get_file("val", 1)
+    try:
+        generator = iter(get_h5_generator(
+            orga, file, f_size=samples,
+            zero_center=orga.cfg.zero_center_folder is not None,
+            keras_mode=True))
+        xs, ys = next(generator)
+    finally:
+        orga.io.release_files(file)
 
     pdf_name_act = "{}/activations_epoch_{}_file_{}.pdf".format(
         orga.io.get_subfolder("activations", create=True), epoch[0], epoch[1])
@@ -209,7 +558,8 @@ def save_actv_wghts_plot(orga, model, epoch, samples=1):
         plt.close()
 
 
-def h5_inference(orga, model, files_dict, output_path, samples=None, use_def_label=True):
+def h5_inference(orga, model, files_dict, output_path, samples=None,
+                 use_def_label=True, rows=None):
     """
     Let a model predict on all samples in a h5 file, and save it as a h5 file.
 
@@ -233,67 +583,471 @@ def h5_inference(orga, model, files_dict, output_path, samples=None, use_def_lab
     use_def_label : bool
         If True and no label modifier is given by user, use the default
         label modifier instead of none.
+    rows : tuple, optional
+        Only predict on a part of the file: The first row, and the number
+        of rows. Overwrites samples.
 
     """
     batchsize = orga.cfg.batchsize
-    compression = ("gzip", 1)
 
-    file_size = h5_get_number_of_rows(
+    file_size = orga.io.get_number_of_rows(
         list(files_dict.values())[0],
         datasets=[orga.cfg.key_x_values])
-    generator = iter(get_h5_generator(
+    if rows is None:
+        f_offset, f_size = 0, None
+    else:
+        f_offset, f_size = rows
+    generator = get_h5_generator(
         orga,
         files_dict,
+        f_size=f_size,
+        f_offset=f_offset,
         zero_center=orga.cfg.zero_center_folder is not None,
         keras_mode=False,
-        use_def_label=use_def_label))
+        use_def_label=use_def_label,
+        reuse_buffers=True)
 
-    if samples is None:
+    if rows is not None:
+        steps = int(np.ceil(f_size / batchsize))
+        n_rows = f_size
+    elif samples is None:
         steps = int(file_size / batchsize)
         if file_size % batchsize != 0:
             # add a smaller step in the end
             steps += 1
+        n_rows = file_size
     else:
         steps = int(samples / batchsize)
+        n_rows = min(file_size, steps * batchsize)
+
+    # write to a temporary file first, so that unfinished output files
+    # can not be mistaken for finished ones
+    temp_path = output_path + ".tmp"
+    # reading, predicting and writing are done in parallel
+    reader = BackgroundIterator(itertools.islice(generator, steps),
+                                maxsize=orga.cfg.max_queue_size)
+    try:
+        with h5py.File(temp_path, 'w') as h5_file:
+            writer = PredictionWriter(
+                h5_file, n_rows,
+                dataset_modifier=orga.cfg.dataset_modifier,
+                maxsize=orga.cfg.max_queue_size)
+            try:
+                for s, info_blob in enumerate(reader):
+                    if s % 1000 == 0:
+                        print('Predicting in step {}/{} ({:0.2%})'.format(
+                            s, steps, s/steps))
+
+                    y_pred = model.predict_on_batch(info_blob["xs"])
+                    if not isinstance(y_pred, list):
+                        # if only one output, transform to a list
+                        y_pred = [y_pred]
+                    # transform y_pred to dict
+                    y_pred = {
+                        out: y_pred[i] for i, out in enumerate(model.output_names)}
+                    info_blob["y_pred"] = y_pred
+
+                    writer.put(info_blob)
+                writer.finish()
+            finally:
+                writer.close()
+    finally:
+        reader.close()
+        generator.close()
+    os.replace(temp_path, output_path)
+
+
+def parallel_inference(orga, epoch, fileno, which, jobs, samples=None,
+                       use_def_label=True):
+    """
+    Let a saved model predict on multiple files, with several processes.
 
-    with h5py.File(output_path, 'w') as h5_file:
-        for s in range(steps):
-            if s % 1000 == 0:
-                print('Predicting in step {}/{} ({:0.2%})'.format(
-                    s, steps, s/steps))
-
-            info_blob = next(generator)
-
-            y_pred = model.predict_on_batch(info_blob["xs"])
-            if not isinstance(y_pred, list):
-                # if only one output, transform to a list
-                y_pred = [y_pred]
-            # transform y_pred to dict
-            y_pred = {
-                out: y_pred[i] for i, out in enumerate(model.output_names)}
-            info_blob["y_pred"] = y_pred
-
-            if orga.cfg.dataset_modifier is None:
-                datasets = get_datasets(info_blob)
-            else:
-                datasets = orga.cfg.dataset_modifier(info_blob)
+    The files are spread over orga.cfg.inference_processes worker processes.
+    Each worker loads the saved model once, and then predicts on one file
+    after the other with h5_inference. Jobs whose output file exists already
+    are skipped. If there are fewer files than processes, the files are split
+    into parts (see get_row_ranges), whose predictions are concatenated
+    in order afterwards.
 
-            # TODO maybe add attr to data, like used files or orcanet version number?
-            if s == 0:  # create datasets in the first step
-                for dataset_name, data in datasets.items():
-                    maxshape = (file_size,) + data.shape[1:]
-                    chunks = True  # (batchsize,) + data.shape[1:]
-                    h5_file.create_dataset(
-                        dataset_name, data=data, maxshape=maxshape,
-                        chunks=chunks, compression=compression[0],
-                        compression_opts=compression[1])
+    Like in parallel_validation, the workers are spawned, so the orga
+    has to be picklable, and the files are only staged while their
+    jobs are running.
 
-            else:
+    Parameters
+    ----------
+    orga : object Organizer
+        Contains all the configurable options in the OrcaNet scripts.
+    epoch : int
+        Epoch of the saved model.
+    fileno : int
+        File number of the saved model.
+    which : str
+        The fileset to predict on, e.g. "val" or "inference".
+    jobs : List
+        The file number (starting at 1) and the output path of every file
+        to predict on, as tuples.
+    samples : int, optional
+        Dont use all events in the files, but instead only the given number.
+    use_def_label : bool
+        If True and no label modifier is given by user, use the default
+        label modifier instead of none.
+
+    """
+    jobs = [(file_no, output_path) for file_no, output_path in jobs
+            if not os.path.exists(output_path)]
+    if len(jobs) == 0:
+        return
+
+    files = orga.io.get_local_files(which)
+    f_sizes = []
+    for file_no, output_path in jobs:
+        files_dict = {key: files[key][file_no - 1] for key in files}
+        f_size = orga.io.get_number_of_rows(
+            list(files_dict.values())[0], datasets=[orga.cfg.key_x_values])
+        if samples is not None:
+            f_size = min(f_size, int(samples / orga.cfg.batchsize) *
+                         orga.cfg.batchsize)
+        f_sizes.append(f_size)
+    # the predictions of the parts of each file, in order
+    part_paths = {}
+    tasks = []
+    for (file_no, output_path), row_ranges in zip(jobs, get_row_ranges(
+            f_sizes, orga.cfg.inference_processes, orga.cfg.batchsize)):
+        files_dict = {key: files[key][file_no - 1] for key in files}
+        if len(row_ranges) == 1:
+            tasks.append((file_no, (files_dict, output_path, samples,
+                                    use_def_label, None)))
+            continue
+        part_paths[output_path] = []
+        for part_no, rows in enumerate(row_ranges):
+            part_path = "{}.part_{}".format(output_path, part_no)
+            part_paths[output_path].append(part_path)
+            # parts can be done already if the prediction was interrupted
+            if not os.path.exists(part_path):
+                tasks.append((file_no, (files_dict, part_path, None,
+                                        use_def_label, rows)))
+    if len(tasks) > 0:
+        _run_inference_workers(orga, epoch, fileno, which, tasks)
+
+    for output_path, paths in part_paths.items():
+        concatenate_h5_files(paths, output_path)
+        for path in paths:
+            os.remove(path)
+
+
+def _run_inference_workers(orga, epoch, fileno, which, jobs):
+    """ Run the jobs of parallel_inference in a pool of worker processes. """
+    n_processes = min(orga.cfg.inference_processes, len(jobs))
+    print("Predicting on {} files or parts of files with {} processes".format(
+        len(jobs), n_processes))
+
+    start_time = time.time()
+    # tensorflow has usually been used in this process already, so fork
+    # is not safe
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(n_processes, initializer=_init_worker,
+                      initargs=(orga, epoch, fileno)) as pool:
+        results = _imap_staged(
+            orga, pool, _inference_worker, which, jobs, n_processes)
+        for job_no, (output_path, elapsed_s) in enumerate(results, 1):
+            print('Finished file {}/{} ({}) in {}, {} elapsed in '
+                  'total'.format(
+                    job_no, len(jobs), os.path.basename(output_path),
+                    timedelta(seconds=int(elapsed_s)),
+                    timedelta(seconds=int(time.time() - start_time))))
+
+
+def _imap_staged(orga, pool, function, which, jobs, max_jobs):
+    """
+    Like pool.imap_unordered, but the files of each job are only staged
+    right before the job is started, and released when all jobs on
+    the file are done.
+
+    Parameters
+    ----------
+    orga : object Organizer
+        Contains all the configurable options in the OrcaNet scripts.
+    pool : multiprocessing.pool.Pool
+        The pool to run the jobs in.
+    function : function
+        Gets called with the argument of each job in the pool.
+    which : str
+        The fileset of the files, e.g. "val".
+    jobs : List
+        The file number (starting at 1) and the argument of each job,
+        as tuples.
+    max_jobs : int
+        How many jobs can be submitted to the pool at the same time.
+
+    Yields
+    ------
+    result
+        The result of each job, in the order they are done.
+
+    """
+    # number of unfinished jobs on each file
+    remaining = collections.Counter(file_no for file_no, arg in jobs)
+    # file_no -> the staged files dict
+    staged = {}
+    # (file_no, result, exception) of each finished job
+    done = queue.Queue()
+    jobs = iter(jobs)
+    n_running = 0
+    try:
+        while True:
+            for file_no, arg in itertools.islice(jobs, max_jobs - n_running):
+                if file_no not in staged:
+                    staged[file_no] = orga.io.get_file(which, file_no)
+                pool.apply_async(
+                    function, (arg, ),
+                    callback=lambda result, file_no=file_no: done.put(
+                        (file_no, result, None)),
+                    error_callback=lambda e, file_no=file_no: done.put(
+                        (file_no, None, e)))
+                n_running += 1
+            if n_running == 0:
+                return
+            file_no, result, exception = done.get()
+            n_running -= 1
+            if exception is not None:
+                raise exception
+            remaining[file_no] -= 1
+            if remaining[file_no] == 0:
+                orga.io.release_files(staged.pop(file_no))
+            yield result
+    finally:
+        for files_dict in staged.values():
+            orga.io.release_files(files_dict)
+
+
+# the orga and model of a worker process of parallel_inference or
+# parallel_validation
+_worker_state = {}
+
+
+def _init_worker(orga, epoch, fileno):
+    """ Load the model in a worker process of parallel_inference or
+    parallel_validation. """
+    model = orga.load_saved_model(epoch, fileno, logging=False)
+    orga._set_up(model)
+    _worker_state["orga"] = orga
+    _worker_state["model"] = model
+
+
+def _inference_worker(job):
+    """ Predict on one file in a worker process of parallel_inference. """
+    files_dict, output_path, samples, use_def_label, rows = job
+    start_time = time.time()
+    h5_inference(_worker_state["orga"], _worker_state["model"], files_dict,
+                 output_path, samples=samples, use_def_label=use_def_label,
+                 rows=rows)
+    return output_path, time.time() - start_time
+
+
+class BackgroundIterator:
+    """
+    Iterate over an iterable in a background thread.
+
+    The items are put into a queue of limited size, from which they
+    can be taken by iterating over this object. Errors in the background
+    thread are raised in the iterating thread.
+
+    """
+    def __init__(self, iterable, maxsize=10):
+        """
+        Parameters
+        ----------
+        iterable : iterable
+            The iterable to read out in the background.
+        maxsize : int
+            How many items can be waiting in the queue at most.
+
+        """
+        self._queue = queue.Queue(max(maxsize, 1))
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, args=(iterable, ), daemon=True)
+        self._thread.start()
+
+    def __iter__(self):
+        while True:
+            kind, item = self._queue.get()
+            if kind == "end":
+                return
+            elif kind == "error":
+                raise item
+            yield item
+
+    def close(self):
+        """ Stop the background thread. """
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self, iterable):
+        try:
+            for item in iterable:
+                if not self._put(("item", item)):
+                    return
+        except Exception as e:
+            self._put(("error", e))
+        else:
+            self._put(("end", None))
+
+    def _put(self, message):
+        """ Put into the queue, unless close has been called. """
+        while not self._stop.is_set():
+            try:
+                self._queue.put(message, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+
+class PredictionWriter:
+    """
+    Write the datasets of batches to a h5 file in a background thread.
+
+    The datasets are preallocated in the file, and every batch is written
+    into its slice. Data gets compressed in a thread pool, and written
+    directly as chunks if possible (i.e. every batch fills exactly one
+    chunk).
+
+    """
+    def __init__(self, h5_file, n_rows, dataset_modifier=None, maxsize=10,
+                 compression_level=1, compression_threads=2):
+        """
+        Parameters
+        ----------
+        h5_file : h5py.File
+            The opened file to write into.
+        n_rows : int
+            The expected number of rows of each dataset. Datasets are
+            preallocated to this size, and resized in the end if needed.
+        dataset_modifier : function or None
+            Gets the info_blob of each batch and returns the datasets
+            to write. If None, use get_datasets.
+        maxsize : int
+            How many batches can be waiting to be written at most.
+        compression_level : int
+            gzip compression level of the datasets.
+        compression_threads : int
+            Number of threads that compress the data.
+
+        """
+        self.h5_file = h5_file
+        self.n_rows = n_rows
+        self.dataset_modifier = dataset_modifier
+        self.compression_level = compression_level
+
+        # number of rows written to each dataset so far
+        self._rows = {}
+        self._error = None
+        self._queue = queue.Queue(max(maxsize, 1))
+        self._stop = threading.Event()
+        self._executor = ThreadPoolExecutor(compression_threads)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def put(self, info_blob):
+        """ Add the info_blob of the next batch. """
+        while True:
+            self._check_error()
+            try:
+                self._queue.put(info_blob, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def finish(self):
+        """ Wait until everything is written, and raise possible errors. """
+        self.put(None)
+        self._thread.join()
+        self._check_error()
+
+    def close(self):
+        """ Stop the background threads. """
+        self._stop.set()
+        self._thread.join()
+        self._executor.shutdown(wait=True)
+
+    def _check_error(self):
+        if self._error is not None:
+            raise self._error
+
+    def _run(self):
+        # batches that are being compressed: (dataset, offset, data, future)
+        pending = collections.deque()
+        try:
+            while not self._stop.is_set():
+                try:
+                    info_blob = self._queue.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                if info_blob is None:
+                    break
+                if self.dataset_modifier is None:
+                    datasets = get_datasets(info_blob)
+                else:
+                    datasets = self.dataset_modifier(info_blob)
                 for dataset_name, data in datasets.items():
-                    # append data at the end of the dataset
-                    h5_file[dataset_name].resize(
-                        h5_file[dataset_name].shape[0] + data.shape[0], axis=0)
-                    h5_file[dataset_name][-data.shape[0]:] = data
+                    pending.append(self._prepare(dataset_name, data))
+                # keep the compression of about two batches going
+                while len(pending) > 2 * len(datasets):
+                    self._write(*pending.popleft())
+            else:
+                # stopped by close
+                return
+            while pending:
+                self._write(*pending.popleft())
+            for dataset_name, rows in self._rows.items():
+                if self.h5_file[dataset_name].shape[0] != rows:
+                    self.h5_file[dataset_name].resize(rows, axis=0)
+        except Exception as e:
+            self._error = e
+
+    def _prepare(self, dataset_name, data):
+        """ Create the dataset if neccessary, and start the compression. """
+        if dataset_name not in self._rows:
+            self.h5_file.create_dataset(
+                dataset_name,
+                shape=(max(self.n_rows, data.shape[0]),) + data.shape[1:],
+                maxshape=(None,) + data.shape[1:],
+                chunks=(max(data.shape[0], 1),) + data.shape[1:],
+                dtype=data.dtype,
+                compression="gzip",
+                compression_opts=self.compression_level)
+            self._rows[dataset_name] = 0
+        dataset = self.h5_file[dataset_name]
+        offset = self._rows[dataset_name]
+        self._rows[dataset_name] += data.shape[0]
+
+        chunk_rows = dataset.chunks[0]
+        if offset % chunk_rows == 0 and (
+                data.shape[0] == chunk_rows or
+                offset + data.shape[0] == self.n_rows):
+            future = self._executor.submit(
+                self._compress, data, dataset.chunks, dataset.dtype)
+        else:
+            future = None
+        return dataset, offset, data, future
+
+    def _compress(self, data, chunks, dtype):
+        """ Compress data to one chunk, filled up with zeros. """
+        chunk = np.zeros(chunks, dtype=dtype)
+        chunk[:data.shape[0]] = data
+        return zlib.compress(chunk.tobytes(), self.compression_level)
+
+    def _write(self, dataset, offset, data, future):
+        """ Write the data of a batch to its slice of the dataset. """
+        stop = offset + data.shape[0]
+        if stop > dataset.shape[0]:
+            dataset.resize(stop, axis=0)
+        if future is None:
+            dataset[offset:stop] = data
+        else:
+            dataset.id.write_direct_chunk(
+                (offset, ) + (0, ) * (dataset.ndim - 1), future.result())
 
 
 def make_model_prediction(orga, model, epoch, fileno, samples=None):
@@ -309,8 +1063,10 @@ def make_model_prediction(orga, model, epoch, fileno, samples=None):
     ----------
     orga : object Organizer
         Contains all the configurable options in the OrcaNet scripts.
-    model : ks.model.Model
-        Trained Keras model of a neural network.
+    model : ks.model.Model or None
+        Trained Keras model of a neural network. Not used if
+        orga.cfg.inference_processes is set, since the worker processes
+        load the saved model of the given epoch and fileno themselves.
     epoch : int
         Epoch of the last model training step in the epoch, file_no tuple.
     fileno : int
@@ -320,6 +1076,13 @@ def make_model_prediction(orga, model, epoch, fileno, samples=None):
         If samples=None, the whole file will be used.
 
     """
+    if orga.cfg.inference_processes is not None:
+        jobs = [(f_number, orga.io.get_pred_path(epoch, fileno, f_number))
+                for f_number in range(
+                    1, orga.io.get_no_of_files("val") + 1)]
+        parallel_inference(orga, epoch, fileno, "val", jobs, samples=samples)
+        return
+
     latest_pred_file_no = orga.io.get_latest_prediction_file_no(epoch, fileno)
     if latest_pred_file_no is None:
         latest_pred_file_no = 0
@@ -327,11 +1090,14 @@ def make_model_prediction(orga, model, epoch, fileno, samples=None):
     # For every val file set (one set can have multiple files if
     # the model has multiple inputs):
     for f_number, files_dict in enumerate(orga.io.yield_files("val"), 1):
-        if f_number <= latest_pred_file_no:
-            continue
-
-        pred_filepath = orga.io.get_pred_path(epoch, fileno, f_number)
-        h5_inference(orga, model, files_dict, pred_filepath, samples=samples)
+        try:
+            if f_number <= latest_pred_file_no:
+                continue
+            pred_filepath = orga.io.get_pred_path(epoch, fileno, f_number)
+            h5_inference(
+                orga, model, files_dict, pred_filepath, samples=samples)
+        finally:
+            orga.io.release_files(files_dict)
 
 
 def get_datasets(info_blob):
@@ -10,12 +10,14 @@ import warnings
 import time
 from datetime import timedelta
 import keras as ks
+import numpy as np
 
 import orcanet.backend as backend
-from orcanet.utilities.visualization import update_summary_plot
+from orcanet.distributed import DistributedTrainStep, get_communicator
+from orcanet.utilities.visualization import SummaryPlotter
 from orcanet.in_out import IOHandler
 from orcanet.history import HistoryHandler
-from orcanet.utilities.nn_utilities import load_zero_center_data, get_auto_label_modifier
+from orcanet.utilities.nn_utilities import load_zero_center_data, load_zero_center_std, get_auto_label_modifier
 import orcanet.logging as olog
 
 
@@ -73,8 +75,23 @@ class Organizer:
         self.history = HistoryHandler(output_folder)
 
         self.xs_mean = None
+        self.xs_std = None
         self._auto_label_modifier = None
         self._stored_model = None
+        self._summary_plotter = None
+        self._comm = None
+        self._train_step = None
+
+    def __getstate__(self):
+        """ Leave out what belongs to this process when pickling, e.g. for
+        sending the organizer to spawned worker processes. """
+        state = self.__dict__.copy()
+        state["_stored_model"] = None
+        state["_summary_plotter"] = None
+        state["_comm"] = None
+        state["_train_step"] = None
+        state["_auto_label_modifier"] = None
+        return state
 
     def train_and_validate(self, model=None, epochs=None):
         """
@@ -89,6 +106,11 @@ class Organizer:
         the plots subfolder after every validation.
         The training can be resumed by executing this function again.
 
+        If the script was started with the launcher of orcanet.distributed
+        (orcalaunch), the training is distributed over all of its worker
+        processes. Only the worker with rank 0 logs, saves the model and
+        validates.
+
         Parameters
         ----------
         model : ks.models.Model or str, optional
@@ -111,9 +133,10 @@ class Organizer:
 
         model = self._get_model(model, logging=False)
         self._stored_model = model
+        is_main = self._is_main_worker()
 
         # check if the validation is missing for the latest fileno
-        if latest_epoch is not None:
+        if is_main and latest_epoch is not None:
             state = self.history.get_state()[-1]
             if state["is_validated"] is False and self.val_is_due(latest_epoch):
                 self.validate()
@@ -122,18 +145,22 @@ class Organizer:
         n_train_files = self.io.get_no_of_files("train")
 
         trained_epochs = 0
-        while epochs is None or trained_epochs < epochs:
-            # Train on remaining files
-            for file_no in range(next_epoch[1], n_train_files + 1):
-                curr_epoch = (next_epoch[0], file_no)
-                self.train(model)
-                if self.val_is_due(curr_epoch):
-                    self.validate()
-
-            next_epoch = (next_epoch[0] + 1, 1)
-            trained_epochs += 1
+        try:
+            while epochs is None or trained_epochs < epochs:
+                # Train on remaining files
+                for file_no in range(next_epoch[1], n_train_files + 1):
+                    curr_epoch = (next_epoch[0], file_no)
+                    self._train(model)
+                    if is_main and self.val_is_due(curr_epoch):
+                        self.validate()
+
+                next_epoch = (next_epoch[0] + 1, 1)
+                trained_epochs += 1
+        finally:
+            self._close_comm()
 
         self._stored_model = None
+        self._get_summary_plotter().wait()
         return model
 
     def train(self, model=None):
@@ -141,6 +168,8 @@ class Organizer:
         Trains a model on the next file.
 
         The progress of the training is also logged and plotted.
+        In distributed training, the connections to the other workers
+        are closed afterwards, and made again in the next call.
 
         Parameters
         ----------
@@ -158,6 +187,21 @@ class Organizer:
             loss values and metrics values.
 
         """
+        try:
+            return self._train(model)
+        finally:
+            self._close_comm()
+
+    def _train(self, model=None):
+        """
+        Train on the next file, without closing the connections to the
+        other workers in distributed training afterwards.
+
+        """
+        comm = self._get_comm()
+        if comm is not None and comm.rank != 0:
+            return self._train_worker(model, comm)
+
         # Create folder structure
         self.io.get_subfolder(create=True)
         latest_epoch = self.io.get_latest_epoch()
@@ -200,8 +244,16 @@ class Organizer:
                                                    os.path.basename(
                                                        input_file)))
 
+        if comm is not None:
+            # start the other workers on the same file
+            comm.broadcast(np.array(next_epoch, dtype="int64"))
+
         start_time = time.time()
-        history = backend.train_model(self, model, next_epoch, batch_logger=True)
+        try:
+            history = backend.train_model(self, model, next_epoch,
+                                          batch_logger=True, comm=comm)
+        finally:
+            self.io.release_files(files_dict)
         elapsed_s = int(time.time() - start_time)
 
         model.save(model_path)
@@ -213,12 +265,28 @@ class Organizer:
         self.io.print_log("Elapsed time: {}".format(timedelta(seconds=elapsed_s)))
         self.io.print_log("Saved model to: {}\n".format(model_path_local))
 
-        update_summary_plot(self)
+        self._get_summary_plotter().update()
         if self.cfg.cleanup_models:
             self.cleanup_models()
 
         return history
 
+    def _train_worker(self, model, comm):
+        """
+        Train on the next file as one of the workers without rank 0
+        in distributed training, without logging or saving anything.
+
+        """
+        model = self._get_model(model, logging=False)
+        # wait for the worker with rank 0, which decides on the file
+        next_epoch = comm.broadcast(np.zeros(2, dtype="int64"))
+        next_epoch = tuple(next_epoch.tolist())
+        # rank 0 has done the setup already, e.g. the zero center image
+        self._set_up(model)
+        lr = self.io.get_learning_rate(next_epoch)
+        ks.backend.set_value(model.optimizer.lr, lr)
+        return backend.train_model(self, model, next_epoch, comm=comm)
+
     def validate(self, make_weight_plots=True):
         """
         Validate the most recent saved model on all validation files.
@@ -256,7 +324,10 @@ class Organizer:
         olog.log_start_validation(self)
 
         start_time = time.time()
-        history = backend.validate_model(self, model)
+        if self.cfg.validation_processes is None:
+            history = backend.validate_model(self, model)
+        else:
+            history = backend.parallel_validation(self, *latest_epoch)
         elapsed_s = int(time.time() - start_time)
 
         self.io.print_log('Validation results:')
@@ -265,7 +336,7 @@ class Organizer:
         self.io.print_log(f"Elapsed time: {timedelta(seconds=elapsed_s)}\n")
         smry_logger.write_line(epoch_float, "n/a", history_val=history)
 
-        update_summary_plot(self)
+        self._get_summary_plotter().update()
         if make_weight_plots:
             backend.save_actv_wghts_plot(
                 self, model, latest_epoch, samples=self.cfg.batchsize)
@@ -290,8 +361,10 @@ class Organizer:
             Epoch of a model to load.
         fileno : int, optional
             File number of a model to load.
-        concatenate : bool
+        concatenate : bool or str
             Whether the prediction files should also be concatenated.
+            If "virtual", the concatenated file only contains virtual
+            datasets, which refer to the data in the prediction files.
 
         Returns
         -------
@@ -314,8 +387,13 @@ class Organizer:
             pred_filepaths = self.io.get_pred_files_list(epoch, fileno)
 
         else:
-            model = self.load_saved_model(epoch, fileno, logging=False)
-            self._set_up(model)
+            if self.cfg.inference_processes is None:
+                model = self.load_saved_model(epoch, fileno, logging=False)
+                self._set_up(model)
+            else:
+                # the worker processes load the model themselves
+                model = None
+                self._set_up_parallel()
 
             start_time = time.time()
             backend.make_model_prediction(self, model, epoch, fileno)
@@ -328,10 +406,11 @@ class Organizer:
         # concatenate all prediction files if wished
         concatenated_folder = self.io.get_subfolder("predictions") + '/concatenated'
         n_val_files = self.io.get_no_of_files("val")
-        if concatenate is True and n_val_files > 1:
+        if concatenate and n_val_files > 1:
             if not os.path.isdir(concatenated_folder):
                 print('Concatenating all prediction files to a single one.')
-                pred_filename_conc = self.io.concatenate_pred_files(concatenated_folder)
+                pred_filename_conc = self.io.concatenate_pred_files(
+                    concatenated_folder, virtual=concatenate == "virtual")
                 pred_filepaths = [pred_filename_conc]
             else:
                 # omit directories if there are any in the concatenated folder
@@ -372,13 +451,13 @@ class Organizer:
             raise ValueError(
                 "Either both or none of epoch and fileno must be None")
 
-        model = self.load_saved_model(epoch, fileno, logging=False)
-        self._set_up(model)
-
-        filenames = []
-        for files_dict in self.io.yield_files("inference"):
+        filenames, jobs = [], []
+        # only the names are needed here, so the files are not staged yet
+        inference_files = self.io.get_local_files("inference")
+        for file_no in range(1, self.io.get_no_of_files("inference") + 1):
             # output filename is based on name of file in first input
-            first_filename = os.path.basename(list(files_dict.values())[0])
+            first_filename = os.path.basename(
+                list(inference_files.values())[0][file_no - 1])
             output_filename = "model_epoch_{}_file_{}_on_{}".format(
                 epoch, fileno, first_filename)
 
@@ -389,10 +468,29 @@ class Organizer:
                 warnings.warn("Warning: {} exists already, skipping "
                               "file".format(output_filename))
                 continue
+            jobs.append((file_no, output_path))
+
+        if len(jobs) == 0:
+            return filenames
 
+        if self.cfg.inference_processes is not None:
+            self._set_up_parallel()
+            backend.parallel_inference(
+                self, epoch, fileno, "inference", jobs, use_def_label=False)
+            return filenames
+
+        model = self.load_saved_model(epoch, fileno, logging=False)
+        self._set_up(model)
+
+        for file_no, output_path in jobs:
+            files_dict = self.io.get_file("inference", file_no)
+            first_filename = os.path.basename(list(files_dict.values())[0])
             start_time = time.time()
-            backend.h5_inference(
-                self, model, files_dict, output_path, use_def_label=False)
+            try:
+                backend.h5_inference(
+                    self, model, files_dict, output_path, use_def_label=False)
+            finally:
+                self.io.release_files(files_dict)
             elapsed_s = int(time.time() - start_time)
             print('Finished on file {} in {}'.format(
                 first_filename, timedelta(seconds=elapsed_s)))
@@ -448,6 +546,11 @@ class Organizer:
             already been fully done or not.
 
         """
+        if self.cfg.inference_processes is not None:
+            # files are not finished in order when predicting in parallel
+            return all(os.path.exists(self.io.get_pred_path(epoch, fileno, i))
+                       for i in range(1, self.io.get_no_of_files('val') + 1))
+
         latest_pred_file_no = self.io.get_latest_prediction_file_no(epoch, fileno)
         total_no_of_val_files = self.io.get_no_of_files('val')
 
@@ -491,6 +594,31 @@ class Organizer:
             self.xs_mean = load_zero_center_data(self, logging=logging)
         return self.xs_mean
 
+    def get_xs_std(self, logging=False):
+        """
+        Set and return the standard deviation of each bin for each list input.
+
+        It is calculated together with the zero center image (see
+        get_xs_mean).
+
+        Parameters
+        ----------
+        logging : bool
+            If true, the execution of get_xs_mean will be logged into the
+            full summary in the output folder if called for the first time.
+
+        Returns
+        -------
+        dict
+            Dict of numpy arrays that contains the standard deviation of the
+            x dataset (1 array per list input).
+
+        """
+        if self.xs_std is None:
+            self.get_xs_mean(logging=logging)
+            self.xs_std = load_zero_center_std(self)
+        return self.xs_std
+
     def load_saved_model(self, epoch, fileno, logging=False):
         """
         Load a saved model.
@@ -574,6 +702,63 @@ class Organizer:
         if self.cfg.zero_center_folder is not None:
             self.get_xs_mean(logging)
 
+    def _get_summary_plotter(self):
+        """ Get the SummaryPlotter for updating the summary plot. """
+        if self._summary_plotter is None:
+            self._summary_plotter = SummaryPlotter(self)
+        return self._summary_plotter
+
+    def _get_comm(self):
+        """
+        Get the Communicator for distributed training, or None if this
+        process was not started by the launcher of orcanet.distributed.
+
+        """
+        if self._comm is None:
+            self._comm = get_communicator()
+        return self._comm
+
+    def _close_comm(self):
+        """ Close the connections to the other workers, if there are any. """
+        if self._comm is not None:
+            self._comm.close()
+        self._comm = None
+        self._train_step = None
+
+    def _get_train_step(self, model, comm):
+        """
+        Get the DistributedTrainStep for training the model.
+
+        It is only built once per model, since building it traces the
+        train step again. The weights of all workers are synced when
+        it is built, and stay the same afterwards.
+
+        """
+        step = self._train_step
+        if step is None or step.model is not model or step.comm is not comm:
+            step = DistributedTrainStep(model, comm)
+            step.sync_weights()
+            self._train_step = step
+        return step
+
+    def _is_main_worker(self):
+        """ True if not training distributed, or if this worker has rank 0. """
+        comm = self._get_comm()
+        return comm is None or comm.rank == 0
+
+    def _set_up_parallel(self):
+        """
+        Setup for predicting with multiple processes, which happens
+        before the model is loaded in the worker processes.
+
+        """
+        if self.cfg.get_list_file() is None:
+            raise ValueError("No files specified. Need to load a toml "
+                             "list file with pathes to h5 files first.")
+        # calculate it here, instead of in every worker
+        if self.cfg.zero_center_folder is not None:
+            self.get_xs_mean()
+
     def val_is_due(self, epoch=None):
         """
         True if validation is due on given epoch according to schedule.
@@ -621,6 +806,14 @@ class Configuration(object):
         in the resulting h5 file. If none, every output layer will get one
         dataset each for both the label and the prediction, and one dataset
         containing the y_values from the validation files.
+    inference_processes : int or None
+        If given, orga.predict and orga.inference spread the files over
+        this many worker processes, which load the saved model
+        themselves. Output files that exist already are skipped. If there
+        are fewer files than processes, the files are split into parts,
+        whose predictions are concatenated in order afterwards.
+        The workers are spawned, so the modifiers have to be picklable,
+        like for validation_processes.
     key_x_values : str
         The name of the datagroup in the h5 input files which contains
         the samples for the network.
@@ -643,6 +836,12 @@ class Configuration(object):
         If it is a str: Path to a csv file inside the main folder, containing
         3 columns with the epoch, fileno, and the value the lr will be set
         to when reaching this epoch/fileno.
+    loader_processes : int or None
+        If given, the batches for training and validation are read out and
+        modified in this many worker processes, which hand them over in
+        shared memory. Does not work together with shuffle_buffer_files.
+        The modifiers are run in the workers, so they can not use
+        tensorflow, and have to be defined at the top level of a module.
     max_queue_size : int
         max_queue_size option of the keras training and evaluation generator
         methods. How many batches get preloaded
@@ -650,39 +849,120 @@ class Configuration(object):
     n_events : None or int
         For testing purposes. If not the whole .h5 file should be used for
         training, define the number of samples.
+    prefetch_batches : int
+        How many of the upcoming batches are read out and modified in
+        background threads while the model works on the current one.
+        0 for no prefetching. If > 0, the order of the batches during
+        training is only determined by shuffle_train.
     sample_modifier : function or None
         Operation to be performed on batches of x_values read from the input
         files before they are fed into the model as samples.
-    shuffle_train : bool
+    scratch_max_size : float or None
+        Only for use_scratch_ssd: Maximum size in bytes that the copied files
+        may take up on the scratch space. Older copies are deleted to make
+        space for new ones. None for no limit.
+    shuffle_buffer_files : int or None
+        If given, samples from this many training files are mixed during
+        training. The files are split into groups of this size, and every
+        file step trains on an equal slice of each file in its group.
+        Samples are shuffled in a buffer of shuffle_buffer_memory bytes.
+    shuffle_buffer_memory : float
+        Only for shuffle_buffer_files: Size of the buffer for mixing
+        samples in bytes.
+    shuffle_chunk_buffer : int
+        Only for shuffle_train = "chunks": How many chunks of the files are
+        shuffled together in memory.
+    shuffle_train : bool or str
         If true, the order in which batches are read out from the files during
         training are randomized each time they are read out.
+        If "chunks", the samples are shuffled instead, in a way that respects
+        the chunk layout of the h5 files: the order of the chunks is
+        randomized, and samples are shuffled within a buffer of
+        shuffle_chunk_buffer chunks. This is much faster than shuffling
+        batches, since every chunk has to be decompressed only once.
+        With virtual_files, the chunk size of the original files is used.
+    summary_plot_background : bool
+        If true, the summary plot is rendered in a background process
+        after each training file and validation, so that the training
+        can continue in the meantime. The process is spawned, so the
+        script has to be guarded with if __name__ == "__main__". If the
+        plotting fails, there is only a warning.
+    summary_plot_formats : List
+        Formats of the summary plot: "pdf" for one file with all plots,
+        "png" and "svg" for one file per plot.
+    summary_plot_points : int or None
+        The lines of each training log file are averaged down to at most
+        this many points in the summary plot. None for no averaging.
     train_logger_display : int
         How many batches should be averaged for one line in the training log files.
     train_logger_flush : int
         After how many lines the training log file should be flushed (updated on
         the disk). -1 for flush at the end of the file only.
+    train_logger_timing : bool
+        If true, the training log files also contain the time per batch,
+        how long getting a batch from the generator took, the time in the
+        train step, how many batches the generator had read ahead, and
+        the samples per second. A summary is written to the log.txt.
+        With max_queue_size > 0, the batches are fetched in background
+        threads, so the time to get a batch (time_fetch) is the time the
+        generator needs, not how long the training waited for it.
+    train_logger_format : str
+        Format of the training log files. "txt" for one text file per
+        epoch and file, "h5" for appending them all to one h5 file in the
+        train_log folder, which is faster to write and to read for
+        plotting. Use orcanet.logging.convert_binary_to_txt_train_log
+        and convert_txt_to_binary_train_log to convert between them.
     output_folder : str
         Name of the folder of this model in which everything will be saved,
         e.g., the summary.txt log file is located in here.
+    use_memmap : bool
+        If true, datasets in the input files that are stored contiguously
+        and uncompressed are read via numpy memmaps instead of h5py,
+        which has much less overhead per batch. Works best in combination
+        with use_scratch_ssd. The modifiers then get copy-on-write views
+        into the files, and the files stay mapped as long as they are used.
+        Default: False.
     use_scratch_ssd : bool
         Only working at HPC Erlangen: Declares if the input files should be
-        copied to the node-local SSD scratch space.
+        copied to the node-local SSD scratch space (given by the environment
+        variable TMPDIR). Files are copied in the background when needed,
+        the next one while training on the current one.
     validate_interval : int or None
         Validate the model after this many training files have been trained on
         in an epoch. There will always be a validation at the end of an epoch.
         None for only validate at the end of an epoch.
         Example: validate_interval=3 --> Validate after file 3, 6, 9, ...
+    validation_processes : int or None
+        If given, the val files are split into parts which are spread over
+        this many worker processes, which load the saved model themselves.
+        The workers are spawned, so the modifiers have to be picklable,
+        i.e. defined at the top level of a module, and the script has
+        to be guarded with if __name__ == "__main__".
+    virtual_files : List or None
+        The filesets ("train", "val" and/or "inference") for which all files
+        of each input in the toml list are presented as one file. It
+        contains virtual datasets of the samples and labels of all files,
+        and is saved in the virtual_files subfolder. E.g. ["val"] to
+        validate on all files with one generator. For "train", every file
+        of an epoch is then the whole training set, so that batches can
+        mix samples from all files, and shuffle_train shuffles
+        globally. Can not be used together with use_scratch_ssd.
     verbose_train : int
         verbose option of keras.model.fit_generator.
         0 = silent, 1 = progress bar, 2 = one line per epoch.
     verbose_val : int
         verbose option of evaluate_generator.
         0 = silent, 1 = progress bar.
+    zero_center_dtype : str
+        The dtype of the zero centered samples, e.g. float32 or float16.
     zero_center_folder : None or str
         Path to a folder in which zero centering images are stored.
         If this path is set, zero centering images for the given dataset will
         either be calculated and saved automatically at the start of the
         training, or loaded if they have been saved before.
+    zero_center_scale : bool
+        If true, the zero centered samples are also divided by the standard
+        deviation of each bin in the train data.
 
     """
     # TODO add a clober script that properly deletes models + logfiles
@@ -712,28 +992,45 @@ class Configuration(object):
         self.learning_rate = 0.001
 
         self.zero_center_folder = None
+        self.zero_center_dtype = "float32"
+        self.zero_center_scale = False
         self.validate_interval = None
+        self.validation_processes = None
         self.cleanup_models = False
         self.class_weight = None
 
         self.sample_modifier = None
         self.dataset_modifier = None
         self.label_modifier = None
+        self.inference_processes = None
+        self.loader_processes = None
 
         self.key_x_values = "x"
         self.key_y_values = "y"
         self.custom_objects = None
         self.shuffle_train = False
+        self.shuffle_chunk_buffer = 16
+        self.shuffle_buffer_files = None
+        self.shuffle_buffer_memory = 2e9
 
         self.callback_train = None
         self.use_scratch_ssd = False
+        self.scratch_max_size = None
+        self.use_memmap = False
+        self.virtual_files = None
         self.verbose_train = 1
         self.verbose_val = 0
 
         self.n_events = None
         self.max_queue_size = 10
+        self.prefetch_batches = 0
         self.train_logger_display = 100
         self.train_logger_flush = -1
+        self.train_logger_timing = False
+        self.train_logger_format = "txt"
+        self.summary_plot_background = False
+        self.summary_plot_formats = ["pdf"]
+        self.summary_plot_points = None
 
         self._default_values = dict(self.__dict__)
 
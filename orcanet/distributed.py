@@ -0,0 +1,545 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Data-parallel training with multiple worker processes.
+
+Every worker trains a copy of the model on its own part of the batches
+of each train file, and the gradients of all workers are averaged with
+a ring allreduce over tcp sockets before they are applied. The workers
+can be on one or on several nodes.
+
+The workers are started with the launcher, e.g. for 4 workers on this node::
+
+    orcalaunch -n 4 train.py
+
+which runs the script train.py 4 times, and sets the environment variables
+with the rank of each worker, the number of workers and the address
+to meet at. Organizer.train_and_validate will then train distributed.
+Only the worker with rank 0 writes the logs, saves the models and
+validates. With several nodes, the launcher has to be started on every node
+with the same master address, and the output folder has to be on a
+filesystem shared by all nodes.
+
+"""
+import argparse
+import os
+import socket
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import tensorflow as tf
+
+# the environment variables set by the launcher
+ENV_RANK = "ORCANET_RANK"
+ENV_WORLD_SIZE = "ORCANET_WORLD_SIZE"
+ENV_MASTER_ADDR = "ORCANET_MASTER_ADDR"
+ENV_MASTER_PORT = "ORCANET_MASTER_PORT"
+DEFAULT_PORT = 29500
+
+
+class Communicator:
+    """
+    Exchange arrays between the worker processes.
+
+    The workers are connected in a ring: every worker sends to the worker
+    with the next rank, and receives from the one with the previous rank.
+    To set up the ring, all workers first connect to the worker with
+    rank 0 at the master address, which hands out the addresses of
+    everyone.
+
+    Attributes
+    ----------
+    rank : int
+        The rank of this worker, from 0 to world_size - 1.
+    world_size : int
+        The total number of workers.
+
+    """
+    def __init__(self, rank, world_size, master_addr="127.0.0.1",
+                 master_port=DEFAULT_PORT, timeout=600):
+        """
+        Connect to the other workers. Blocks until all of them are there.
+
+        Parameters
+        ----------
+        rank : int
+            The rank of this worker, from 0 to world_size - 1.
+        world_size : int
+            The total number of workers.
+        master_addr : str
+            Address of the worker with rank 0.
+        master_port : int
+            Port on which the worker with rank 0 waits for the others.
+        timeout : float
+            Seconds to wait for the other workers to connect.
+
+        """
+        if not 0 <= rank < world_size:
+            raise ValueError("Invalid rank {} for {} workers".format(
+                rank, world_size))
+        self.rank = rank
+        self.world_size = world_size
+        self._next = None
+        self._prev = None
+        self._sender = None
+        if world_size > 1:
+            self._connect(master_addr, int(master_port), timeout)
+            self._sender = ThreadPoolExecutor(max_workers=1)
+
+    def _connect(self, master_addr, master_port, timeout):
+        """ Meet at the master address and connect to the neighbours. """
+        listener = socket.create_server(("", 0))
+        listener.settimeout(timeout)
+        port = listener.getsockname()[1]
+        try:
+            if self.rank == 0:
+                addresses = self._gather_addresses(
+                    master_addr, master_port, port, timeout)
+            else:
+                addresses = self._send_address(
+                    master_addr, master_port, port, timeout)
+
+            next_host, next_port = addresses[(self.rank + 1) % self.world_size]
+            self._next = socket.create_connection(
+                (next_host, next_port), timeout=timeout)
+            _send_message(self._next, str(self.rank))
+            self._prev, _ = listener.accept()
+            self._prev.settimeout(None)
+            prev_rank = int(_recv_message(self._prev))
+            if prev_rank != (self.rank - 1) % self.world_size:
+                raise ConnectionError(
+                    "Worker {} was connected to worker {} instead of its "
+                    "predecessor".format(self.rank, prev_rank))
+            self._next.settimeout(None)
+            for sock in (self._next, self._prev):
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        finally:
+            listener.close()
+
+    def _gather_addresses(self, master_addr, master_port, port, timeout):
+        """ Rank 0: Get the addresses of all workers, and send them out. """
+        addresses = {0: (master_addr, port)}
+        connections = []
+        with socket.create_server(("", master_port)) as server:
+            server.settimeout(timeout)
+            try:
+                while len(addresses) < self.world_size:
+                    conn, _ = server.accept()
+                    conn.settimeout(timeout)
+                    connections.append(conn)
+                    rank, host, rank_port = \
+                        _recv_message(conn).split(" ")
+                    addresses[int(rank)] = (host, int(rank_port))
+                message = " ".join("{}:{}".format(*addresses[rank])
+                                   for rank in range(self.world_size))
+                for conn in connections:
+                    _send_message(conn, message)
+            finally:
+                for conn in connections:
+                    conn.close()
+        return addresses
+
+    def _send_address(self, master_addr, master_port, port, timeout):
+        """ Other ranks: Tell rank 0 where to find this worker. """
+        start_time = time.time()
+        while True:
+            try:
+                conn = socket.create_connection(
+                    (master_addr, master_port), timeout=timeout)
+                break
+            except OSError:
+                # rank 0 might not be there yet
+                if time.time() - start_time > timeout:
+                    raise
+                time.sleep(0.1)
+        with conn:
+            # the address of this node, as seen from the master
+            host = conn.getsockname()[0]
+            _send_message(conn, "{} {} {}".format(self.rank, host, port))
+            addresses = {}
+            for rank, address in enumerate(_recv_message(conn).split(" ")):
+                host, rank_port = address.rsplit(":", 1)
+                addresses[rank] = (host, int(rank_port))
+        return addresses
+
+    def allreduce(self, array, average=True):
+        """
+        Sum up (or average) an array over all workers.
+
+        Parameters
+        ----------
+        array : ndarray
+            The array of this worker. Must have the same shape and dtype
+            for every worker.
+        average : bool
+            If True, return the mean instead of the sum.
+
+        Returns
+        -------
+        result : ndarray
+            The reduced array, the same in every worker.
+
+        """
+        array = np.asarray(array)
+        result = np.array(array, copy=True).ravel()
+        n = self.world_size
+        if n > 1:
+            bounds = np.linspace(0, len(result), n + 1).astype(int)
+            chunks = [result[bounds[i]:bounds[i + 1]] for i in range(n)]
+            received = np.empty(np.max(np.diff(bounds)), dtype=result.dtype)
+            # reduce-scatter: afterwards, each worker has the sum of
+            # the chunk (rank + 1) % n
+            for step in range(n - 1):
+                send_chunk = chunks[(self.rank - step) % n]
+                recv_chunk = chunks[(self.rank - step - 1) % n]
+                buffer = received[:len(recv_chunk)]
+                self._exchange(send_chunk, buffer)
+                recv_chunk += buffer
+            # all-gather: pass the summed chunks around the ring
+            for step in range(n - 1):
+                self._exchange(chunks[(self.rank - step + 1) % n],
+                               chunks[(self.rank - step) % n])
+        if average:
+            result = result / n
+        return result.reshape(array.shape)
+
+    def broadcast(self, array, root=0):
+        """
+        Send an array from one worker to all others.
+
+        Parameters
+        ----------
+        array : ndarray
+            The array to send on the root worker, and an array of the same
+            shape and dtype on the others, which is overwritten.
+        root : int
+            Rank of the worker to send from.
+
+        Returns
+        -------
+        array : ndarray
+            The array of the root worker.
+
+        """
+        shape = np.shape(array)
+        array = np.ascontiguousarray(array)
+        if self.world_size > 1:
+            if self.rank != root:
+                _recv_into(self._prev, array)
+            if (self.rank + 1) % self.world_size != root:
+                self._next.sendall(memoryview(array).cast("B"))
+        return array.reshape(shape)
+
+    def barrier(self):
+        """ Wait until all workers have arrived here. """
+        self.allreduce(np.zeros(1), average=False)
+
+    def _exchange(self, send, recv):
+        """ Send an array to the next worker while receiving from the
+        previous one. """
+        future = self._sender.submit(
+            self._next.sendall, memoryview(send).cast("B"))
+        _recv_into(self._prev, recv)
+        future.result()
+
+    def close(self):
+        """ Close the connections to the other workers. """
+        if self._sender is not None:
+            self._sender.shutdown()
+            self._sender = None
+        for sock in (self._next, self._prev):
+            if sock is not None:
+                sock.close()
+        self._next, self._prev = None, None
+
+
+def _send_message(sock, message):
+    """ Send a short string with its length in front. """
+    data = message.encode()
+    sock.sendall(len(data).to_bytes(4, "big") + data)
+
+
+def _recv_message(sock):
+    """ Receive a string sent with _send_message. """
+    length = bytearray(4)
+    _recv_into(sock, length)
+    data = bytearray(int.from_bytes(length, "big"))
+    _recv_into(sock, data)
+    return data.decode()
+
+
+def _recv_into(sock, buffer):
+    """ Fill the buffer with data from the socket. """
+    view = memoryview(buffer).cast("B")
+    while len(view) > 0:
+        n_bytes = sock.recv_into(view)
+        if n_bytes == 0:
+            raise ConnectionError("Connection to other worker was lost")
+        view = view[n_bytes:]
+
+
+def get_communicator():
+    """
+    Connect to the other workers, if this process was started by the launcher.
+
+    Returns
+    -------
+    Communicator or None
+        None if the environment variables of the launcher are not set.
+
+    """
+    if ENV_RANK not in os.environ:
+        return None
+    return Communicator(
+        rank=int(os.environ[ENV_RANK]),
+        world_size=int(os.environ[ENV_WORLD_SIZE]),
+        master_addr=os.environ.get(ENV_MASTER_ADDR, "127.0.0.1"),
+        master_port=int(os.environ.get(ENV_MASTER_PORT, DEFAULT_PORT)),
+    )
+
+
+class DistributedTrainStep:
+    """
+    Train a keras model on one batch, with the gradients averaged over
+    all workers.
+
+    The loss and the metrics are averaged over the workers as well, in the
+    same allreduce as the gradients. The non-trainable weights, e.g. the
+    moving statistics of BatchNormalization, have to be synced with
+    sync_non_trainable. Requires tensorflow 2.
+
+    """
+    def __init__(self, model, comm):
+        """
+        Parameters
+        ----------
+        model : ks.Model
+            A compiled keras model.
+        comm : Communicator
+            For exchanging the gradients with the other workers.
+
+        """
+        self.model = model
+        self.comm = comm
+        self._variables = model.trainable_variables
+        self._shapes = [v.shape for v in self._variables]
+        self._sizes = [int(np.prod(shape)) for shape in self._shapes]
+        self._metric_names = None
+        self._compute = tf.function(self._compute_gradients)
+        self._apply = tf.function(self._apply_gradients)
+
+    def sync_weights(self, root=0):
+        """ Set the weights and the optimizer state of every worker to
+        the ones of the root worker. """
+        self.model.optimizer.build(self._variables)
+        for variable in self.model.weights + self.model.optimizer.variables:
+            variable.assign(self.comm.broadcast(variable.numpy(), root=root))
+
+    def sync_non_trainable(self, root=0):
+        """
+        Make the non-trainable weights the same in every worker.
+
+        They are not updated with the averaged gradients, so e.g. the
+        moving mean and variance of BatchNormalization drift apart, since
+        every worker sees different batches. The floating point ones are
+        averaged over the workers, the others are taken from the root worker.
+
+        """
+        floats, others = [], []
+        for variable in self.model.non_trainable_variables:
+            if variable.dtype.is_floating:
+                floats.append(variable)
+            else:
+                others.append(variable)
+        if floats:
+            values = self.comm.allreduce(np.concatenate(
+                [np.ravel(v.numpy()).astype("float64") for v in floats]))
+            bounds = np.cumsum([0] + [int(np.prod(v.shape)) for v in floats])
+            for variable, start, stop in zip(floats, bounds, bounds[1:]):
+                variable.assign(values[start:stop].reshape(
+                    variable.shape).astype(variable.dtype.as_numpy_dtype))
+        for variable in others:
+            variable.assign(self.comm.broadcast(variable.numpy(), root=root))
+
+    def __call__(self, xs, ys):
+        """
+        Train on one batch.
+
+        Returns
+        -------
+        logs : dict
+            The loss and the metrics, averaged over all batches seen since
+            model.reset_metrics was called, and over all workers.
+
+        """
+        flat_grads, metrics = self._compute(xs, ys)
+        if self._metric_names is None:
+            self._metric_names = sorted(metrics.keys())
+        values = np.concatenate([
+            flat_grads.numpy(),
+            [metrics[name].numpy() for name in self._metric_names],
+        ]).astype("float32")
+        values = self.comm.allreduce(values)
+        n_grads = len(values) - len(self._metric_names)
+        self._apply(values[:n_grads])
+        return {name: float(value) for name, value in zip(
+            self._metric_names, values[n_grads:])}
+
+    def _compute_gradients(self, xs, ys):
+        """ Get the flattened gradients and the metrics of this worker. """
+        with tf.GradientTape() as tape:
+            y_pred = self.model(xs, training=True)
+            loss = self.model.compute_loss(xs, ys, y_pred)
+        grads = tape.gradient(loss, self._variables)
+        metrics = self.model.compute_metrics(xs, ys, y_pred, None)
+        flat_grads = tf.concat([
+            tf.zeros(size) if grad is None else tf.reshape(
+                tf.cast(tf.convert_to_tensor(grad), tf.float32), [-1])
+            for grad, size in zip(grads, self._sizes)], axis=0)
+        return flat_grads, metrics
+
+    def _apply_gradients(self, flat_grads):
+        """ Apply the averaged, flattened gradients. """
+        grads = [
+            tf.cast(tf.reshape(grad, shape), variable.dtype)
+            for grad, shape, variable in zip(
+                tf.split(flat_grads, self._sizes), self._shapes,
+                self._variables)]
+        self.model.optimizer.apply_gradients(zip(grads, self._variables))
+
+
+def get_shard(f_size, batchsize, comm):
+    """
+    Get the part of a file that a worker trains on.
+
+    Every worker gets the same number of whole batches.
+
+    Parameters
+    ----------
+    f_size : int
+        Number of samples in the file.
+    batchsize : int
+        Batchsize of every worker.
+    comm : Communicator
+        For getting the rank and the number of workers.
+
+    Returns
+    -------
+    f_offset : int
+        The first sample of the part.
+    shard_size : int
+        Number of samples in the part.
+
+    """
+    steps = int(f_size / batchsize) // comm.world_size
+    if steps == 0:
+        raise ValueError(
+            "Can not split {} samples into batches of size {} for {} "
+            "workers".format(f_size, batchsize, comm.world_size))
+    shard_size = steps * batchsize
+    return comm.rank * shard_size, shard_size
+
+
+def launch(command, n_processes, n_nodes=1, node_rank=0,
+           master_addr="127.0.0.1", master_port=DEFAULT_PORT,
+           assign_gpus=False):
+    """
+    Run a command in several worker processes on this node.
+
+    Every worker gets the environment variables for get_communicator.
+    If one of the workers fails, the others are terminated.
+
+    Parameters
+    ----------
+    command : List
+        The command to run, e.g. [sys.executable, "train.py"].
+    n_processes : int
+        Number of workers to start on this node.
+    n_nodes : int
+        Total number of nodes. On each node, the launcher has to be run
+        with the same n_processes.
+    node_rank : int
+        Number of this node, from 0 to n_nodes - 1. The worker with rank 0
+        is on the node with node_rank 0.
+    master_addr : str
+        Address of the node with node_rank 0, as seen from the other nodes.
+    master_port : int
+        Free port on that node.
+    assign_gpus : bool
+        If True, every worker only sees the gpu with the number of
+        its local rank.
+
+    Returns
+    -------
+    returncode : int
+        0 if all workers finished successfully, otherwise the return
+        code of the first failed one.
+
+    """
+    processes = []
+    for local_rank in range(n_processes):
+        env = dict(os.environ)
+        env[ENV_RANK] = str(node_rank * n_processes + local_rank)
+        env[ENV_WORLD_SIZE] = str(n_nodes * n_processes)
+        env[ENV_MASTER_ADDR] = master_addr
+        env[ENV_MASTER_PORT] = str(master_port)
+        if assign_gpus:
+            env["CUDA_VISIBLE_DEVICES"] = str(local_rank)
+        processes.append(subprocess.Popen(command, env=env))
+
+    returncode = 0
+    try:
+        running = list(processes)
+        while running:
+            for process in list(running):
+                if process.poll() is None:
+                    continue
+                running.remove(process)
+                if process.returncode != 0 and returncode == 0:
+                    returncode = process.returncode
+                    for other in running:
+                        other.terminate()
+            time.sleep(0.1)
+    finally:
+        for process in processes:
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+    return returncode
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run a python script in several worker processes "
+                    "for data-parallel training with OrcaNet.")
+    parser.add_argument("-n", "--n_processes", type=int, default=1,
+                        help="Number of workers on this node.")
+    parser.add_argument("--n_nodes", type=int, default=1,
+                        help="Total number of nodes.")
+    parser.add_argument("--node_rank", type=int, default=0,
+                        help="Number of this node, starting at 0.")
+    parser.add_argument("--master_addr", default="127.0.0.1",
+                        help="Address of the node with node_rank 0.")
+    parser.add_argument("--master_port", type=int, default=DEFAULT_PORT,
+                        help="Free port on the node with node_rank 0.")
+    parser.add_argument("--assign_gpus", action="store_true",
+                        help="Give every worker its own gpu.")
+    parser.add_argument("script", help="The python script to run.")
+    parser.add_argument("script_args", nargs=argparse.REMAINDER,
+                        help="Arguments for the script.")
+    args = parser.parse_args()
+    sys.exit(launch(
+        [sys.executable, args.script] + args.script_args,
+        n_processes=args.n_processes,
+        n_nodes=args.n_nodes,
+        node_rank=args.node_rank,
+        master_addr=args.master_addr,
+        master_port=args.master_port,
+        assign_gpus=args.assign_gpus,
+    ))
+
+
+if __name__ == "__main__":
+    main()
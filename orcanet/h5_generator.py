@@ -1,3 +1,11 @@
+import os
+import collections
+import multiprocessing
+import queue
+import threading
+import traceback
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import h5py
 import numpy as np
 import keras as ks
@@ -8,12 +16,20 @@ class Hdf5BatchGenerator(ks.utils.Sequence):
                  batchsize=64,
                  key_x_values="x",
                  key_y_values="y",
+                 y_field_names=None,
                  sample_modifier=None,
                  label_modifier=None,
                  xs_mean=None,
+                 xs_std=None,
+                 x_dtype="float32",
+                 n_buffers=None,
                  f_size=None,
+                 f_offset=0,
                  keras_mode=True,
-                 shuffle=False):
+                 shuffle=False,
+                 prefetch_batches=0,
+                 chunk_buffer=16,
+                 use_memmap=False):
         """
         Yields batches of input data from h5 files.
 
@@ -37,52 +53,140 @@ class Hdf5BatchGenerator(ks.utils.Sequence):
             The name of the datagroup in the h5 input files which contains
             the info for the labels. If this name is not in the file,
             y_values will be set to None.
+        y_field_names : List or None
+            If given, only these fields of the y_values are read from the
+            files, e.g. the ones needed by the label modifier.
+            The y_values are read completely if they are not a structured
+            array, or if one of these fields is not in it.
         sample_modifier : function or None
             Operation to be performed on batches of samples read from the input
             files before they are fed into the model.
         label_modifier : function or None
             Operation to be performed on batches of labels read from the input files
             before they are fed into the model.
-        xs_mean : ndarray or None
+        xs_mean : dict or None
             Zero center image to be subtracted from data as preprocessing.
+        xs_std : dict or None
+            If given, the zero centered data is also divided by this
+            standard deviation.
+        x_dtype : str
+            Only for zero centering: The dtype of the zero centered data,
+            e.g. float32 or float16.
+        n_buffers : int or None
+            Only for zero centering: The zero centered data is written into
+            this many preallocated buffers in turns. Batches are therefore
+            overwritten after this many further batches have been read,
+            so only use this if the batches are consumed synchronously!
+            None (default) for using a new array for every batch.
         f_size : int or None
             Specifies the number of samples to be read from the .h5 file.
             If none, the whole .h5 file will be used.
+        f_offset : int
+            Index of the first sample that will be read from the .h5 file.
         keras_mode : bool
             If true, yield xs and ys (samples and labels) for the keras fit
             generator function.
             If false, yield the info_blob containing the full sample and label
             info, both before and after the modifiers have been applied.
-        shuffle : bool
+        shuffle : bool or str
             Randomize the order in which batches are read from the file
             (once during init). Can reduce read out speed.
+            If "chunks", shuffle the samples themselves instead, in a way
+            that respects the chunk layout of the files: The order of the
+            chunks is randomized, and the samples of chunk_buffer chunks
+            at a time are shuffled in memory. Each chunk is read only once.
+        prefetch_batches : int
+            If > 0, this many of the following batches will be read and
+            modified in background threads while the current one is in use.
+            Only helps if batches are requested in ascending order.
+        chunk_buffer : int
+            Only for shuffle="chunks": How many chunks are shuffled together.
+            Up to twice as many chunks per dataset are held in memory.
+        use_memmap : bool
+            If true, datasets that are stored contiguously and uncompressed
+            are read through a numpy memmap of the file instead of h5py.
+            The batches are then copy-on-write views into the memmap,
+            which keep the file mapped as long as they exist.
 
         """
         self.files_dict = files_dict
         self.batchsize = batchsize
         self.key_x_values = key_x_values
         self.key_y_values = key_y_values
+        self.y_field_names = y_field_names
         self.sample_modifier = sample_modifier
         self.label_modifier = label_modifier
         self.xs_mean = xs_mean
+        self.xs_std = xs_std
+        self.x_dtype = x_dtype
+        self.n_buffers = n_buffers
         self.f_size = f_size
+        self.f_offset = f_offset
         self.keras_mode = keras_mode
         self.shuffle = shuffle
+        self.prefetch_batches = prefetch_batches
+        self.chunk_buffer = chunk_buffer
+        self.use_memmap = use_memmap
 
         # a dict with the names of list inputs as keys, and the opened
         # h5 files as values
         self._files = {}
-        # start index of each batch in the file
+        # start index of each batch in the file, or, when shuffling
+        # chunk-wise, the indices of all samples of each batch
         self._sample_pos = None
         # total number of samples per file
         self._total_f_size = None
+        # thread pool and pending batches for prefetching
+        self._executor = None
+        self._prefetched = {}
+        self._prefetch_lock = threading.Lock()
+        # for chunk-wise shuffling: recently read chunks of each dataset
+        self._chunk_caches = {}
+        self._cache_lock = threading.Lock()
+        # memmaps of the contiguous datasets (None if not possible)
+        self._memmaps = {}
+        # for zero centering: xs_mean and 1/xs_std in x_dtype, the output
+        # buffers, and the next buffer to use for each input
+        self._zero_center_arrays = {}
+        self._buffers = {}
+        self._buffer_pos = {}
+        self._buffer_lock = threading.Lock()
 
         self.open()
 
+    def __getstate__(self):
+        """
+        For pickling, e.g. to send the generator to other processes.
+
+        The files are not opened in the copy, and nothing is cached.
+
+        """
+        state = self.__dict__.copy()
+        for key in ("_prefetch_lock", "_cache_lock", "_buffer_lock"):
+            del state[key]
+        state.update({
+            "_files": {}, "_executor": None, "_prefetched": {},
+            "_chunk_caches": {}, "_memmaps": {}, "_zero_center_arrays": {},
+            "_buffers": {}, "_buffer_pos": {},
+        })
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._prefetch_lock = threading.Lock()
+        self._cache_lock = threading.Lock()
+        self._buffer_lock = threading.Lock()
+
     def __len__(self):
         """ Number of batches in the Sequence (includes queue). """
         return len(self._sample_pos)
 
+    @property
+    def n_ready(self):
+        """ Number of prefetched batches that are ready. """
+        return sum([future.done()
+                    for future in list(self._prefetched.values())])
+
     def __getitem__(self, index):
         """
         Gets batch number `index`.
@@ -109,29 +213,45 @@ class Hdf5BatchGenerator(ks.utils.Sequence):
             Blob containing, the x_values, y_values, xs and ys.
 
         """
+        if self.prefetch_batches > 0:
+            return self._get_prefetched(index)
+        return self._get_batch(index)
+
+    def _get_batch(self, index):
+        """ Read batch number `index` and apply the modifiers. """
         file_index = self._sample_pos[index]
         info_blob = dict()
         info_blob["x_values"] = self.get_x_values(file_index)
         info_blob["y_values"] = self.get_y_values(file_index)
+        return modify_blob(info_blob, self.sample_modifier,
+                           self.label_modifier, self.keras_mode)
 
-        # Modify the samples
-        if self.sample_modifier is not None:
-            xs = self.sample_modifier(info_blob)
-        else:
-            xs = info_blob["x_values"]
-        info_blob["xs"] = xs
+    def _get_prefetched(self, index):
+        """
+        Get batch number `index` from the prefetched batches (or read it now
+        if it has not been prefetched), and start reading the following ones.
 
-        # Modify the labels
-        if info_blob["y_values"] is not None and self.label_modifier is not None:
-            ys = self.label_modifier(info_blob)
-        else:
-            ys = None
-        info_blob["ys"] = ys
+        """
+        with self._prefetch_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=min(self.prefetch_batches, os.cpu_count() or 1))
 
-        if self.keras_mode:
-            return xs, ys
-        else:
-            return info_blob
+            future = self._prefetched.pop(index, None)
+            if future is None:
+                future = self._executor.submit(self._get_batch, index)
+
+            ahead = range(index + 1,
+                          min(index + 1 + self.prefetch_batches, len(self)))
+            # discard batches that are not ahead anymore, e.g. after a jump
+            for stale_index in set(self._prefetched) - set(ahead):
+                self._prefetched.pop(stale_index).cancel()
+            for next_index in ahead:
+                if next_index not in self._prefetched:
+                    self._prefetched[next_index] = self._executor.submit(
+                        self._get_batch, next_index)
+
+        return future.result()
 
     def open(self):
         """ Open all files and prepare for read out. """
@@ -142,6 +262,15 @@ class Hdf5BatchGenerator(ks.utils.Sequence):
 
     def close(self):
         """ Close all files again. """
+        with self._prefetch_lock:
+            for future in self._prefetched.values():
+                future.cancel()
+            self._prefetched = {}
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+                self._executor = None
+        self._chunk_caches = {}
+        self._memmaps = {}
         for f in list(self._files.values()):
             f.close()
 
@@ -151,9 +280,10 @@ class Hdf5BatchGenerator(ks.utils.Sequence):
 
         Parameters
         ----------
-        start_index : int
+        start_index : int or ndarray
             The start index in the h5 files at which the batch will be read.
             The end index will be the start index + the batch size.
+            Can also be the indices of all samples in the batch.
 
         Returns
         -------
@@ -162,14 +292,57 @@ class Hdf5BatchGenerator(ks.utils.Sequence):
 
         """
         x_values = {}
-        for input_key, file in self._files.items():
-            x_values[input_key] = file[self.key_x_values][
-                                  start_index: start_index + self._batchsize]
+        for input_key in self._files:
+            x_values[input_key] = self._read(
+                input_key, self.key_x_values, start_index)
             if self.xs_mean is not None:
-                x_values[input_key] = np.subtract(x_values[input_key],
-                                                  self.xs_mean[input_key])
+                x_values[input_key] = self._zero_center(
+                    input_key, x_values[input_key])
         return x_values
 
+    def _zero_center(self, input_key, x_values):
+        """
+        Subtract xs_mean (and divide by xs_std) in one of the buffers.
+
+        """
+        xs_mean, xs_inv_std = self._get_zero_center_arrays(input_key)
+        out = self._get_buffer(input_key, x_values.shape)
+        np.subtract(x_values, xs_mean, out=out)
+        if xs_inv_std is not None:
+            np.multiply(out, xs_inv_std, out=out)
+        return out
+
+    def _get_zero_center_arrays(self, input_key):
+        """ Get xs_mean and 1/xs_std of an input in the x_dtype. """
+        if input_key not in self._zero_center_arrays:
+            xs_mean = np.asarray(self.xs_mean[input_key], dtype=self.x_dtype)
+            if self.xs_std is None:
+                xs_inv_std = None
+            else:
+                xs_std = np.asarray(self.xs_std[input_key], dtype="float64")
+                # bins without any variation are only zero centered
+                xs_inv_std = np.ones_like(xs_std)
+                np.divide(1, xs_std, out=xs_inv_std, where=xs_std > 0)
+                xs_inv_std = xs_inv_std.astype(self.x_dtype)
+            self._zero_center_arrays[input_key] = (xs_mean, xs_inv_std)
+        return self._zero_center_arrays[input_key]
+
+    def _get_buffer(self, input_key, shape):
+        """ Get the next output buffer for zero centering. """
+        if self.n_buffers is None:
+            return np.empty(shape, dtype=self.x_dtype)
+        with self._buffer_lock:
+            if input_key not in self._buffers:
+                self._buffers[input_key] = [
+                    np.empty((self._batchsize, ) + shape[1:],
+                             dtype=self.x_dtype)
+                    for i in range(self.n_buffers)]
+                self._buffer_pos[input_key] = 0
+            buffer = self._buffers[input_key][self._buffer_pos[input_key]]
+            self._buffer_pos[input_key] = \
+                (self._buffer_pos[input_key] + 1) % self.n_buffers
+        return buffer[:shape[0]]
+
     def get_y_values(self, start_index):
         """
         Get y_values for the nn. Since the y_values are hopefully the same
@@ -177,9 +350,10 @@ class Hdf5BatchGenerator(ks.utils.Sequence):
 
         Parameters
         ----------
-        start_index : int
+        start_index : int or ndarray
             The start index in the h5 files at which the batch will be read.
             The end index will be the start index + the batch size.
+            Can also be the indices of all samples in the batch.
 
         Returns
         -------
@@ -187,21 +361,112 @@ class Hdf5BatchGenerator(ks.utils.Sequence):
             The y_values, right from the files.
 
         """
-        first_file = list(self._files.values())[0]
+        first_input = list(self._files.keys())[0]
         try:
-            y_values = first_file[self.key_y_values][
-                       start_index:start_index + self._batchsize]
+            y_values = self._read(first_input, self.key_y_values, start_index,
+                                  fields=self._get_y_fields(first_input))
         except KeyError:
             # can not look up y_values, lets hope we dont need them
             y_values = None
         return y_values
 
+    def _get_y_fields(self, input_key):
+        """ The fields of the y dataset to read, or None for all. """
+        if self.y_field_names is None or \
+                self.key_y_values not in self._files[input_key]:
+            return None
+        names = self._files[input_key][self.key_y_values].dtype.names
+        if names is None or not set(self.y_field_names).issubset(names):
+            return None
+        # keep the order of the fields in the file
+        return [name for name in names if name in self.y_field_names]
+
+    def _read(self, input_key, dataset_key, start_index, fields=None):
+        """
+        Read one batch from a dataset in the file of the given input.
+
+        Parameters
+        ----------
+        input_key : str
+            The name of the input whose file will be read.
+        dataset_key : str
+            The name of the dataset in the file.
+        start_index : int or ndarray
+            Start index of the batch, or the indices of all its samples.
+        fields : List or None
+            Only read these fields of a structured dataset.
+
+        Returns
+        -------
+        ndarray
+            The data of the batch.
+
+        """
+        memmap = self._get_memmap(input_key, dataset_key)
+        if memmap is not None and fields is not None:
+            # a view with only the fields, so nothing else is copied
+            memmap = memmap[fields]
+        if isinstance(start_index, np.ndarray):
+            if memmap is not None:
+                return memmap[start_index]
+            return self._get_chunk_cache(input_key, dataset_key, fields).read(
+                start_index)
+        stop = min(start_index + self._batchsize, self.f_offset + self._size)
+        if memmap is not None:
+            return memmap[start_index: stop]
+        dataset = self._files[input_key][dataset_key]
+        if fields is not None:
+            dataset = dataset.fields(fields)
+        return dataset[start_index: stop]
+
+    def _get_memmap(self, input_key, dataset_key):
+        """
+        Get the memmap of a dataset, or None if it can not be memory mapped
+        or use_memmap is False.
+
+        """
+        if not self.use_memmap:
+            return None
+        with self._cache_lock:
+            cache_key = (input_key, dataset_key)
+            if cache_key not in self._memmaps:
+                self._memmaps[cache_key] = get_memmap(
+                    self._files[input_key][dataset_key])
+            return self._memmaps[cache_key]
+
+    def _get_chunk_cache(self, input_key, dataset_key, fields=None):
+        """ Get the cache of recently read chunks of a dataset. """
+        with self._cache_lock:
+            cache_key = (input_key, dataset_key)
+            if cache_key not in self._chunk_caches:
+                self._chunk_caches[cache_key] = ChunkCache(
+                    self._files[input_key][dataset_key],
+                    buffer_rows=2 * self.chunk_buffer * self._get_chunk_rows(),
+                    fields=fields,
+                )
+            return self._chunk_caches[cache_key]
+
+    def _get_chunk_rows(self):
+        """
+        The number of samples in one shuffling unit for chunk-wise shuffling.
+
+        This is the largest number of rows in a chunk of the x datasets
+        in all the files (or the batchsize if none of them are chunked).
+
+        """
+        chunk_rows = [get_chunk_rows(f[self.key_x_values])
+                      for f in self._files.values()]
+        chunk_rows = [rows for rows in chunk_rows if rows is not None]
+        if len(chunk_rows) == 0:
+            return self._batchsize
+        return max(chunk_rows)
+
     @property
     def _size(self):
         """ Size of the files that will be read in. Can be smaller than the actual
         file size if defined by user. """
         if self.f_size is None:
-            return self._total_f_size
+            return self._total_f_size - self.f_offset
         else:
             return self.f_size
 
@@ -235,18 +500,733 @@ class Hdf5BatchGenerator(ks.utils.Sequence):
         """
         Define the start indices of each batch in the h5 file and store this.
         """
+        if self.shuffle == "chunks":
+            self._sample_pos = self._get_chunk_shuffled_indices()
+            return
+
         total_no_of_batches = int(
             np.ceil(self._size / self._batchsize))  # w/o queue
-        sample_pos = np.arange(total_no_of_batches) * self._batchsize
+        sample_pos = np.arange(total_no_of_batches) * self._batchsize + \
+            self.f_offset
 
         if self.shuffle:
             np.random.shuffle(sample_pos)
 
         self._sample_pos = sample_pos
 
+    def _get_chunk_shuffled_indices(self):
+        """
+        Get the indices of the samples of each batch for chunk-wise shuffling.
+
+        The samples are divided into units of whole chunks. The order of the
+        units is randomized, and then the samples in every group of
+        chunk_buffer consecutive units are shuffled.
+
+        Returns
+        -------
+        batch_indices : List
+            For every batch, an ndarray with the indices of its samples.
+
+        """
+        chunk_rows = self._get_chunk_rows()
+        stop = self.f_offset + self._size
+        # units are aligned to the chunks in the file
+        unit_order = np.random.permutation(np.arange(
+            self.f_offset // chunk_rows, int(np.ceil(stop / chunk_rows))))
+
+        sample_order = []
+        for group_start in range(0, len(unit_order), self.chunk_buffer):
+            group = unit_order[group_start: group_start + self.chunk_buffer]
+            group_indices = np.concatenate([
+                np.arange(max(unit * chunk_rows, self.f_offset),
+                          min((unit + 1) * chunk_rows, stop))
+                for unit in group])
+            np.random.shuffle(group_indices)
+            sample_order.append(group_indices)
+        sample_order = np.concatenate(sample_order)
+
+        batch_indices = [
+            sample_order[start: start + self._batchsize]
+            for start in range(0, self._size, self._batchsize)]
+        return batch_indices
+
+
+class ShuffleBuffer:
+    """
+    Mix the samples of several Hdf5BatchGenerators in a shuffle buffer.
+
+    Batches are drawn from all the generators at once, in random order.
+    Their samples are stored in a buffer of limited size, from which
+    random samples are taken to form new batches. This way, the batches
+    contain samples from all files.
+
+    """
+    def __init__(self, generators,
+                 batchsize=64,
+                 sample_modifier=None,
+                 label_modifier=None,
+                 buffer_memory=2e9,
+                 keras_mode=True):
+        """
+        Parameters
+        ----------
+        generators : List
+            Hdf5BatchGenerators that read out the samples. They need to be in
+            keras_mode=False, and should have no modifiers.
+        batchsize : int
+            Batchsize of the batches produced from the buffer.
+        sample_modifier : function or None
+            Operation to be performed on the mixed batches of samples before
+            they are fed into the model.
+        label_modifier : function or None
+            Operation to be performed on the mixed batches of labels before
+            they are fed into the model.
+        buffer_memory : float
+            Maximum size of the buffer in bytes. It will store at least
+            one batch of samples, though.
+        keras_mode : bool
+            If true, yield xs and ys (samples and labels) for the keras fit
+            generator function. If false, yield the info_blob instead.
+
+        """
+        self.generators = generators
+        self.batchsize = batchsize
+        self.sample_modifier = sample_modifier
+        self.label_modifier = label_modifier
+        self.buffer_memory = buffer_memory
+        self.keras_mode = keras_mode
+
+        # number of samples in each of the generators
+        self._sizes = [generator._size for generator in generators]
+        # next batch no to read from each generator
+        self._next_batch = [0] * len(generators)
+        # samples read out from the generators, but not yet in the buffer
+        self._pending = []
+
+        self._x_buffer = None
+        self._y_buffer = None
+        self._n_filled = 0
+
+    @property
+    def n_samples(self):
+        """ The total number of samples in all generators. """
+        return sum(self._sizes)
+
+    def __len__(self):
+        """ Number of batches that will be produced. """
+        return int(np.ceil(self.n_samples / self.batchsize))
+
+    def __iter__(self):
+        """
+        Yield mixed batches until all samples have been used once.
+
+        Yields
+        ------
+        xs, ys or info_blob
+            Like Hdf5BatchGenerator.
+
+        """
+        self._fill()
+        while self._n_filled > 0:
+            n_samples = min(self.batchsize, self._n_filled)
+            slots = np.random.choice(self._n_filled, n_samples, replace=False)
+            info_blob = {
+                "x_values": {key: buffer[slots]
+                             for key, buffer in self._x_buffer.items()},
+                "y_values": (None if self._y_buffer is None
+                             else self._y_buffer[slots]),
+            }
+            self._refill(slots)
+            yield modify_blob(info_blob, self.sample_modifier,
+                              self.label_modifier, self.keras_mode)
+
+    def close(self):
+        """ Close all generators. """
+        for generator in self.generators:
+            generator.close()
+
+    def _fill(self):
+        """ Fill the buffer with samples until it is full. """
+        x_values, y_values = self._take(self.batchsize)
+        if x_values is None:
+            return
+        self._make_buffer(x_values, y_values)
+        capacity = len(list(self._x_buffer.values())[0])
+        while x_values is not None:
+            self._put(np.arange(self._n_filled,
+                                self._n_filled + len(y_or_x(x_values, y_values))),
+                      x_values, y_values)
+            self._n_filled += len(y_or_x(x_values, y_values))
+            x_values, y_values = self._take(
+                min(self.batchsize, capacity - self._n_filled))
+
+    def _refill(self, slots):
+        """ Replace the samples in the given slots with new ones. """
+        x_values, y_values = self._take(len(slots))
+        if x_values is None:
+            n_new = 0
+        else:
+            n_new = len(y_or_x(x_values, y_values))
+            self._put(slots[:n_new], x_values, y_values)
+
+        # no more new samples: move samples from the end into the holes
+        holes = np.sort(slots[n_new:])
+        n_filled = self._n_filled - len(holes)
+        tail = np.setdiff1d(np.arange(n_filled, self._n_filled), holes)
+        holes = holes[holes < n_filled]
+        for buffer in self._buffers():
+            buffer[holes] = buffer[tail]
+        self._n_filled = n_filled
+
+    def _take(self, n_samples):
+        """
+        Get up to n_samples new samples from the generators.
+
+        Returns
+        -------
+        x_values : dict or None
+            The samples. None if the generators are all exhausted.
+        y_values : ndarray or None
+            The y_values.
+
+        """
+        pieces = []
+        n_taken = 0
+        while n_taken < n_samples:
+            if not self._pending:
+                info_blob = self._read_next()
+                if info_blob is None:
+                    break
+                self._pending = [info_blob["x_values"], info_blob["y_values"]]
+            x_values, y_values = self._pending
+            n = min(n_samples - n_taken, len(y_or_x(x_values, y_values)))
+            pieces.append((
+                {key: value[:n] for key, value in x_values.items()},
+                None if y_values is None else y_values[:n],
+            ))
+            if n == len(y_or_x(x_values, y_values)):
+                self._pending = []
+            else:
+                self._pending = [
+                    {key: value[n:] for key, value in x_values.items()},
+                    None if y_values is None else y_values[n:],
+                ]
+            n_taken += n
+
+        if n_taken == 0:
+            return None, None
+        x_values = {key: np.concatenate([piece[0][key] for piece in pieces])
+                    for key in pieces[0][0]}
+        if pieces[0][1] is None:
+            y_values = None
+        else:
+            y_values = np.concatenate([piece[1] for piece in pieces])
+        return x_values, y_values
+
+    def _read_next(self):
+        """
+        Read the next batch from a random generator, with a chance
+        proportional to the number of samples it has left.
+
+        """
+        remaining = np.array([
+            max(0, size - next_batch * generator._batchsize)
+            for size, next_batch, generator in zip(
+                self._sizes, self._next_batch, self.generators)],
+            dtype="float64")
+        if remaining.sum() == 0:
+            return None
+        gen_no = np.random.choice(len(self.generators),
+                                  p=remaining / remaining.sum())
+        info_blob = self.generators[gen_no][self._next_batch[gen_no]]
+        self._next_batch[gen_no] += 1
+        return info_blob
+
+    def _make_buffer(self, x_values, y_values):
+        """ Allocate the buffer, with a size depending on the sample size. """
+        sample_memory = sum(value[0].nbytes for value in x_values.values())
+        if y_values is not None:
+            sample_memory += y_values[0].nbytes
+        capacity = int(min(self.n_samples, max(
+            self.batchsize, self.buffer_memory / max(sample_memory, 1))))
+
+        self._x_buffer = {
+            key: np.empty((capacity,) + value.shape[1:], dtype=value.dtype)
+            for key, value in x_values.items()}
+        if y_values is not None:
+            self._y_buffer = np.empty(
+                (capacity,) + y_values.shape[1:], dtype=y_values.dtype)
+
+    def _put(self, slots, x_values, y_values):
+        """ Write samples into the given slots of the buffer. """
+        for key, buffer in self._x_buffer.items():
+            buffer[slots] = x_values[key]
+        if self._y_buffer is not None:
+            self._y_buffer[slots] = y_values
+
+    def _buffers(self):
+        """ All arrays of the buffer. """
+        buffers = list(self._x_buffer.values())
+        if self._y_buffer is not None:
+            buffers.append(self._y_buffer)
+        return buffers
+
+
+class ProcessLoader:
+    """
+    Read and modify the batches of a Hdf5BatchGenerator in worker processes.
+
+    Every worker opens the files itself, and writes the finished batches
+    into a ring of slots in shared memory, so they are not pickled.
+    The batches are copied out of the slots before they are yielded,
+    unless copy is False.
+
+    The workers are spawned instead of forked, since forking after
+    tensorflow has been used can make them hang. So the generator has to
+    be picklable, i.e. its modifiers have to be defined at the top level
+    of a module.
+
+    """
+    def __init__(self, generator, n_processes, n_keep=10, copy=True):
+        """
+        Parameters
+        ----------
+        generator : Hdf5BatchGenerator
+            The generator to read from. Has to be in keras_mode. It is
+            closed in this process, and used by the workers instead.
+        n_processes : int
+            Number of worker processes.
+        n_keep : int
+            Only if copy is False: How many of the yielded batches are
+            still in use, e.g. in a queue. Their slots are not overwritten.
+        copy : bool
+            If False, yield views into the slots instead of copies. A slot
+            is reused after n_keep further batches have been yielded, so
+            only use this if the batches are consumed in order through
+            a queue of limited size, like in validation.
+
+        """
+        if not generator.keras_mode:
+            raise ValueError("ProcessLoader requires a generator "
+                             "in keras_mode")
+        self.generator = generator
+        self.n_processes = n_processes
+        self.n_keep = 0 if copy else n_keep
+        self.copy = copy
+        self.n_slots = self.n_keep + 2 * n_processes
+
+        # the structure of the batches is taken from the first one
+        xs, ys = generator._get_batch(0)
+        generator.close()
+        self._layout = []
+        self._slot_bytes = 0
+        for group, arrays in (("xs", xs), ("ys", ys)):
+            if arrays is None:
+                continue
+            for key, array in arrays.items():
+                shape = (generator._batchsize, ) + array.shape[1:]
+                nbytes = int(np.prod(shape)) * array.dtype.itemsize
+                self._layout.append(
+                    (group, key, array.shape[1:], array.dtype,
+                     self._slot_bytes, nbytes))
+                # keep arrays aligned
+                self._slot_bytes += int(np.ceil(nbytes / 64)) * 64
+        self._has_ys = ys is not None
+
+        context = multiprocessing.get_context("spawn")
+        self._shared = context.RawArray(
+            "b", max(self._slot_bytes * self.n_slots, 1))
+        self._memory = np.frombuffer(self._shared, dtype=np.uint8)
+        self._tasks = context.Queue()
+        self._results = context.Queue()
+        self._processes = [
+            context.Process(target=self._work, daemon=True)
+            for i in range(n_processes)]
+        for process in self._processes:
+            process.start()
+        # number of the current iteration, and its unfinished tasks
+        self._run = 0
+        self._in_flight = 0
+        # finished batches of the current iteration, by index
+        self._finished = {}
+
+    def __getstate__(self):
+        """ What the worker processes get. """
+        state = self.__dict__.copy()
+        for key in ("_memory", "_processes", "_finished"):
+            state.pop(key, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._memory = np.frombuffer(self._shared, dtype=np.uint8)
+
+    def __len__(self):
+        return len(self.generator)
+
+    @property
+    def n_ready(self):
+        """ Number of batches the workers have finished ahead. """
+        try:
+            in_queue = self._results.qsize()
+        except NotImplementedError:
+            in_queue = 0
+        return len(self._finished) + in_queue
+
+    def __iter__(self):
+        """
+        Yield all batches of the generator in order.
+
+        Yields
+        ------
+        xs, ys
+            Like Hdf5BatchGenerator.
+
+        """
+        self._drain()
+        self._run += 1
+        free_slots = list(range(self.n_slots))
+        handed_out = collections.deque()
+        self._finished = finished = {}
+        next_task = 0
+        for index in range(len(self)):
+            while free_slots and next_task < len(self):
+                self._tasks.put((self._run, next_task, free_slots.pop()))
+                self._in_flight += 1
+                next_task += 1
+            while index not in finished:
+                run, done_index, slot, rows = self._get_result()
+                finished[done_index] = (slot, rows)
+            slot, rows = finished.pop(index)
+            if self.copy:
+                xs, ys = self._get_views(slot, rows)
+                xs = {key: array.copy() for key, array in xs.items()}
+                if ys is not None:
+                    ys = {key: array.copy() for key, array in ys.items()}
+                free_slots.append(slot)
+                yield xs, ys
+                continue
+            yield self._get_views(slot, rows)
+            handed_out.append(slot)
+            if len(handed_out) > self.n_keep:
+                free_slots.append(handed_out.popleft())
+
+    def close(self):
+        """ Stop the worker processes. """
+        for process in self._processes:
+            self._tasks.put(None)
+        for process in self._processes:
+            process.join(timeout=10)
+            if process.is_alive():
+                process.terminate()
+                process.join()
+        self._processes = []
+        self._tasks.close()
+        self._results.close()
+
+    def _work(self):
+        """ Read batches in a worker process until told to stop. """
+        generator = self.generator
+        generator.prefetch_batches = 0
+        for input_key, file in generator.files_dict.items():
+            generator._files[input_key] = h5py.File(file, 'r')
+        try:
+            while True:
+                task = self._tasks.get()
+                if task is None:
+                    break
+                run, index, slot = task
+                try:
+                    xs, ys = generator._get_batch(index)
+                    rows = self._put(slot, {"xs": xs, "ys": ys})
+                except Exception:
+                    self._results.put(
+                        (run, index, slot, None, traceback.format_exc()))
+                else:
+                    self._results.put((run, index, slot, rows, None))
+        finally:
+            generator.close()
+
+    def _put(self, slot, batch):
+        """ Copy a batch into a slot, and return its number of rows. """
+        rows = None
+        for group, key, shape, dtype, offset, nbytes in self._layout:
+            array = batch[group][key]
+            if array.shape[1:] != shape or array.dtype != dtype or \
+                    len(array) > self.generator._batchsize:
+                raise ValueError(
+                    "Batch of {} {} has shape {} and dtype {}, but it "
+                    "was {} and {} in the first batch".format(
+                        group, key, array.shape, array.dtype, shape, dtype))
+            rows = len(array)
+            np.copyto(self._get_view(slot, offset, nbytes, shape,
+                                     dtype, rows), array)
+        return rows
+
+    def _get_views(self, slot, rows):
+        """ Get the batch in a slot as xs, ys. """
+        batch = {"xs": {}, "ys": {} if self._has_ys else None}
+        for group, key, shape, dtype, offset, nbytes in self._layout:
+            batch[group][key] = self._get_view(
+                slot, offset, nbytes, shape, dtype, rows)
+        return batch["xs"], batch["ys"]
+
+    def _get_view(self, slot, offset, nbytes, shape, dtype, rows):
+        start = slot * self._slot_bytes + offset
+        view = self._memory[start: start + nbytes].view(dtype)
+        return view.reshape((-1, ) + shape)[:rows]
+
+    def _get_result(self):
+        """
+        Get the next finished batch of the current iteration from the
+        workers. Errors of the workers are raised here.
+
+        """
+        while True:
+            run, index, slot, rows, error = self._get_any_result()
+            if run != self._run:
+                # from an iteration that was stopped early
+                continue
+            if error is not None:
+                raise RuntimeError(
+                    "Error in loader process while reading batch "
+                    "{}:\n{}".format(index, error))
+            return run, index, slot, rows
+
+    def _get_any_result(self):
+        """ Wait for the next finished task of the workers. """
+        while True:
+            try:
+                result = self._results.get(timeout=1)
+                break
+            except queue.Empty:
+                for process in self._processes:
+                    if process.exitcode not in (None, 0):
+                        raise RuntimeError(
+                            "Loader process exited with code {}".format(
+                                process.exitcode))
+        self._in_flight -= 1
+        return result
+
+    def _drain(self):
+        """
+        Wait for the tasks of a previous, unfinished iteration, so that
+        their slots can be used again.
+
+        """
+        while self._in_flight > 0:
+            self._get_any_result()
+
+
+def get_chunk_rows(dataset):
+    """
+    Get the number of rows in a chunk of a h5 dataset.
+
+    Virtual datasets are not chunked themselves, so the largest number
+    of rows in a chunk of their sources is used instead. Chunks of
+    sources that do not start at a multiple of it in the virtual dataset
+    are not aligned to the rows read together, so reading is slower.
+
+    Parameters
+    ----------
+    dataset : h5py.Dataset
+        The dataset.
+
+    Returns
+    -------
+    chunk_rows : int or None
+        The number of rows, or None if the dataset is not chunked.
+
+    """
+    if not dataset.is_virtual:
+        return None if dataset.chunks is None else dataset.chunks[0]
+    folder = os.path.dirname(os.path.abspath(dataset.file.filename))
+    chunk_rows = []
+    for source in dataset.virtual_sources():
+        if source.file_name == ".":
+            source_file = dataset.file
+        else:
+            source_file = h5py.File(
+                os.path.join(folder, source.file_name), "r")
+        try:
+            chunks = source_file[source.dset_name].chunks
+        finally:
+            if source_file is not dataset.file:
+                source_file.close()
+        if chunks is not None:
+            chunk_rows.append(chunks[0])
+    if len(chunk_rows) == 0:
+        return None
+    return max(chunk_rows)
+
+
+def get_memmap(dataset):
+    """
+    Map a h5 dataset into memory with numpy, if possible.
+
+    This works for datasets that are stored contiguously and without
+    filters (like compression) in a file opened with the default driver,
+    and with a fixed-size dtype.
+
+    Parameters
+    ----------
+    dataset : h5py.Dataset
+        The dataset.
+
+    Returns
+    -------
+    memmap : ndarray or None
+        A copy-on-write view of the memmap, i.e. writing to it does not
+        change the file. None if the dataset can not be memory mapped.
+
+    """
+    if dataset.chunks is not None or dataset.compression is not None:
+        return None
+    if dataset.is_virtual:
+        return None
+    if dataset.file.driver != "sec2" or dataset.dtype.hasobject:
+        return None
+    if h5py.check_dtype(vlen=dataset.dtype) is not None:
+        return None
+    if dataset.size == 0:
+        return None
+    # None if the space of the dataset has not been allocated in the file
+    offset = dataset.id.get_offset()
+    if offset is None:
+        return None
+
+    memmap = np.memmap(dataset.file.filename, mode="c",
+                       dtype=dataset.dtype, offset=offset,
+                       shape=dataset.shape)
+    return memmap.view(np.ndarray)
+
+
+def y_or_x(x_values, y_values):
+    """ Get y_values, or the first x_values if there are no y_values. """
+    if y_values is not None:
+        return y_values
+    return list(x_values.values())[0]
+
+
+def modify_blob(info_blob, sample_modifier, label_modifier, keras_mode=True):
+    """
+    Apply the sample and label modifier to a blob with x and y values.
+
+    Parameters
+    ----------
+    info_blob : dict
+        Contains x_values and y_values (which can be None).
+    sample_modifier : function or None
+        Operation to be performed on the samples.
+    label_modifier : function or None
+        Operation to be performed on the labels.
+    keras_mode : bool
+        If true, return xs and ys. Otherwise, add them to the info_blob
+        and return the info_blob.
+
+    Returns
+    -------
+    xs, ys or info_blob
+
+    """
+    # Modify the samples
+    if sample_modifier is not None:
+        xs = sample_modifier(info_blob)
+    else:
+        xs = info_blob["x_values"]
+    info_blob["xs"] = xs
+
+    # Modify the labels
+    if info_blob["y_values"] is not None and label_modifier is not None:
+        ys = label_modifier(info_blob)
+    else:
+        ys = None
+    info_blob["ys"] = ys
+
+    if keras_mode:
+        return xs, ys
+    else:
+        return info_blob
+
+
+class ChunkCache:
+    """
+    Read rows from a h5 dataset chunk by chunk, and keep the most
+    recently used chunks in memory.
+
+    """
+    def __init__(self, dataset, buffer_rows, fields=None):
+        """
+        Parameters
+        ----------
+        dataset : h5py.Dataset
+            The dataset to read from.
+        buffer_rows : int
+            How many rows to keep in memory at most (rounded up to
+            whole chunks).
+        fields : List or None
+            Only read these fields of a structured dataset.
+
+        """
+        self.dataset = dataset
+        self.fields = fields
+        self.chunk_rows = get_chunk_rows(dataset)
+        if self.chunk_rows is None:
+            # not chunked: read blocks of similar size instead
+            self.chunk_rows = max(1, min(buffer_rows, len(dataset)))
+        self.max_chunks = int(np.ceil(buffer_rows / self.chunk_rows)) + 1
+
+        self._chunks = OrderedDict()
+        self._lock = threading.Lock()
+
+    def read(self, indices):
+        """
+        Get the rows with the given indices.
+
+        Parameters
+        ----------
+        indices : ndarray
+            The indices of the rows, in any order.
+
+        Returns
+        -------
+        rows : ndarray
+            The rows, in the order of the indices.
+
+        """
+        chunk_nos = indices // self.chunk_rows
+        if self.fields is None:
+            dtype = self.dataset.dtype
+        else:
+            dtype = np.dtype([(name, self.dataset.dtype[name])
+                              for name in self.fields])
+        rows = np.empty((len(indices),) + self.dataset.shape[1:], dtype=dtype)
+        for chunk_no in np.unique(chunk_nos):
+            in_chunk = chunk_nos == chunk_no
+            chunk = self._get_chunk(chunk_no)
+            rows[in_chunk] = chunk[indices[in_chunk] - chunk_no * self.chunk_rows]
+        return rows
+
+    def _get_chunk(self, chunk_no):
+        """ Get a chunk from memory, or read it from the file. """
+        with self._lock:
+            if chunk_no in self._chunks:
+                self._chunks.move_to_end(chunk_no)
+            else:
+                start = chunk_no * self.chunk_rows
+                if self.fields is None:
+                    dataset = self.dataset
+                else:
+                    dataset = self.dataset.fields(self.fields)
+                self._chunks[chunk_no] = dataset[start: start + self.chunk_rows]
+                if len(self._chunks) > self.max_chunks:
+                    self._chunks.popitem(last=False)
+            return self._chunks[chunk_no]
+
 
 def get_h5_generator(orga, files_dict, f_size=None, zero_center=False,
-                     keras_mode=True, shuffle=False, use_def_label=True):
+                     keras_mode=True, shuffle=False, use_def_label=True,
+                     y_field_names=None, f_offset=0, reuse_buffers=False):
     """
     Initialize the hdf5_batch_generator_base with the paramters in orga.cfg.
 
@@ -267,12 +1247,27 @@ def get_h5_generator(orga, files_dict, f_size=None, zero_center=False,
     keras_mode : bool
         Specifies if mc-infos (y_values) should be yielded as well. The
         mc-infos are used for evaluation after training and testing is finished.
-    shuffle : bool
+    shuffle : bool or str
         Randomize the order in which batches are read from the file.
         Significantly reduces read out speed.
+        If "chunks", shuffle the samples chunk-wise instead, which is close
+        to the read out speed without shuffling (see Hdf5BatchGenerator).
     use_def_label : bool
         If True and no label modifier is given by user, use the default
         label modifier instead of none.
+    y_field_names : List or None
+        Only read these fields of the y_values from the files.
+        If None and keras_mode is True, the fields in the y_field_names
+        attributes of the label modifier and the sample modifier are used
+        (see get_y_field_names).
+    f_offset : int
+        The index of the first sample in the files to use.
+    reuse_buffers : bool
+        Only for zero centering: Write the batches into get_n_buffers(orga)
+        preallocated buffers in turns, instead of into new arrays. Batches
+        are overwritten after that many further batches, so only use this
+        if they are consumed in order through queues of at most
+        orga.cfg.max_queue_size batches, like in validation and inference.
 
     Yields
     ------
@@ -289,33 +1284,228 @@ def get_h5_generator(orga, files_dict, f_size=None, zero_center=False,
         Y values from the file. Only yielded if yield_mc_info is True.
 
     """
-    if orga.cfg.label_modifier is not None:
-        label_modifier = orga.cfg.label_modifier
-    elif use_def_label:
-        assert orga._auto_label_modifier is not None, \
-            "Auto label modifier has not been set up (can be done with " \
-            "nn_utilities.get_auto_label_modifier)"
-        label_modifier = orga._auto_label_modifier
-    else:
-        label_modifier = None
-
-    # get xs_mean or load/create if not stored yet
-    if zero_center:
-        xs_mean = orga.get_xs_mean()
-    else:
-        xs_mean = None
+    label_modifier = get_label_modifier(orga, use_def_label)
+    if y_field_names is None and keras_mode:
+        # otherwise, all y_values are needed for the dataset modifier
+        y_field_names = get_y_field_names(
+            label_modifier, orga.cfg.sample_modifier)
 
     generator = Hdf5BatchGenerator(
         files_dict=files_dict,
         batchsize=orga.cfg.batchsize,
         key_x_values=orga.cfg.key_x_values,
         key_y_values=orga.cfg.key_y_values,
+        y_field_names=y_field_names,
         sample_modifier=orga.cfg.sample_modifier,
         label_modifier=label_modifier,
-        xs_mean=xs_mean,
         f_size=f_size,
+        f_offset=f_offset,
         keras_mode=keras_mode,
         shuffle=shuffle,
+        prefetch_batches=orga.cfg.prefetch_batches,
+        chunk_buffer=orga.cfg.shuffle_chunk_buffer,
+        use_memmap=orga.cfg.use_memmap,
+        **get_zero_center_options(orga, zero_center, reuse_buffers),
     )
 
     return generator
+
+
+def get_shuffle_buffer(orga, file_no, zero_center=False):
+    """
+    Get a ShuffleBuffer for the given train file with the paramters in
+    orga.cfg.
+
+    The training files are divided into groups of
+    orga.cfg.shuffle_buffer_files files. The file_no-th file step trains on
+    a slice of every file in its group, e.g. with 3 files in a group, the
+    first file step uses the first third of each of the 3 files,
+    the second file step uses the second third, etc.
+
+    Parameters
+    ----------
+    orga : object Organizer
+        Contains all the configurable options in the OrcaNet scripts.
+    file_no : int
+        The number of the file step, starting at 1.
+    zero_center : bool
+        Whether to use zero centering.
+        Requires orga.zero_center_folder to be set.
+
+    Returns
+    -------
+    shuffle_buffer : ShuffleBuffer
+        Yields the mixed batches.
+
+    """
+    label_modifier = get_label_modifier(orga)
+    group_size = orga.cfg.shuffle_buffer_files
+    n_files = orga.io.get_no_of_files("train")
+    file_sizes = orga.io.get_file_sizes("train")
+
+    group_start = (file_no - 1) // group_size * group_size
+    group = range(group_start, min(group_start + group_size, n_files))
+    part = file_no - 1 - group_start
+
+    # the staged files are released by the caller after the training,
+    # or here if the shuffle buffer can not be made
+    staged, generators = [], []
+    try:
+        for file_index in group:
+            size = file_sizes[file_index]
+            start = size * part // len(group)
+            stop = size * (part + 1) // len(group)
+            if stop == start:
+                continue
+            files_dict = orga.io.get_file("train", file_index + 1)
+            staged.append(files_dict)
+            generators.append(Hdf5BatchGenerator(
+                files_dict=files_dict,
+                batchsize=orga.cfg.batchsize,
+                key_x_values=orga.cfg.key_x_values,
+                key_y_values=orga.cfg.key_y_values,
+                y_field_names=get_y_field_names(
+                    label_modifier, orga.cfg.sample_modifier),
+                f_size=stop - start,
+                f_offset=start,
+                keras_mode=False,
+                shuffle=orga.cfg.shuffle_train,
+                prefetch_batches=orga.cfg.prefetch_batches,
+                chunk_buffer=orga.cfg.shuffle_chunk_buffer,
+                use_memmap=orga.cfg.use_memmap,
+                **get_zero_center_options(orga, zero_center),
+            ))
+
+        shuffle_buffer = ShuffleBuffer(
+            generators,
+            batchsize=orga.cfg.batchsize,
+            sample_modifier=orga.cfg.sample_modifier,
+            label_modifier=label_modifier,
+            buffer_memory=orga.cfg.shuffle_buffer_memory,
+        )
+    except Exception:
+        for generator in generators:
+            generator.close()
+        for files_dict in staged:
+            orga.io.release_files(files_dict)
+        raise
+    return shuffle_buffer
+
+
+def get_label_modifier(orga, use_def_label=True):
+    """
+    Get the label modifier of the user, or the default one.
+
+    Parameters
+    ----------
+    orga : object Organizer
+        Contains all the configurable options in the OrcaNet scripts.
+    use_def_label : bool
+        If True and no label modifier is given by user, use the default
+        label modifier instead of none.
+
+    Returns
+    -------
+    label_modifier : function or None
+
+    """
+    if orga.cfg.label_modifier is not None:
+        label_modifier = orga.cfg.label_modifier
+    elif use_def_label:
+        assert orga._auto_label_modifier is not None, \
+            "Auto label modifier has not been set up (can be done with " \
+            "nn_utilities.get_auto_label_modifier)"
+        label_modifier = orga._auto_label_modifier
+    else:
+        label_modifier = None
+    return label_modifier
+
+
+def get_y_field_names(label_modifier, sample_modifier=None):
+    """
+    Get the fields of the y_values that the modifiers use.
+
+    Parameters
+    ----------
+    label_modifier : function or None
+        The label modifier. Can state the fields of the y_values it needs in
+        its attribute y_field_names.
+    sample_modifier : function or None
+        The sample modifier, which also gets the y_values. If given, it
+        has to state the fields it needs in its attribute y_field_names
+        as well, otherwise all fields are read.
+
+    Returns
+    -------
+    y_field_names : List or None
+        The fields, or None if they are not known.
+
+    """
+    y_field_names = getattr(label_modifier, "y_field_names", None)
+    if y_field_names is None or sample_modifier is None:
+        return y_field_names
+    sample_field_names = getattr(sample_modifier, "y_field_names", None)
+    if sample_field_names is None:
+        return None
+    return list(y_field_names) + [name for name in sample_field_names
+                                  if name not in y_field_names]
+
+
+def get_zero_center_options(orga, zero_center, reuse_buffers=False):
+    """
+    Get the arguments of the Hdf5BatchGenerator regarding zero centering.
+
+    Parameters
+    ----------
+    orga : object Organizer
+        Contains all the configurable options in the OrcaNet scripts.
+    zero_center : bool
+        Whether to use zero centering.
+        Requires orga.zero_center_folder to be set.
+    reuse_buffers : bool
+        Write the zero centered data into preallocated buffers in turns
+        (see get_h5_generator).
+
+    Returns
+    -------
+    options : dict
+        xs_mean, xs_std, x_dtype and n_buffers.
+
+    """
+    if not zero_center:
+        return {"xs_mean": None}
+    # get xs_mean or load/create if not stored yet
+    xs_mean = orga.get_xs_mean()
+    if orga.cfg.zero_center_scale:
+        xs_std = orga.get_xs_std()
+    else:
+        xs_std = None
+    return {
+        "xs_mean": xs_mean,
+        "xs_std": xs_std,
+        "x_dtype": orga.cfg.zero_center_dtype,
+        "n_buffers": get_n_buffers(orga) if reuse_buffers else None,
+    }
+
+
+def get_n_buffers(orga):
+    """
+    Get how many output buffers are needed to safely reuse them per batch.
+
+    Parameters
+    ----------
+    orga : object Organizer
+        Contains all the configurable options in the OrcaNet scripts.
+
+    Returns
+    -------
+    n_buffers : int
+        Number of batches that can exist at the same time.
+
+    """
+    # batches that can exist at the same time, e.g. in h5_inference: the
+    # prefetched ones, the ones in the queues of the reader and the
+    # writer, one in each of the reader thread (blocked in put) and the
+    # main thread, and up to three in the writer thread, which keeps the
+    # compression of two batches going while writing the next one
+    return 2 * orga.cfg.max_queue_size + orga.cfg.prefetch_batches + 5
@@ -2,6 +2,8 @@ import numpy as np
 import os
 from orcanet.utilities.visualization import plot_history
 from orcanet.in_out import get_subfolder
+from orcanet.logging import BINARY_TRAIN_LOG, read_binary_train_log, \
+    read_txt_train_log
 
 
 class HistoryHandler:
@@ -12,6 +14,16 @@ class HistoryHandler:
     def __init__(self, main_folder):
         self.main_folder = main_folder
         self.summary_filename = "summary.txt"
+        # keys are filepaths, values the stats of the file when it was
+        # read, and its data
+        self._file_cache = {}
+
+    def __getstate__(self):
+        """ Leave out the cached data when pickling, e.g. for plotting
+        in a spawned process. """
+        state = self.__dict__.copy()
+        state["_file_cache"] = {}
+        return state
 
     @property
     def summary_file(self):
@@ -24,7 +36,8 @@ class HistoryHandler:
     def train_log_folder(self):
         return get_subfolder(self.main_folder, "train_log")
 
-    def plot_metric(self, metric_name, **kwargs):
+    def plot_metric(self, metric_name, summary_data=None,
+                    full_train_data=None, **kwargs):
         """
         Plot the training and validation history of a metric.
 
@@ -37,12 +50,18 @@ class HistoryHandler:
             Name of the metric to be plotted over the epoch. This name is what
             was written in the head line of the summary.txt file, except without
             the train_ or val_ prefix.
+        summary_data : ndarray, optional
+            Use this instead of the data from the summary file.
+        full_train_data : ndarray, optional
+            Use this instead of the data from the training log files.
         kwargs
             Keyword arguments for the plot_history function.
 
         """
-        summary_data = self.get_summary_data()
-        full_train_data = self.get_train_data()
+        if summary_data is None:
+            summary_data = self.get_summary_data()
+        if full_train_data is None:
+            full_train_data = self.get_train_data()
         summary_label = "val_" + metric_name
 
         if metric_name not in full_train_data.dtype.names:
@@ -77,12 +96,14 @@ class HistoryHandler:
 
         plot_history(train_data, val_data, **kwargs)
 
-    def plot_lr(self, **kwargs):
+    def plot_lr(self, summary_data=None, **kwargs):
         """
         Plot the learning rate over the epochs.
 
         Parameters
         ----------
+        summary_data : ndarray, optional
+            Use this instead of the data from the summary file.
         kwargs
             Keyword arguments for the plot_history function.
 
@@ -92,7 +113,8 @@ class HistoryHandler:
             The plot.
 
         """
-        summary_data = self.get_summary_data()
+        if summary_data is None:
+            summary_data = self.get_summary_data()
 
         epoch = summary_data["Epoch"]
         lr = summary_data["LR"]
@@ -107,6 +129,36 @@ class HistoryHandler:
         plot_history(train_data=None, val_data=val_data, logy=True,
                      y_lims=None, **kwargs)
 
+    def plot_timing(self, column_name="samples_per_s", **kwargs):
+        """
+        Plot a timing column of the training log files over the epoch.
+
+        The columns are only present if the training was done with
+        cfg.train_logger_timing.
+
+        Parameters
+        ----------
+        column_name : str
+            Name of the column, e.g. samples_per_s, time_batch, time_fetch,
+            time_step or queue_fill.
+        kwargs
+            Keyword arguments for the plot_history function.
+
+        """
+        full_train_data = self.get_train_data()
+        if column_name not in full_train_data.dtype.names:
+            raise ValueError(
+                "Train log column {} unknown, must be one of {}".format(
+                    column_name, full_train_data.dtype.names))
+        train_data = [full_train_data["Batch_float"],
+                      full_train_data[column_name]]
+
+        if "y_label" not in kwargs:
+            kwargs["y_label"] = column_name
+        if "legend" not in kwargs:
+            kwargs["legend"] = False
+        plot_history(train_data, None, **kwargs)
+
     def get_metrics(self):
         """
         Get the name of the metrics from the first line in the summary file.
@@ -137,6 +189,9 @@ class HistoryHandler:
         """
         Read out the summary file in the output folder.
 
+        The data is cached, and only read again if the file has changed
+        since then.
+
         Returns
         -------
         summary_data : ndarray
@@ -144,11 +199,27 @@ class HistoryHandler:
             Its shape is the number of lines with data.
 
         """
-        summary_data = self._load_txt(self.summary_file)
-        if summary_data.shape == ():
-            # When only one line is present
-            summary_data = summary_data.reshape(1,)
-        return summary_data
+        summary_data = self._read_cached(self.summary_file, self._load_txt)
+        # reshape for when only one line is present
+        return summary_data.reshape(-1).copy()
+
+    def clear_cache(self):
+        """ Read all files again the next time they are needed. """
+        self._file_cache = {}
+
+    def _read_cached(self, filepath, reader):
+        """
+        Read a file with the given function, or take the data from the
+        cache if the file has not changed since it was read last.
+
+        """
+        stat = os.stat(filepath)
+        file_stats = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        cached = self._file_cache.get(filepath)
+        if cached is None or cached[0] != file_stats:
+            cached = (file_stats, reader(filepath))
+            self._file_cache[filepath] = cached
+        return cached[1]
 
     def get_best_epoch_info(self, metric="val_loss", mini=True):
         """
@@ -225,13 +296,21 @@ class HistoryHandler:
         column_names = summary_data.dtype.names
         return column_names
 
-    def get_train_data(self):
+    def get_train_data(self, train_logs=None):
         """
         Read out all training logfiles in the output folder.
 
         Read out the data from the summary.txt file, and from all training
         log files in the train_log folder, which is in the same directory
-        as the summary.txt file.
+        as the summary.txt file. Logs in the binary train log file are
+        read as well; they are preferred over text files of the same
+        epoch and file number.
+
+        Parameters
+        ----------
+        train_logs : dict, optional
+            Use these logs instead of reading them, in the format
+            returned by get_train_logs.
 
         Returns
         -------
@@ -239,10 +318,45 @@ class HistoryHandler:
             Structured array containing the data from the summary.txt file.
             Its shape is the number of lines with data.
 
+        """
+        if train_logs is None:
+            train_logs = self.get_train_logs()
+        # sort so that earlier epochs come first
+        full_train_data = _concatenate_columns(
+            [train_logs[epoch_file] for epoch_file in sorted(train_logs)])
+
+        if full_train_data.shape == ():
+            # When only one line is present
+            full_train_data = full_train_data.reshape(1,)
+        return full_train_data
+
+    def get_train_logs(self):
+        """
+        Read out the training logfiles in the output folder separately.
+
+        Files are only read again if they have changed since they were
+        read last, so the same arrays are returned for them.
+        The arrays should not be modified.
+
+        Returns
+        -------
+        train_logs : dict
+            Keys are (epoch, fileno) tuples, values the structured arrays
+            with the data of the training log files.
+
         """
         # list of all files in the train_log folder of this model
         files = os.listdir(self.train_log_folder)
-        train_file_data = []
+        # keys are (epoch, fileno)
+        train_file_data = {}
+        if BINARY_TRAIN_LOG in files:
+            binary_data = self._read_cached(
+                os.path.join(self.train_log_folder, BINARY_TRAIN_LOG),
+                read_binary_train_log)
+            for epoch_file, file_data in binary_data.items():
+                if len(file_data) > 0:
+                    train_file_data[epoch_file] = file_data
+
         for file in files:
             if not (file.startswith("log_epoch_") and file.endswith(".txt")):
                 continue
@@ -252,19 +366,11 @@ class HistoryHandler:
 
             # file is sth like "log_epoch_1_file_2.txt", extract epoch & fileno:
             epoch, file_no = [int(file.split(".")[0].split("_")[i]) for i in [2, 4]]
-            file_data = self._load_txt(filepath)
-            train_file_data.append([[epoch, file_no], file_data])
-
-        # sort so that earlier epochs come first
-        train_file_data.sort()
-        full_train_data = train_file_data[0][1]
-        for [epoch, file_no], file_data in train_file_data[1:]:
-            full_train_data = np.append(full_train_data, file_data)
-
-        if full_train_data.shape == ():
-            # When only one line is present
-            full_train_data = full_train_data.reshape(1,)
-        return full_train_data
+            if (epoch, file_no) in train_file_data:
+                continue
+            train_file_data[(epoch, file_no)] = self._read_cached(
+                filepath, self._load_txt)
+        return train_file_data
 
     def get_state(self):
         """
@@ -325,17 +431,29 @@ class HistoryHandler:
 
     @staticmethod
     def _load_txt(filepath):
-        # TODO suboptimal that n/a gets replaced by np.nan, because this
-        #  means that legitamte, not availble cells can not be distinguished
-        #  from failed 'nan' metric values produced by training.
-
-        file_data = np.genfromtxt(
-            filepath,
-            names=True,
-            delimiter="|",
-            autostrip=True,
-            comments="--",
-            missing_values="n/a",
-            filling_values=np.nan
-        )
-        return file_data
+        return read_txt_train_log(filepath)
+
+
+def _concatenate_columns(arrays):
+    """
+    Concatenate structured arrays, which may have different columns.
+    Missing columns are filled with nans.
+
+    """
+    arrays = [array.reshape(-1) for array in arrays]
+    names = []
+    for array in arrays:
+        for name in array.dtype.names:
+            if name not in names:
+                names.append(name)
+    if all([array.dtype.names == tuple(names) for array in arrays]):
+        return np.concatenate(arrays)
+
+    full_data = np.full(sum([len(array) for array in arrays]), np.nan,
+                        dtype=[(name, "<f8") for name in names])
+    start = 0
+    for array in arrays:
+        for name in array.dtype.names:
+            full_data[name][start: start + len(array)] = array[name]
+        start += len(array)
+    return full_data
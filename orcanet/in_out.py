@@ -5,7 +5,15 @@ Utility code regarding user input.
 """
 
 import os
+import queue
 import shutil
+import threading
+import uuid
+import warnings
+import zlib
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import ExitStack
 import h5py
 import numpy as np
 from inspect import signature
@@ -40,6 +48,7 @@ def get_subfolder(main_folder, name=None, create=False):
         "plots": main_folder + "plots",
         "activations": main_folder + "plots/activations",
         "predictions": main_folder + "predictions",
+        "virtual_files": main_folder + "virtual_files",
     }
 
     def get(fdr):
@@ -75,6 +84,18 @@ class IOHandler(object):
             "val": None,
             "inference": None,
         }
+        # metadata of the h5 files, see get_h5_metadata
+        self._h5_metadata = {}
+        # copies the files to the local tmpdir, see get_local_files
+        self._staging = None
+        # files with virtual datasets over all files of a set
+        self._virtual_files_dict = {}
+
+    def __getstate__(self):
+        """ The copying to the local tmpdir stays in this process. """
+        state = self.__dict__.copy()
+        state["_staging"] = None
+        return state
 
     def get_latest_epoch(self):
         """
@@ -356,53 +377,50 @@ class IOHandler(object):
 
         return cum_number_of_rows
 
-    def concatenate_pred_files(self, concatenated_folder):
-        """ Concatenates prediction files to a single one. """
+    def concatenate_pred_files(self, concatenated_folder, virtual=False):
+        """
+        Concatenates prediction files to a single one.
+
+        See concatenate_h5_files.
+
+        Parameters
+        ----------
+        concatenated_folder : str
+            The folder in which the concatenated file is saved.
+        virtual : bool
+            If true, make virtual datasets, which refer to the data in
+            the prediction files instead of copying it.
+
+        Returns
+        -------
+        pred_filepath_conc : str
+            The path to the concatenated file.
+
+        """
         if not os.path.isdir(concatenated_folder):
             os.mkdir(concatenated_folder)
 
         pred_files_list = self.get_pred_files_list()
 
-        # get cumulative number of rows in the pred files
-        cum_number_of_rows = self.get_cumulative_number_of_rows(pred_files_list)
-
         basename = os.path.basename(pred_files_list[-1])  # take one pred filepath, doesnt matter which one so use -1
         pred_filepath_conc = concatenated_folder + '/' + basename.split('_val_file_')[0] + '_all_val_files.h5'
 
-        f_conc = h5py.File(pred_filepath_conc, 'w')
-        for i, pred_file in enumerate(pred_files_list):
-            print('Concatenating file ' + str(i) + ' of ' + str(len(pred_files_list)))
-
-            f = h5py.File(pred_file, 'r')
-            for folder_name in f:
-                folder_data = f[folder_name]
-
-                if i == 0:
-                    # first file; create the dataset with no max shape
-                    maxshape = (None,) + folder_data.shape[1:]  # change shape of axis zero to None
-                    chunks = True
-                    compression, compression_opts = folder_data.compression, folder_data.compression_opts
-
-                    output_dataset = f_conc.create_dataset(folder_name, data=folder_data, maxshape=maxshape, chunks=chunks,
-                                                           compression=compression, compression_opts=compression_opts)
-
-                    output_dataset.resize(cum_number_of_rows[-1], axis=0)
-
-                else:
-                    f_conc[folder_name][cum_number_of_rows[i]:cum_number_of_rows[i + 1]] = folder_data
-
-            f_conc.flush()
-
-        f_conc.close()
-
+        print('Concatenating {} files'.format(len(pred_files_list)))
+        concatenate_h5_files(pred_files_list, pred_filepath_conc,
+                             virtual=virtual)
         return pred_filepath_conc
 
     def get_local_files(self, which):
         """
         Get the training or validation file paths for each list input set.
 
-        Returns the path to the copy of the file on the local tmpdir, which
-        it will generate if called for the first time.
+        If cfg.use_scratch_ssd is True, returns the path to the copy of the
+        files on the local tmpdir. The files are copied in the background
+        on demand by a StagingManager, so the copies might not exist yet!
+        Use get_file or yield_files to make sure they do.
+
+        If which is in cfg.virtual_files, returns one file per input set
+        instead, which contains virtual datasets over all files of the set.
 
         Parameters
         ----------
@@ -424,14 +442,72 @@ class IOHandler(object):
         if which not in self._tmpdir_files_dict.keys():
             raise NameError("Unknown fileset name ", which)
 
+        if self.cfg.virtual_files is not None and \
+                which in self.cfg.virtual_files:
+            return self._get_virtual_files(which)
+
         files = self.cfg.get_files(which)
         if self.cfg.use_scratch_ssd:
             if self._tmpdir_files_dict[which] is None:
-                self._tmpdir_files_dict[which] = use_local_tmpdir(files)
+                staging = self._get_staging()
+                self._tmpdir_files_dict[which] = {
+                    input_key: tuple(staging.get_path(f_path)
+                                     for f_path in f_paths)
+                    for input_key, f_paths in files.items()}
             return self._tmpdir_files_dict[which]
         else:
             return files
 
+    def _get_virtual_files(self, which):
+        """
+        Make a file for each input set of the given fileset, in which the
+        samples and labels of all its files are concatenated as virtual
+        datasets. They are made the first time they are needed, unless
+        an up-to-date file exists already, e.g. made by another worker in
+        distributed training.
+
+        """
+        if self.cfg.use_scratch_ssd:
+            raise ValueError(
+                "virtual_files can not be used together with use_scratch_ssd")
+        if which not in self._virtual_files_dict:
+            folder = get_subfolder(
+                self.cfg.output_folder, "virtual_files", create=True)
+            datasets = [self.cfg.key_x_values, self.cfg.key_y_values]
+            virtual_files = {}
+            for input_key, f_paths in self.cfg.get_files(which).items():
+                virtual_file = os.path.join(
+                    folder, "{}_{}.h5".format(which, input_key))
+                if not _is_virtual_file_up_to_date(
+                        virtual_file, f_paths, datasets):
+                    concatenate_h5_files(f_paths, virtual_file, virtual=True,
+                                         datasets=datasets)
+                virtual_files[input_key] = (virtual_file, )
+            self._virtual_files_dict[which] = virtual_files
+        return self._virtual_files_dict[which]
+
+    def _get_staging(self):
+        """ Get the StagingManager for copying files to the local tmpdir. """
+        if self._staging is None:
+            self._staging = StagingManager(
+                os.environ['TMPDIR'], max_size=self.cfg.scratch_max_size)
+        return self._staging
+
+    def _stage_file(self, which, file_no):
+        """
+        Make sure the n-th files are copied to the local tmpdir, and start
+        copying the next ones in the background.
+
+        """
+        files = self.cfg.get_files(which)
+        n_files = self.get_no_of_files(which)
+        self._staging.stage([f_paths[file_no - 1]
+                             for f_paths in files.values()])
+        # the first training file comes again after the last
+        if file_no < n_files or which == "train":
+            self._staging.prefetch([f_paths[file_no % n_files]
+                                    for f_paths in files.values()])
+
     def get_n_bins(self):
         """
         Get the number of bins from the training files.
@@ -448,8 +524,8 @@ class IOHandler(object):
         train_files = self.get_local_files("train")
         n_bins = {}
         for input_key in train_files:
-            with h5py.File(train_files[input_key][0], "r") as f:
-                n_bins[input_key] = f[self.cfg.key_x_values].shape[1:]
+            metadata = self.get_h5_metadata(train_files[input_key][0])
+            n_bins[input_key] = metadata[self.cfg.key_x_values]["shape"][1:]
         return n_bins
 
     def get_file_sizes(self, which):
@@ -474,9 +550,12 @@ class IOHandler(object):
 
         """
         file_sizes_full, error_file_sizes, file_sizes = {}, [], []
-        for n, file_no_set in enumerate(self.yield_files(which)):
+        files = self.get_local_files(which)
+        for n in range(self.get_no_of_files(which)):
+            # don't use yield_files, since the files dont need to be copied
+            file_no_set = {key: files[key][n] for key in files}
             # the number of samples in the n-th file of all inputs
-            file_sizes_full[n] = [h5_get_number_of_rows(
+            file_sizes_full[n] = [self.get_number_of_rows(
                 file, datasets=[self.cfg.key_y_values, self.cfg.key_x_values])
                 for file in file_no_set.values()]
             if not file_sizes_full[n].count(file_sizes_full[n][0]) == \
@@ -496,6 +575,89 @@ class IOHandler(object):
 
         return file_sizes
 
+    def get_h5_metadata(self, filepath):
+        """
+        Get the shape, dtype and chunks of all datasets in a h5 file.
+
+        The metadata is cached, so that the file only has to be opened again
+        if its size or modification time have changed.
+
+        Parameters
+        ----------
+        filepath : str
+            Path to the h5 file.
+
+        Returns
+        -------
+        metadata : dict
+            Keys: The names of the datasets (for datasets in groups,
+            the full path inside the file).
+            Values: dicts with the entries "shape", "dtype" and "chunks".
+
+        """
+        if self._staging is not None:
+            # the original file has the same metadata as the (possibly
+            # not yet existing) copy on the local tmpdir
+            filepath = self._staging.get_source(filepath)
+        stat = os.stat(filepath)
+        file_state = (stat.st_size, stat.st_mtime_ns)
+
+        cached = self._h5_metadata.get(filepath)
+        if cached is not None and cached[0] == file_state:
+            return cached[1]
+
+        metadata = {}
+
+        def add_dataset(name, obj):
+            if isinstance(obj, h5py.Dataset):
+                metadata[name] = {
+                    "shape": obj.shape,
+                    "dtype": obj.dtype,
+                    "chunks": obj.chunks,
+                }
+        with h5py.File(filepath, "r") as f:
+            f.visititems(add_dataset)
+
+        self._h5_metadata[filepath] = (file_state, metadata)
+        return metadata
+
+    def get_number_of_rows(self, filepath, datasets=None):
+        """
+        Like h5_get_number_of_rows, but uses the cached metadata.
+
+        Parameters
+        ----------
+        filepath : str
+            filepath of the .h5 file.
+        datasets : list
+            Optional, The names of datasets in the file to check.
+
+        Returns
+        -------
+        number_of_rows: int
+            number of rows of the .h5 file in the first dataset.
+
+        Raises
+        ------
+        AssertionError
+            If the given datasets do not have the same no of rows.
+
+        """
+        metadata = self.get_h5_metadata(filepath)
+        if datasets is None:
+            datasets = [name for name in metadata if "/" not in name]
+
+        number_of_rows = [metadata[dataset]["shape"][0]
+                          for dataset in datasets]
+        if not number_of_rows.count(number_of_rows[0]) == len(number_of_rows):
+            err_msg = "Datasets do not have the same number of samples " \
+                      "in file " + filepath
+            for i, dataset in enumerate(datasets):
+                err_msg += "\nDataset: {}\tSamples: {}".format(
+                    dataset, number_of_rows[i])
+            raise AssertionError(err_msg)
+        return number_of_rows[0]
+
     def get_no_of_files(self, which):
         """
         Return the number of training or validation files.
@@ -537,17 +699,38 @@ class IOHandler(object):
             Values: One of the filepaths.
 
         """
-        files = self.get_local_files(which)
         for file_no in range(self.get_no_of_files(which)):
-            files_dict = {key: files[key][file_no] for key in files}
-            yield files_dict
+            yield self.get_file(which, file_no + 1)
 
     def get_file(self, which, file_no):
-        """ Get a dict with the n-th files. """
+        """
+        Get a dict with the n-th files.
+
+        If cfg.use_scratch_ssd is True, this will wait until the files
+        have been copied to the local tmpdir. The copies are kept until
+        release_files is called with the returned dict.
+
+        """
         files = self.get_local_files(which)
         files_dict = {key: files[key][file_no-1] for key in files}
+        if self.cfg.use_scratch_ssd:
+            self._stage_file(which, file_no)
         return files_dict
 
+    def release_files(self, files_dict):
+        """
+        Allow the local copies of files from get_file to be deleted again.
+
+        Parameters
+        ----------
+        files_dict : dict
+            As returned by get_file or yield_files.
+
+        """
+        if self.cfg.use_scratch_ssd and self._staging is not None:
+            self._staging.release([self._staging.get_source(f_path)
+                                   for f_path in files_dict.values()])
+
     def check_connections(self, model):
         """
         Check if the names and shapes of the samples and labels in the
@@ -686,13 +869,18 @@ class IOHandler(object):
 
         """
         # TODO gets y_values only from first train file
-        files_dict = next(self.yield_files("train"))
+        files_dict = self.get_file("train", 1)
         x_values = {}
-        for i, inp_name in enumerate(files_dict):
-            with h5py.File(files_dict[inp_name], "r") as f:
-                x_values[inp_name] = f[self.cfg.key_x_values][:self.cfg.batchsize]
-                if i == 0:
-                    y_values = f[self.cfg.key_y_values][:self.cfg.batchsize]
+        try:
+            for i, inp_name in enumerate(files_dict):
+                with h5py.File(files_dict[inp_name], "r") as f:
+                    x_values[inp_name] = f[self.cfg.key_x_values][
+                        :self.cfg.batchsize]
+                    if i == 0:
+                        y_values = f[self.cfg.key_y_values][
+                            :self.cfg.batchsize]
+        finally:
+            self.release_files(files_dict)
 
         info_blob = {"x_values": x_values, "y_values": y_values}
         return info_blob
@@ -896,6 +1084,368 @@ def h5_get_number_of_rows(h5_filepath, datasets=None):
     return number_of_rows[0]
 
 
+def concatenate_h5_files(input_files, output_file, virtual=False,
+                         n_threads=None, datasets=None):
+    """
+    Concatenate the datasets of h5 files along the first axis.
+
+    Every input file is opened only once, and the datasets in the output
+    file are preallocated. They have the chunks and the compression of
+    the datasets in the first file. Chunks of the input files are copied
+    as they are if they have the same chunks and filters as the output
+    dataset, and if they are at a chunk border in the output. Otherwise,
+    the data is read out and the chunks are compressed in a thread pool,
+    if the compression is gzip.
+    The output file is written under a unique temporary name first, so
+    several processes can make the same file at once.
+
+    Parameters
+    ----------
+    input_files : List
+        Paths to the input files. The datasets of the first file will be
+        concatenated, and all files need to have them.
+    output_file : str
+        Path to the output file.
+    virtual : bool
+        If true, make virtual datasets, which refer to the data in the
+        input files instead of copying it. The input files then have to
+        stay where they are.
+    n_threads : int, optional
+        Number of threads for compressing. Default: Number of cpus.
+    datasets : List, optional
+        Names of the datasets to concatenate. Default: All datasets of
+        the first file.
+
+    """
+    if n_threads is None:
+        n_threads = os.cpu_count() or 1
+    temp_file = "{}.{}.tmp".format(output_file, uuid.uuid4().hex)
+    with ExitStack() as stack:
+        f_ins = [stack.enter_context(h5py.File(input_file, "r"))
+                 for input_file in input_files]
+        f_out = stack.enter_context(h5py.File(temp_file, "w"))
+        executor = stack.enter_context(ThreadPoolExecutor(n_threads))
+        if datasets is None:
+            datasets = list(f_ins[0])
+        for dataset_name in datasets:
+            sources = [f_in[dataset_name] for f_in in f_ins]
+            if virtual:
+                _make_virtual_dataset(f_out, dataset_name, sources)
+            else:
+                _concatenate_datasets(
+                    f_out, dataset_name, sources, executor, n_threads)
+    os.replace(temp_file, output_file)
+
+
+def _is_virtual_file_up_to_date(virtual_file, input_files, datasets):
+    """
+    Check if a file made by concatenate_h5_files with virtual=True exists
+    already, with the datasets of the given input files in this order,
+    and if it is newer than all of them.
+
+    """
+    if not os.path.isfile(virtual_file):
+        return False
+    mtime = os.path.getmtime(virtual_file)
+    if any([os.path.getmtime(f_path) > mtime for f_path in input_files]):
+        return False
+    input_files = [os.path.abspath(f_path) for f_path in input_files]
+    try:
+        with h5py.File(virtual_file, "r") as f:
+            for dataset_name in datasets:
+                sources = [source.file_name
+                           for source in f[dataset_name].virtual_sources()]
+                if sources != input_files:
+                    return False
+    except (OSError, KeyError, RuntimeError):
+        return False
+    return True
+
+
+def _make_virtual_dataset(f_out, dataset_name, sources):
+    """ Make a virtual dataset in f_out with the sources one after another. """
+    n_rows = [source.shape[0] for source in sources]
+    layout = h5py.VirtualLayout(
+        shape=(sum(n_rows), ) + sources[0].shape[1:],
+        dtype=sources[0].dtype)
+    start = 0
+    for source, rows in zip(sources, n_rows):
+        layout[start:start + rows] = h5py.VirtualSource(
+            os.path.abspath(source.file.filename), source.name,
+            shape=source.shape, dtype=source.dtype)
+        start += rows
+    f_out.create_virtual_dataset(dataset_name, layout)
+
+
+def _concatenate_datasets(f_out, dataset_name, sources, executor, n_threads):
+    """ Write the sources one after another into a new dataset in f_out. """
+    first = sources[0]
+    shape = (sum([source.shape[0] for source in sources]), ) + first.shape[1:]
+    dataset = f_out.create_dataset(
+        dataset_name,
+        shape=shape,
+        maxshape=(None, ) + first.shape[1:],
+        chunks=first.chunks if first.chunks is not None else True,
+        dtype=first.dtype,
+        compression=first.compression,
+        compression_opts=first.compression_opts,
+        shuffle=first.shuffle,
+    )
+    chunk_rows = dataset.chunks[0]
+    # offset of a chunk in all dimensions except the first
+    chunk_tail = (0, ) * (dataset.ndim - 1)
+    # read about 16 MB at once
+    row_bytes = max(dataset.dtype.itemsize * int(np.prod(shape[1:])), 1)
+    block_rows = int(max(16e6 // (row_bytes * chunk_rows), 1) * chunk_rows)
+    # chunks can be written directly if they can be compressed with zlib
+    direct = dataset.chunks[1:] == shape[1:] and \
+        dataset.compression in (None, "gzip") and not (
+            dataset.shuffle or dataset.fletcher32 or dataset.scaleoffset)
+
+    def compress(chunk):
+        if dataset.compression is None:
+            return chunk.tobytes()
+        return zlib.compress(chunk.tobytes(), dataset.compression_opts)
+
+    # chunks (offset, filter_mask, bytes or future) in the order of writing
+    pending = deque()
+
+    def write_pending(max_pending):
+        while len(pending) > max_pending or (pending and (
+                not isinstance(pending[0][2], Future) or
+                pending[0][2].done())):
+            offset, filter_mask, chunk = pending.popleft()
+            if isinstance(chunk, Future):
+                chunk = chunk.result()
+            dataset.id.write_direct_chunk(offset, chunk, filter_mask)
+
+    # rows which are not written yet, since they don't fill a chunk
+    leftover = first[0:0]
+    # rows of the output dataset that are written or pending
+    row = 0
+    for source in sources:
+        start = 0
+        if len(leftover) == 0 and row % chunk_rows == 0 and \
+                _can_copy_chunks(source, dataset):
+            # copy all full chunks as they are
+            n_chunks = source.shape[0] // chunk_rows
+            for start in range(0, n_chunks * chunk_rows, chunk_rows):
+                filter_mask, chunk = source.id.read_direct_chunk(
+                    (start, ) + chunk_tail)
+                pending.append(((row + start, ) + chunk_tail,
+                                filter_mask, chunk))
+                write_pending(4 * n_threads)
+            start = n_chunks * chunk_rows
+            row += start
+
+        for block_start in range(start, source.shape[0], block_rows):
+            block = source[block_start:block_start + block_rows]
+            if not direct:
+                dataset[row:row + len(block)] = block
+                row += len(block)
+                continue
+            block = np.concatenate([leftover, block])
+            n_full = len(block) // chunk_rows * chunk_rows
+            for start in range(0, n_full, chunk_rows):
+                pending.append(((row + start, ) + chunk_tail, 0,
+                                executor.submit(
+                                    compress,
+                                    block[start:start + chunk_rows])))
+            row += n_full
+            leftover = block[n_full:]
+            write_pending(2 * block_rows // chunk_rows)
+
+    if len(leftover) > 0:
+        # last chunk, filled up with zeros
+        chunk = np.zeros(dataset.chunks, dtype=dataset.dtype)
+        chunk[:len(leftover)] = leftover
+        pending.append(((row, ) + chunk_tail, 0,
+                        executor.submit(compress, chunk)))
+    write_pending(0)
+
+
+def _can_copy_chunks(source, dataset):
+    """ Check if the chunks of source can be copied into dataset as they are. """
+    if source.chunks != dataset.chunks or source.dtype != dataset.dtype or \
+            source.chunks[1:] != source.shape[1:]:
+        return False
+    for attribute in ("compression", "compression_opts", "shuffle",
+                      "fletcher32", "scaleoffset"):
+        if getattr(source, attribute) != getattr(dataset, attribute):
+            return False
+    # all chunks must have been written
+    n_chunks = -(-source.shape[0] // source.chunks[0])
+    return source.id.get_num_chunks() == n_chunks
+
+
+class StagingManager:
+    """
+    Copies files to a local scratch folder in a background thread.
+
+    Files are copied when they are staged (waiting for the copy to finish)
+    or prefetched (not waiting). Copies are verified with a checksum.
+    If a maximum size is given, the least recently staged copies are
+    deleted to make space for new ones. Copies of staged files are never
+    deleted until they have been released as often as they were staged.
+
+    """
+    def __init__(self, scratch_dir, max_size=None, verify=True):
+        """
+        Parameters
+        ----------
+        scratch_dir : str
+            The folder to copy the files into.
+        max_size : float or None
+            Maximum total size of the copies in bytes. None for no limit.
+        verify : bool
+            Check if the copies are identical to the original files by
+            comparing crc32 checksums.
+
+        """
+        self.scratch_dir = scratch_dir
+        self.max_size = max_size
+        self.verify = verify
+
+        # original file path for each copied file path
+        self._sources = {}
+        # original -> size of finished copies, least recently staged first
+        self._staged = OrderedDict()
+        # original -> Future of copies that are not finished
+        self._jobs = {}
+        # originals that must not be deleted -> number of unreleased stages
+        self._in_use = Counter()
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def get_path(self, f_path):
+        """ Get the path of the copy of a file. """
+        path = os.path.join(self.scratch_dir, os.path.basename(f_path))
+        self._sources[path] = f_path
+        return path
+
+    def get_source(self, path):
+        """ Get the original file path of a copy (or the path itself). """
+        return self._sources.get(path, path)
+
+    def stage(self, f_paths):
+        """
+        Copy the given files if neccessary, and wait until done.
+
+        The copies will not be deleted before release is called with them.
+
+        """
+        for future in self._submit(f_paths, in_use=True):
+            future.result()
+
+    def release(self, f_paths):
+        """ Allow the copies of previously staged files to be deleted. """
+        with self._lock:
+            for f_path in f_paths:
+                if self._in_use[f_path] <= 0:
+                    raise ValueError("{} is not staged".format(f_path))
+                self._in_use[f_path] -= 1
+                if self._in_use[f_path] == 0:
+                    del self._in_use[f_path]
+
+    def prefetch(self, f_paths):
+        """ Start copying the given files in the background. """
+        self._submit(f_paths, in_use=False)
+
+    def close(self):
+        """ Stop the background thread after all current copies are done. """
+        self._queue.put(None)
+        self._thread.join()
+
+    def _submit(self, f_paths, in_use):
+        futures = []
+        with self._lock:
+            if in_use:
+                self._in_use.update(f_paths)
+            for f_path in f_paths:
+                if f_path in self._staged:
+                    self._staged.move_to_end(f_path)
+                    continue
+                if f_path not in self._jobs:
+                    self._jobs[f_path] = Future()
+                    self._queue.put(f_path)
+                futures.append(self._jobs[f_path])
+        return futures
+
+    def _run(self):
+        while True:
+            f_path = self._queue.get()
+            if f_path is None:
+                return
+            future = self._jobs[f_path]
+            try:
+                size = os.path.getsize(f_path)
+                self._make_space(size)
+                self._copy(f_path, self.get_path(f_path))
+            except Exception as e:
+                with self._lock:
+                    self._jobs.pop(f_path)
+                future.set_exception(e)
+            else:
+                with self._lock:
+                    self._jobs.pop(f_path)
+                    self._staged[f_path] = size
+                future.set_result(self.get_path(f_path))
+
+    def _make_space(self, size):
+        """ Delete old copies until there is space for size bytes. """
+        if self.max_size is None:
+            return
+        with self._lock:
+            used = sum(self._staged.values())
+            for f_path in list(self._staged):
+                if used + size <= self.max_size:
+                    break
+                if f_path in self._in_use:
+                    continue
+                print("Removing", self.get_path(f_path), "from local tmpdir")
+                os.remove(self.get_path(f_path))
+                used -= self._staged.pop(f_path)
+        if used + size > self.max_size:
+            warnings.warn("Files on local tmpdir take up more space than "
+                          "allowed by scratch_max_size")
+
+    def _copy(self, f_path, target):
+        """ Copy a file, unless an identical copy exists already. """
+        if os.path.exists(target):
+            source_stat, target_stat = os.stat(f_path), os.stat(target)
+            if source_stat.st_size == target_stat.st_size and \
+                    source_stat.st_mtime_ns == target_stat.st_mtime_ns:
+                return
+
+        print("Copying", f_path, "\nto", target)
+        for attempt in range(2):
+            temp_target = target + ".part"
+            checksum = 0
+            with open(f_path, "rb") as src, open(temp_target, "wb") as dst:
+                for block in iter(lambda: src.read(2**24), b""):
+                    checksum = zlib.crc32(block, checksum)
+                    dst.write(block)
+            shutil.copystat(f_path, temp_target)
+            if not self.verify or _get_crc32(temp_target) == checksum:
+                os.replace(temp_target, target)
+                return
+            os.remove(temp_target)
+            warnings.warn("Copy of {} is corrupted".format(f_path))
+        raise OSError("Copying {} to {} failed: checksums differ".format(
+            f_path, target))
+
+
+def _get_crc32(path):
+    """ Get the crc32 checksum of a file. """
+    checksum = 0
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(2**24), b""):
+            checksum = zlib.crc32(block, checksum)
+    return checksum
+
+
 def use_local_tmpdir(files):
     """
     Copies given files to the local temp folder.
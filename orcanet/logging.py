@@ -4,9 +4,18 @@ Scripts for writing the logfiles.
 
 import numpy as np
 import os
+import re
+import threading
+import time
+import h5py
 import keras as ks
 from datetime import datetime
-from shutil import move
+
+# extra columns of the train log files if cfg.train_logger_timing is set
+TIMING_COLUMNS = ("time_batch", "time_fetch", "time_step", "queue_fill",
+                  "samples_per_s")
+# name of the file in the train_log folder for train_logger_format = "h5"
+BINARY_TRAIN_LOG = "train_log.h5"
 
 
 class TrainfileLogger:
@@ -73,6 +82,188 @@ class TrainfileLogger:
         return line, widths
 
 
+class BinaryTrainfileLogger:
+    def __init__(self, log_file, dataset_name, column_names):
+        """
+        For writing the training log into a h5 file.
+
+        Every training log is a dataset in the h5 file, with one
+        float64 field per column. Lines are appended to it when flushing.
+
+        Parameters
+        ----------
+        log_file : str
+            Path to the h5 file.
+        dataset_name : str
+            Name of the dataset of this log, e.g. epoch_1_file_1.
+        column_names : List
+            A list of column names for the file.
+
+        """
+        self.log_file = log_file
+        self.dataset_name = dataset_name
+        self.column_names = column_names
+        self.dtype = np.dtype([(name, "<f8") for name in column_names])
+        self._lines = []
+
+    def level_file(self):
+        """
+        Make an empty dataset. An existing one will be overwritten.
+        """
+        with h5py.File(self.log_file, "a") as f:
+            if self.dataset_name in f:
+                del f[self.dataset_name]
+            f.create_dataset(self.dataset_name, shape=(0, ),
+                             maxshape=(None, ), chunks=(1024, ),
+                             dtype=self.dtype)
+
+    def write_line(self, values):
+        """
+        Store a line with data, which is written to the file with the
+        next flush.
+
+        Parameters
+        ----------
+        values : List
+            The data, in the same order as the column names.
+            n/a is stored as nan.
+
+        """
+        if len(values) != len(self.column_names):
+            raise ValueError("Can not log: Expected {} values, but got "
+                             "{}".format(len(self.column_names), len(values)))
+        self._lines.append(tuple(
+            np.nan if value == "n/a" else float(value) for value in values))
+
+    def flush(self):
+        """ Append the stored lines to the dataset. """
+        if not self._lines:
+            return
+        lines = np.array(self._lines, dtype=self.dtype)
+        with h5py.File(self.log_file, "a") as f:
+            dset = f[self.dataset_name]
+            n_lines = len(dset)
+            dset.resize((n_lines + len(lines), ))
+            dset[n_lines:] = lines
+        self._lines = []
+
+    def close(self):
+        self.flush()
+
+
+def read_binary_train_log(log_file):
+    """
+    Read all training logs from a binary train log file.
+
+    Parameters
+    ----------
+    log_file : str
+        Path to the h5 file.
+
+    Returns
+    -------
+    train_file_data : dict
+        Keys are (epoch, file_no) tuples, values the logs as structured
+        arrays.
+
+    """
+    train_file_data = {}
+    with h5py.File(log_file, "r") as f:
+        for name in f:
+            epoch_file = _get_epoch_file(name)
+            if epoch_file is not None:
+                train_file_data[epoch_file] = f[name][()]
+    return train_file_data
+
+
+def read_txt_train_log(filepath):
+    """
+    Read a log file in the text format (train log or summary file).
+
+    Returns
+    -------
+    file_data : ndarray
+        Structured array with the column names as fields.
+
+    """
+    # TODO suboptimal that n/a gets replaced by np.nan, because this
+    #  means that legitamte, not availble cells can not be distinguished
+    #  from failed 'nan' metric values produced by training.
+    file_data = np.genfromtxt(
+        filepath,
+        names=True,
+        delimiter="|",
+        autostrip=True,
+        comments="--",
+        missing_values="n/a",
+        filling_values=np.nan
+    )
+    return file_data
+
+
+def convert_txt_to_binary_train_log(train_log_folder):
+    """
+    Write all train log files in the text format of a folder into its
+    binary train log file. Existing logs in there are overwritten.
+
+    Parameters
+    ----------
+    train_log_folder : str
+        Path to the train_log folder.
+
+    """
+    log_file = os.path.join(train_log_folder, BINARY_TRAIN_LOG)
+    for file in sorted(os.listdir(train_log_folder)):
+        epoch_file = _get_epoch_file(file, extension=".txt")
+        filepath = os.path.join(train_log_folder, file)
+        if epoch_file is None or os.path.getsize(filepath) == 0:
+            continue
+        file_data = read_txt_train_log(filepath).reshape(-1)
+        logger = BinaryTrainfileLogger(
+            log_file, "epoch_{}_file_{}".format(*epoch_file),
+            file_data.dtype.names)
+        logger.level_file()
+        for line in file_data:
+            logger.write_line(list(line))
+        logger.close()
+
+
+def convert_binary_to_txt_train_log(train_log_folder):
+    """
+    Write all logs in the binary train log file of a folder into train log
+    files in the text format. Existing text files are overwritten.
+
+    Parameters
+    ----------
+    train_log_folder : str
+        Path to the train_log folder.
+
+    """
+    log_file = os.path.join(train_log_folder, BINARY_TRAIN_LOG)
+    for (epoch, file_no), file_data in read_binary_train_log(log_file).items():
+        filepath = os.path.join(
+            train_log_folder, "log_epoch_{}_file_{}.txt".format(epoch, file_no))
+        with open(filepath, "w") as f:
+            logger = TrainfileLogger(f, file_data.dtype.names)
+            logger.level_file()
+            for line in file_data:
+                logger.write_line(
+                    ["n/a" if np.isnan(value) else value for value in line])
+
+
+def _get_epoch_file(name, extension=""):
+    """
+    Get epoch and file number from a train log name like epoch_1_file_2,
+    or None if it is not one.
+
+    """
+    match = re.fullmatch(
+        r"(?:log_)?epoch_(\d+)_file_(\d+)" + re.escape(extension), name)
+    if match is None:
+        return None
+    return int(match.group(1)), int(match.group(2))
+
+
 def gen_line_str(data, widths=None, seperator=" | ", float_precision=4, minimum_cell_width=9):
     """
     Generate a line in nice human readable format,
@@ -151,6 +342,11 @@ def gen_line_cells(data, widths=None, float_precision=4, minimum_cell_width=9):
 class SummaryLogger:
     """
     For writing the summary logfile made during training.
+
+    Lines are appended to the end of the file, and updates of the last
+    line overwrite it in place, so that only the last line has to be
+    read and written, independent of the length of the file.
+
     """
     def __init__(self, orga, model):
         """
@@ -170,7 +366,6 @@ class SummaryLogger:
         self.float_precision = 6
 
         self.logfile_name = orga.cfg.output_folder + 'summary.txt'
-        self.temp_filepath = orga.cfg.output_folder + "/.temp_summary.txt"
         self.orga = orga
 
         self.metric_names = model.metrics_names
@@ -218,22 +413,22 @@ class SummaryLogger:
                 data.append(history_val[metric_name])
 
         # if the epoch is already in the file, its line will get updated
-        update_line = False
-        summary_data = self.orga.history.get_summary_data()
-        if len(summary_data) > 0:
-            last_line = summary_data[-1]
+        update_offset = None
+        last_line_offset, last_line = self._get_last_line()
+        if last_line is not None:
             # get epoch to same length as it appears in file
             # TODO this is bad, epoch, fileno should probably be in the
             #  summary.txt in their own columns
             data[0] = float(self._gen_line_cells(data, widths)[0][0])
 
-            if last_line["Epoch"] == data[0]:
+            if last_line[0] == data[0]:
                 # merge arrays but ignore LR
                 data = merge_arrays(last_line, data, exclude=1)
-                update_line = True
+                update_offset = last_line_offset
 
         line = self._gen_line_str(data, widths)[0]
-        self._save_line(line, update_line)
+        self._save_line(line, update_offset)
+        self.orga.history.clear_cache()
 
     def _get_column_names(self):
         column_names = ["Epoch", "LR", ]
@@ -254,28 +449,57 @@ class SummaryLogger:
 
         return column_names
 
-    def _save_line(self, line, update=False):
-        """ Write a line in the summary file. If update, overwrite the last line.
+    def _save_line(self, line, update_offset=None):
+        """
+        Write a line in the summary file. If update_offset is given,
+        overwrite the last line, which starts at this byte in the file.
         """
-        if not update:
+        if update_offset is None:
             with open(self.logfile_name, 'a+') as logfile:
                 logfile.write(line + "\n")
 
         else:
-            # replace last line by rewriting whole summary file :-(
-            with open(self.logfile_name, "r") as old_file:
-                lines = old_file.readlines()
-            lines[-1] = line + "\n"
+            with open(self.logfile_name, "r+b") as logfile:
+                logfile.seek(update_offset)
+                logfile.write((line + "\n").encode())
+                logfile.truncate()
 
-            # make new summary file as a temp
-            with open(self.temp_filepath, 'w') as temp_file:
-                for old_line in lines:
-                    temp_file.write(old_line)
+    def _get_last_line(self, block_size=4096):
+        """
+        Read the last line of the summary file by reading blocks backwards
+        from its end.
+
+        Returns
+        -------
+        offset : int
+            The byte in the file at which the last line starts.
+        values : List or None
+            The values in the last line as floats (n/a is nan), or None
+            if there is no line with data yet.
 
-            # Remove original file
-            os.remove(self.logfile_name)
-            # Move new file
-            move(self.temp_filepath, self.logfile_name)
+        """
+        with open(self.logfile_name, "rb") as logfile:
+            end = logfile.seek(0, os.SEEK_END)
+            pos, tail = end, b""
+            offset = 0
+            while pos > 0:
+                step = min(block_size, pos)
+                pos -= step
+                logfile.seek(pos)
+                tail = logfile.read(step) + tail
+                # ignore the newline at the end of the file
+                newline = tail.rfind(b"\n", 0, len(tail) - 1)
+                if newline != -1:
+                    offset = pos + newline + 1
+                    tail = tail[newline + 1:]
+                    break
+
+        cells = [cell.strip() for cell in tail.decode().split("|")]
+        if cells[0].startswith("-") or cells[0] == self.column_names[0]:
+            # only the head of the file
+            return offset, None
+        values = [np.nan if cell == "n/a" else float(cell) for cell in cells]
+        return offset, values
 
     def _init_writing(self):
         """
@@ -369,8 +593,25 @@ class BatchLogger(ks.callbacks.Callback):
     of the batch in the epoch (i.e. taking all files into account).
     This class is intended to be used only for one epoch = one file.
 
+    If cfg.train_logger_timing is set, the TIMING_COLUMNS are added to
+    the logfiles: The wall time per batch in s, how long getting a batch
+    from the generator took (time_fetch), the time in the train step, the
+    average number of batches the generator had read ahead, and the
+    samples per second. A summary of these is written to the log.txt at
+    the end.
+    The generator has to be wrapped with time_generator for measuring
+    time_fetch, since the batches are usually fetched inside of the train
+    step. time_fetch is measured where the batches are requested from the
+    generator: With the queue of keras (max_queue_size > 0), this happens
+    in its background threads, so it is the time the generator needs for
+    a batch, and not how long the training waited for it. If the
+    generator is not wrapped, the time between the train steps is used.
+
+    If cfg.train_logger_format is "h5", the logs are written into one
+    h5 file in the train_log folder instead of one text file each.
+
     """
-    def __init__(self, orga, epoch):
+    def __init__(self, orga, epoch, generator=None, n_workers=1):
         """
 
         Parameters
@@ -379,20 +620,39 @@ class BatchLogger(ks.callbacks.Callback):
             Contains all the configurable options in the OrcaNet scripts.
         epoch : tuple
             Epoch and file number.
+        generator : object, optional
+            The generator used for training. Only for logging the timing:
+            If it has the attribute n_ready (the number of batches it has
+            read ahead), its average is logged.
+        n_workers : int
+            Number of workers in distributed training, which each train
+            on a different batch in every step.
 
         """
         ks.callbacks.Callback.__init__(self)
 
         self.epoch_number = epoch[0]
         self.f_number = epoch[1]
+        self.generator = generator
 
         # settings (read from orga)
         self.display = orga.cfg.train_logger_display
         self.flush = orga.cfg.train_logger_flush
-        self.logfile_name = '{}/log_epoch_{}_file_{}.txt'.format(
-            orga.io.get_subfolder("train_log", create=True),
-            self.epoch_number, self.f_number)
-        self.batchsize = orga.cfg.batchsize
+        self.timing = orga.cfg.train_logger_timing
+        self.print_log = orga.io.print_log
+        self.log_format = orga.cfg.train_logger_format
+        train_log_folder = orga.io.get_subfolder("train_log", create=True)
+        if self.log_format == "txt":
+            self.logfile_name = '{}/log_epoch_{}_file_{}.txt'.format(
+                train_log_folder, self.epoch_number, self.f_number)
+        elif self.log_format == "h5":
+            self.logfile_name = os.path.join(train_log_folder,
+                                             BINARY_TRAIN_LOG)
+        else:
+            raise ValueError("Unknown train_logger_format {}, must be 'txt' "
+                             "or 'h5'".format(self.log_format))
+        # samples per step of all workers together
+        self.batchsize = orga.cfg.batchsize * n_workers
         self.file_sizes = np.array(orga.io.get_file_sizes("train"))
 
         # get the total no of batches over all files (not just the current one)
@@ -413,6 +673,37 @@ class BatchLogger(ks.callbacks.Callback):
         self.file = None
         self._stored_metrics = False
         self._logger = None
+        # for the timing: summed up times of the current display window,
+        # and of the whole file
+        self._window = None
+        self._total = None
+        self._last_end = None
+        self._batch_start = None
+        self._fetch_timer = None
+
+    def time_generator(self, generator):
+        """
+        Measure how long getting the batches from a generator takes,
+        in the thread that requests them.
+
+        Parameters
+        ----------
+        generator : keras Sequence or iterable
+            The generator to train on.
+
+        Returns
+        -------
+        generator : keras Sequence or iterator
+            The generator to train on instead. The generator itself if
+            cfg.train_logger_timing is False.
+
+        """
+        if not self.timing:
+            return generator
+        self._fetch_timer = _FetchTimer()
+        if isinstance(generator, ks.utils.Sequence):
+            return _TimedSequence(generator, self._fetch_timer)
+        return _timed_iterator(generator, self._fetch_timer)
 
     def on_epoch_begin(self, epoch, logs=None):
         # no of seen batches in this epoch
@@ -423,8 +714,17 @@ class BatchLogger(ks.callbacks.Callback):
         self.cum_metrics = {}
         for metric in self.model.metrics_names:
             self.cum_metrics[metric] = 0
-        self.file = open(self.logfile_name, "w")
+        if self.log_format == "txt":
+            self.file = open(self.logfile_name, "w")
         self._write_head()
+        if self.timing:
+            self._window = _new_timing()
+            self._total = _new_timing()
+            self._last_end = time.perf_counter()
+
+    def on_batch_begin(self, batch, logs=None):
+        if self.timing:
+            self._batch_start = time.perf_counter()
 
     def on_batch_end(self, batch, logs=None):
         # self.params:
@@ -435,6 +735,8 @@ class BatchLogger(ks.callbacks.Callback):
         #   {'batch': 7, 'size': 5, 'loss': 2.06344,
         #    'dx_loss': 0.19809794, 'dx_err_loss': 0.08246058}
         logs = logs or {}
+        if self.timing:
+            self._add_timing()
 
         self.seen += 1
         for metric in self.model.metrics_names:
@@ -456,7 +758,12 @@ class BatchLogger(ks.callbacks.Callback):
             # write stats of remaining batches
             self._write_line()
         """
-        self.file.close()
+        if self.log_format == "txt":
+            self.file.close()
+        else:
+            self._logger.close()
+        if self.timing and self._total["batches"] > 0:
+            self._log_timing_summary()
 
     def _write_line(self):
         """ Write a line with the metrics for current status and reset metrics.
@@ -471,21 +778,154 @@ class BatchLogger(ks.callbacks.Callback):
         for metric in self.model.metrics_names:
             line_data.append(self.cum_metrics[metric] / self.display)
             self.cum_metrics[metric] = 0
+        if self.timing:
+            line_data.extend(_get_timing_values(self._window))
+            self._window = _new_timing()
         self._logger.write_line(line_data)
         self._stored_metrics = False
 
     def _flush_file(self):
-        self.file.flush()
-        os.fsync(self.file.fileno())
+        if self.log_format == "txt":
+            self.file.flush()
+            os.fsync(self.file.fileno())
+        else:
+            self._logger.flush()
 
     def _write_head(self):
         """ write column names for all losses / metrics """
         column_names = ['Batch', 'Batch_float']
         for metric in self.model.metrics_names:
             column_names.append(metric)
-        self._logger = TrainfileLogger(self.file, column_names)
+        if self.timing:
+            column_names.extend(TIMING_COLUMNS)
+        if self.log_format == "txt":
+            self._logger = TrainfileLogger(self.file, column_names)
+        else:
+            self._logger = BinaryTrainfileLogger(
+                self.logfile_name,
+                "epoch_{}_file_{}".format(self.epoch_number, self.f_number),
+                column_names)
         self._logger.level_file()
 
+    def _add_timing(self):
+        """ Add the times of the batch that just ended. """
+        now = time.perf_counter()
+        batch_start = self._batch_start
+        if batch_start is None:
+            batch_start = self._last_end
+        n_ready = getattr(self.generator, "n_ready", None)
+        if self._fetch_timer is None:
+            # assume that the batch was fetched between the train steps
+            fetch = batch_start - self._last_end
+        else:
+            fetch, n_fetched = self._fetch_timer.pop()
+            if n_ready is None:
+                # e.g. in the queue of keras
+                n_ready = max(n_fetched - self._total["batches"] - 1, 0)
+        for timing in (self._window, self._total):
+            timing["batches"] += 1
+            timing["samples"] += self.batchsize
+            timing["wall"] += now - self._last_end
+            timing["fetch"] += fetch
+            timing["step"] += now - batch_start
+            if n_ready is not None:
+                timing["queue"] += n_ready
+                timing["queue_batches"] += 1
+        self._last_end = now
+        self._batch_start = None
+
+    def _log_timing_summary(self):
+        """ Write the timing of the whole file to the log.txt. """
+        total = self._total
+        time_batch, time_fetch, time_step, queue_fill, samples_per_s = \
+            _get_timing_values(total)
+        self.print_log("Timing: {:.2f} ms per batch ({:.2f} ms to get it "
+                       "from the generator, {:.1%} in the train step), "
+                       "{:.1f} samples/s".format(1000 * time_batch,
+                                                 1000 * time_fetch,
+                                                 time_step / time_batch,
+                                                 samples_per_s))
+        if queue_fill != "n/a":
+            self.print_log("Average batches read ahead by the generator: "
+                           "{:.2f}".format(queue_fill))
+
+
+class _FetchTimer:
+    """
+    Sums up the time spent getting batches from a generator for the
+    BatchLogger. Batches can be fetched in other threads, e.g. by keras.
+
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._time = 0.
+        self._n_batches = 0
+
+    def add(self, seconds):
+        """ Add the time it took to get one batch. """
+        with self._lock:
+            self._time += seconds
+            self._n_batches += 1
+
+    def pop(self):
+        """ Get the time since the last pop, and the total no of batches. """
+        with self._lock:
+            seconds, self._time = self._time, 0.
+            return seconds, self._n_batches
+
+
+class _TimedSequence(ks.utils.Sequence):
+    """ A keras Sequence, whose time to get each batch is measured. """
+    def __init__(self, sequence, fetch_timer):
+        self.sequence = sequence
+        self.fetch_timer = fetch_timer
+
+    def __len__(self):
+        return len(self.sequence)
+
+    def __getitem__(self, index):
+        start = time.perf_counter()
+        batch = self.sequence[index]
+        self.fetch_timer.add(time.perf_counter() - start)
+        return batch
+
+    def on_epoch_end(self):
+        self.sequence.on_epoch_end()
+
+
+def _timed_iterator(iterable, fetch_timer):
+    """ Iterate over something, and measure the time to get each item. """
+    iterator = iter(iterable)
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        fetch_timer.add(time.perf_counter() - start)
+        yield item
+
+
+def _new_timing():
+    """ Summed up times of some batches for the BatchLogger. """
+    return {"batches": 0, "samples": 0, "wall": 0., "fetch": 0., "step": 0.,
+            "queue": 0, "queue_batches": 0}
+
+
+def _get_timing_values(timing):
+    """ Get the values of the TIMING_COLUMNS from the summed up times. """
+    n_batches = max(timing["batches"], 1)
+    if timing["queue_batches"] > 0:
+        queue_fill = timing["queue"] / timing["queue_batches"]
+    else:
+        queue_fill = "n/a"
+    if timing["wall"] > 0:
+        samples_per_s = timing["samples"] / timing["wall"]
+    else:
+        samples_per_s = "n/a"
+    return [timing["wall"] / n_batches, timing["fetch"] / n_batches,
+            timing["step"] / n_batches, queue_fill, samples_per_s]
+
 
 def log_start_training(orga):
     """
@@ -1,6 +1,8 @@
+from functools import partial
 from unittest import TestCase
-from unittest.mock import MagicMock
+from unittest.mock import MagicMock, patch
 import os
+import time
 import warnings
 import shutil
 import h5py
@@ -9,8 +11,12 @@ import keras as ks
 import keras.layers as layers
 
 from orcanet.core import Organizer
-from orcanet.backend import get_datasets, train_model, validate_model, make_model_prediction, weighted_average
+from orcanet.in_out import IOHandler
+from orcanet.backend import get_datasets, train_model, validate_model, make_model_prediction, weighted_average, PredictionWriter, \
+    parallel_validation, get_row_ranges
 from orcanet.utilities.nn_utilities import get_auto_label_modifier
+from orcanet.h5_generator import get_n_buffers, get_shuffle_buffer, \
+    Hdf5BatchGenerator
 
 
 class TestFunctions(TestCase):
@@ -59,6 +65,50 @@ class TestFunctions(TestCase):
 
         self.assertSequenceEqual(averaged_histories, target)
 
+    def test_prediction_writer(self):
+        temp_dir = os.path.join(os.path.dirname(__file__), ".temp")
+        os.makedirs(temp_dir, exist_ok=True)
+        path = os.path.join(temp_dir, "test_prediction_writer.h5")
+
+        y_values = np.arange(10).astype([("mc_A", "<f8"), ("mc_B", "<i4")])
+        pred = np.arange(20, dtype="float32").reshape((10, 2))
+        try:
+            with h5py.File(path, "w") as f:
+                writer = PredictionWriter(
+                    f, n_rows=10,
+                    dataset_modifier=lambda info_blob: {
+                        "y_values": info_blob["y_values"],
+                        "pred": info_blob["pred"],
+                        # one row per batch, does not fit the chunks
+                        "n_samples": np.array([len(info_blob["pred"])]),
+                    })
+                for start in range(0, 10, 4):
+                    writer.put({"y_values": y_values[start:start + 4],
+                                "pred": pred[start:start + 4]})
+                writer.finish()
+                writer.close()
+
+            with h5py.File(path, "r") as f:
+                np.testing.assert_array_equal(f["y_values"][()], y_values)
+                np.testing.assert_array_equal(f["pred"][()], pred)
+                np.testing.assert_array_equal(f["n_samples"][()], [4, 4, 2])
+                self.assertEqual(f["pred"].compression, "gzip")
+        finally:
+            os.remove(path)
+
+    def test_prediction_writer_error(self):
+        def dataset_modifier(info_blob):
+            raise ValueError("modifier failed")
+
+        with h5py.File("in_memory.h5", "w", driver="core",
+                       backing_store=False) as f:
+            writer = PredictionWriter(f, n_rows=10,
+                                      dataset_modifier=dataset_modifier)
+            writer.put({})
+            with self.assertRaises(ValueError):
+                writer.finish()
+            writer.close()
+
     def test_weighted_average_one_file(self):
         # metrics [A, B, C]
         histories = [
@@ -112,6 +162,82 @@ class TestFunctions(TestCase):
 
         self.assertSequenceEqual(averaged_histories, target)
 
+    def test_get_row_ranges(self):
+        # 3 parts: one file with 4 batches, one with 2 and a half
+        row_ranges = get_row_ranges([20, 12], 5, 5)
+        self.assertEqual(row_ranges, [
+            [(0, 5), (5, 5), (10, 10)],
+            [(0, 5), (5, 5), (10, 2)],
+        ])
+        # enough files
+        self.assertEqual(get_row_ranges([20, 12], 2, 5),
+                         [[(0, 20)], [(0, 12)]])
+        self.assertEqual(get_row_ranges([], 2, 5), [])
+
+
+class TestParallelValidation(TestCase):
+    def setUp(self):
+        self.temp_dir = os.path.join(os.path.dirname(__file__), ".temp",
+                                     "test_parallel_validation")
+        os.makedirs(self.temp_dir)
+        input_shapes = {"input_A": (2, 3), "input_B": (3, 4)}
+        list_file = os.path.join(self.temp_dir, "list.toml")
+        with open(list_file, "w") as f:
+            for input_key, shape in input_shapes.items():
+                paths = []
+                for file_no, size in enumerate((23, 12)):
+                    path = os.path.join(
+                        self.temp_dir, "{}_{}.h5".format(input_key, file_no))
+                    save_dummy_h5py(path, shape, size, mode="asc")
+                    paths.append(path)
+                f.write("[{}]\ntrain_files = {}\nvalidation_files = {}\n"
+                        "".format(input_key, paths[:1], paths))
+
+        self.orga = Organizer(self.temp_dir, list_file=list_file)
+        self.orga.cfg.batchsize = 5
+        self.orga.cfg.verbose_val = 0
+        self.model = build_dummy_model(input_shapes, {"mc_A": 1, "mc_B": 1})
+        self.model.compile(loss="mse", optimizer="sgd")
+        self.orga.io.get_subfolder("saved_models", create=True)
+        self.model.save(self.orga.io.get_model_path(1, 1))
+        self.orga._set_up(self.model)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_parallel_validation(self):
+        self.orga.cfg.validation_processes = 3
+        history = parallel_validation(self.orga, 1, 1)
+        target = validate_model(self.orga, self.model)
+        self.assertCountEqual(history.keys(), target.keys())
+        for key, value in target.items():
+            np.testing.assert_allclose(history[key], value, rtol=1e-5)
+
+    def test_parallel_validation_stages_files_per_job(self):
+        # one job per file, and one at a time
+        self.orga.cfg.validation_processes = 1
+        get_file, release_files = IOHandler.get_file, IOHandler.release_files
+        n_staged = []
+
+        def stage(io, *args):
+            n_staged.append(n_staged[-1] + 1 if n_staged else 1)
+            return get_file(io, *args)
+
+        def release(io, files_dict):
+            n_staged.append(n_staged[-1] - 1)
+            return release_files(io, files_dict)
+
+        with patch.object(IOHandler, "get_file", stage), \
+                patch.object(IOHandler, "release_files", release):
+            parallel_validation(self.orga, 1, 1)
+        self.assertEqual(n_staged, [1, 0, 1, 0])
+
+    def test_parallel_validation_no_files(self):
+        self.orga.cfg.validation_processes = 3
+        self.orga.io.get_file_sizes = MagicMock(return_value=[])
+        with self.assertRaises(ValueError):
+            parallel_validation(self.orga, 1, 1)
+
 
 class TestTrainValidatePredict(TestCase):
     @classmethod
@@ -192,6 +318,30 @@ class TestTrainValidatePredict(TestCase):
         assert_dict_arrays_equal(history, target, rtol=1e-1)
         self.assertSequenceEqual(batch_nos, list(range(int(self.file_sizes[0]/self.orga.cfg.batchsize))))
 
+    def test_train_failure_closes_generator(self):
+        def fail(batch, logs):
+            raise ValueError("failed")
+        self.orga.cfg.callback_train = ks.callbacks.LambdaCallback(
+            on_batch_begin=fail)
+        with patch.object(Hdf5BatchGenerator, "close", autospec=True,
+                          side_effect=Hdf5BatchGenerator.close) as close:
+            with self.assertRaises(ValueError):
+                train_model(self.orga, self.model, (1, 1))
+        close.assert_called_once()
+
+    def test_shuffle_buffer_failure_releases_files(self):
+        self.orga.cfg.shuffle_buffer_files = 1
+        self.orga.io.release_files = MagicMock()
+        with patch("orcanet.h5_generator.ShuffleBuffer",
+                   side_effect=ValueError("failed")), \
+                patch.object(Hdf5BatchGenerator, "close", autospec=True,
+                             side_effect=Hdf5BatchGenerator.close) as close:
+            with self.assertRaises(ValueError):
+                get_shuffle_buffer(self.orga, 1)
+        close.assert_called_once()
+        self.orga.io.release_files.assert_called_once_with(
+            {key: paths[0] for key, paths in self.filepaths.items()})
+
     def test_validate(self):
         history = validate_model(self.orga, self.model)
         # input to model is ones
@@ -207,6 +357,27 @@ class TestTrainValidatePredict(TestCase):
         self.model.summary()
         self.assertDictEqual(history, target)
 
+    def test_validate_partial_batches_per_file(self):
+        # two val files with 13 and 7 samples --> batches of 9, 4 and 7
+        self.orga.io.get_local_files = MagicMock(return_value={
+            input_key: paths * 2 for input_key, paths in self.filepaths.items()})
+        self.orga.io.get_file_sizes = MagicMock(return_value=[13, 7])
+        self.orga.io.print_log = MagicMock()
+        model = MagicMock(metrics_names=["loss", "n"])
+        # loss is 1 for file 1 and 2 for file 2, n is the batch size
+        losses = iter([1., 1., 2.])
+        model.test_on_batch.side_effect = lambda xs, ys: [
+            next(losses), len(xs["input_A"])]
+
+        history = validate_model(self.orga, model)
+        self.assertEqual(model.test_on_batch.call_count, 3)
+        self.assertAlmostEqual(history["loss"], (13 + 2 * 7) / 20)
+        self.assertAlmostEqual(history["n"], (9**2 + 4**2 + 7**2) / 20)
+        logged = "\n".join(
+            call[0][0] for call in self.orga.io.print_log.call_args_list)
+        self.assertIn("File 1 (13 samples): loss: 1, n: 7.462", logged)
+        self.assertIn("File 2 (7 samples): loss: 2, n: 7", logged)
+
     def test_predict(self):
         # dummy values
         epoch, fileno = 1, 3
@@ -253,6 +424,99 @@ class TestTrainValidatePredict(TestCase):
             target = contents_dict[key]
             np.testing.assert_array_equal(value, target)
 
+    def test_predict_slow_writer_reused_labels(self):
+        # the labels are written into reused arrays, which must not be
+        # overwritten before the writer is done with them
+        epoch, fileno = 1, 3
+        self.orga.cfg.max_queue_size = 2
+        self.orga.cfg.label_modifier = CountingLabelModifier(
+            get_n_buffers(self.orga))
+        # compress slower than the model predicts, so that the writer
+        # falls behind
+        compress = PredictionWriter._compress
+
+        def slow_compress(writer, *args):
+            time.sleep(0.05)
+            return compress(writer, *args)
+
+        try:
+            with patch.object(PredictionWriter, "_compress", slow_compress):
+                make_model_prediction(self.orga, self.model, epoch, fileno,
+                                      samples=20 * self.orga.cfg.batchsize)
+            with h5py.File(self.pred_filepath, 'r') as file:
+                labels = file["label_mc_A"][()]
+        finally:
+            os.remove(self.pred_filepath)
+        batchsize = self.orga.cfg.batchsize
+        np.testing.assert_array_equal(
+            labels, np.arange(len(labels)) // batchsize)
+
+    def test_predict_parallel(self):
+        epoch, fileno = 1, 3
+        self.orga.cfg.inference_processes = 2
+        # the orga is pickled for the spawned workers, so no MagicMocks.
+        # The workers load the model with load_saved_model.
+        self.orga.io.get_local_files = partial(return_value, self.filepaths)
+        self.orga.io.get_file_sizes = partial(return_value, self.file_sizes)
+        self.orga.cfg.get_list_file = partial(
+            return_value, '/path/to/a/listfilename.toml')
+        self.orga.io.get_next_pred_path = partial(
+            return_value, self.pred_filepath)
+        self.orga.load_saved_model = partial(
+            return_value, ConstantModel(["mc_A", "mc_B"], 18))
+
+        try:
+            make_model_prediction(self.orga, None, epoch, fileno)
+            self.assertFalse(os.path.exists(self.pred_filepath + ".tmp"))
+            with h5py.File(self.pred_filepath, 'r') as file:
+                np.testing.assert_array_equal(
+                    file["pred_mc_A"][()], np.ones((500, 1)) * 18)
+                np.testing.assert_array_equal(
+                    file["y_values"][()], self.train_A_file_1_ctnt[1])
+
+            # existing files are skipped
+            modified = os.path.getmtime(self.pred_filepath)
+            make_model_prediction(self.orga, None, epoch, fileno)
+            self.assertEqual(modified, os.path.getmtime(self.pred_filepath))
+        finally:
+            if os.path.exists(self.pred_filepath):
+                os.remove(self.pred_filepath)
+
+
+class CountingLabelModifier:
+    """ Label every sample with the number of its batch, written into
+    n_buffers arrays in turn. """
+    def __init__(self, n_buffers):
+        self.buffers = [{} for i in range(n_buffers)]
+        self.batch_no = 0
+
+    def __call__(self, info_blob):
+        n_samples = len(info_blob["y_values"])
+        buffer = self.buffers[self.batch_no % len(self.buffers)]
+        for name in ("mc_A", "mc_B"):
+            if name not in buffer or len(buffer[name]) != n_samples:
+                buffer[name] = np.empty(n_samples)
+            buffer[name][:] = self.batch_no
+        self.batch_no += 1
+        return buffer
+
+
+def return_value(value, *args, **kwargs):
+    """ Picklable stand-in for MagicMock(return_value=value). """
+    return value
+
+
+class ConstantModel:
+    """ Stand-in for a keras model that always predicts the same value. """
+    def __init__(self, output_names, value):
+        self.output_names = output_names
+        self.value = value
+
+    def predict_on_batch(self, xs):
+        n_samples = len(list(xs.values())[0])
+        return [np.full((n_samples, 1), self.value, dtype="float32")
+                for _ in self.output_names]
+
 
 def save_dummy_h5py(path, shape, size, mode="asc"):
     """
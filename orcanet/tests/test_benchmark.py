@@ -0,0 +1,58 @@
+import os
+import json
+import shutil
+from unittest import TestCase
+import h5py
+
+from orcanet.core import Organizer
+from orcanet.utilities.benchmark import PipelineBenchmark, make_synthetic_file
+
+
+class TestPipelineBenchmark(TestCase):
+    def setUp(self):
+        self.temp_dir = os.path.join(os.path.dirname(__file__), ".temp",
+                                     "benchmark")
+        if os.path.exists(self.temp_dir):
+            shutil.rmtree(self.temp_dir)
+        os.makedirs(self.temp_dir)
+        self.orga = Organizer(self.temp_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_make_synthetic_file(self):
+        path = os.path.join(self.temp_dir, "synthetic.h5")
+        make_synthetic_file(path, 10, (2, 3), compression="gzip:1",
+                            chunk_rows=4, n_fields=5)
+        with h5py.File(path, "r") as f:
+            self.assertEqual(f["x"].shape, (10, 2, 3))
+            self.assertEqual(f["x"].chunks, (4, 2, 3))
+            self.assertEqual(f["x"].compression, "gzip")
+            self.assertEqual(f["x"].compression_opts, 1)
+            self.assertEqual(len(f["y"].dtype.names), 5)
+
+    def test_run_synthetic(self):
+        self.orga.cfg.sample_modifier = sample_modifier
+        benchmark = PipelineBenchmark(
+            self.orga, batchsizes=[4, 8], shuffles=[False, "chunks"],
+            workers=[0, 1], compressions=[None, "lzf"],
+            synthetic_shape=(2, 3), synthetic_samples=20, n_batches=3)
+        records = benchmark.run()
+        self.assertEqual(len(records), 16)
+        for record in records:
+            self.assertEqual(record["n_batches"], 3)
+            self.assertGreater(record["samples_per_s"], 0)
+            if record["workers"] == 0:
+                self.assertGreater(record["sample_modifier_s"], 0)
+            else:
+                self.assertNotIn("read_s", record)
+
+        path = os.path.join(self.temp_dir, "report.json")
+        benchmark.save(records, path)
+        with open(path) as f:
+            report = json.load(f)
+        self.assertEqual(report["records"], records)
+
+
+def sample_modifier(info_blob):
+    return {"input": info_blob["x_values"]["input"] * 2}
@@ -0,0 +1,304 @@
+import os
+import shutil
+import socket
+import sys
+import threading
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+import numpy as np
+import keras as ks
+
+from orcanet.core import Organizer
+from orcanet.backend import train_model
+from orcanet.distributed import (
+    Communicator, DistributedTrainStep, get_shard, launch)
+from orcanet.utilities.nn_utilities import get_auto_label_modifier
+from orcanet.tests.test_backend import build_dummy_model, save_dummy_h5py
+
+
+def get_free_port():
+    with socket.socket() as sock:
+        sock.bind(("", 0))
+        return sock.getsockname()[1]
+
+
+def run_workers(function, world_size):
+    """ Run function(comm) in one thread per rank and return the results. """
+    port = get_free_port()
+    results, errors = [None] * world_size, []
+
+    def work(rank):
+        try:
+            comm = Communicator(rank, world_size, master_port=port,
+                                timeout=30)
+            try:
+                results[rank] = function(comm)
+            finally:
+                comm.close()
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=work, args=(rank, ))
+               for rank in range(world_size)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(60)
+    if errors:
+        raise errors[0]
+    return results
+
+
+class TestCommunicator(TestCase):
+    def test_allreduce(self):
+        def function(comm):
+            # fewer elements than workers as well
+            return [comm.allreduce(np.arange(7.) * (comm.rank + 1)),
+                    comm.allreduce(np.full((2, 1), comm.rank, dtype="int64"),
+                                   average=False)]
+
+        for result in run_workers(function, 3):
+            np.testing.assert_array_equal(result[0], np.arange(7.) * 2)
+            np.testing.assert_array_equal(result[1], [[3], [3]])
+            self.assertEqual(result[1].dtype, np.int64)
+
+    def test_broadcast_and_barrier(self):
+        def function(comm):
+            comm.barrier()
+            return comm.broadcast(np.full(5, comm.rank, dtype="float32"),
+                                  root=1)
+
+        for result in run_workers(function, 3):
+            np.testing.assert_array_equal(result, np.ones(5))
+
+    def test_single_worker(self):
+        comm = Communicator(0, 1)
+        np.testing.assert_array_equal(comm.allreduce([1., 2.]), [1., 2.])
+        comm.barrier()
+        comm.close()
+
+    def test_get_shard(self):
+        comms = [MagicMock(rank=rank, world_size=3) for rank in range(3)]
+        # 10 batches --> 3 per worker
+        shards = [get_shard(50, 5, comm) for comm in comms]
+        self.assertEqual(shards, [(0, 15), (15, 15), (30, 15)])
+        with self.assertRaises(ValueError):
+            get_shard(10, 5, comms[0])
+
+
+class TestDistributedTrainStep(TestCase):
+    def get_model(self):
+        ks.utils.set_random_seed(42)
+        inp = ks.Input((4, ))
+        x = ks.layers.Dense(3, activation="relu")(inp)
+        model = ks.Model(inp, ks.layers.Dense(2)(x))
+        model.compile(loss="mse", optimizer=ks.optimizers.SGD(0.1))
+        return model
+
+    def test_same_as_concatenated_batch(self):
+        # one step on two workers with half a batch each is one step
+        # of a single worker on the whole batch
+        rng = np.random.default_rng(0)
+        xs = rng.normal(size=(8, 4)).astype("float32")
+        ys = rng.normal(size=(8, 2)).astype("float32")
+        models = [self.get_model() for rank in range(2)]
+        target = self.get_model()
+        target_loss = target.train_on_batch(xs, ys)
+
+        def function(comm):
+            train_step = DistributedTrainStep(models[comm.rank], comm)
+            train_step.sync_weights()
+            shard = slice(comm.rank * 4, (comm.rank + 1) * 4)
+            return train_step(xs[shard], ys[shard])
+
+        for logs, model in zip(run_workers(function, 2), models):
+            self.assertAlmostEqual(logs["loss"], target_loss, places=5)
+            for weights, target_weights in zip(model.get_weights(),
+                                               target.get_weights()):
+                np.testing.assert_allclose(weights, target_weights,
+                                           rtol=1e-5, atol=1e-6)
+
+    def test_sync_non_trainable(self):
+        # every worker sees different batches, so the moving statistics
+        # of the batchnorm differ until they are synced
+        rng = np.random.default_rng(0)
+        xs = rng.normal(size=(2, 8, 4)).astype("float32")
+        ys = rng.normal(size=(8, 2)).astype("float32")
+        models = []
+        for rank in range(2):
+            ks.utils.set_random_seed(42)
+            inp = ks.Input((4, ))
+            x = ks.layers.BatchNormalization()(inp)
+            model = ks.Model(inp, ks.layers.Dense(2)(x))
+            model.compile(loss="mse", optimizer=ks.optimizers.SGD(0.1))
+            models.append(model)
+
+        def function(comm):
+            train_step = DistributedTrainStep(models[comm.rank], comm)
+            train_step.sync_weights()
+            train_step(xs[comm.rank] + comm.rank, ys)
+            before = [w.numpy() for w in
+                      models[comm.rank].non_trainable_weights]
+            train_step.sync_non_trainable()
+            return before
+
+        before = run_workers(function, 2)
+        self.assertFalse(np.allclose(before[0][0], before[1][0]))
+        for weights_0, weights_1, before_0, before_1 in zip(
+                models[0].non_trainable_weights,
+                models[1].non_trainable_weights, *before):
+            np.testing.assert_array_equal(weights_0.numpy(), weights_1.numpy())
+            np.testing.assert_allclose(
+                weights_0.numpy(), (before_0 + before_1) / 2, rtol=1e-6)
+
+
+class TestLaunch(TestCase):
+    def setUp(self):
+        self.temp_dir = os.path.join(os.path.dirname(__file__), ".temp",
+                                     "test_launch")
+        os.makedirs(self.temp_dir, exist_ok=True)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_launch(self):
+        script = os.path.join(self.temp_dir, "script.py")
+        with open(script, "w") as f:
+            f.write(
+                "import sys\n"
+                "sys.path.insert(0, {!r})\n"
+                "import numpy as np\n"
+                "from orcanet.distributed import get_communicator\n"
+                "comm = get_communicator()\n"
+                "total = comm.allreduce(np.array([comm.rank + 1.]), "
+                "average=False)\n"
+                "with open(sys.argv[1] + str(comm.rank), 'w') as f:\n"
+                "    f.write('{{}} {{}}'.format(comm.world_size, total[0]))\n"
+                "".format(os.path.dirname(os.path.dirname(os.path.dirname(
+                    os.path.abspath(__file__))))))
+        prefix = os.path.join(self.temp_dir, "out_")
+        returncode = launch([sys.executable, script, prefix], n_processes=2,
+                            master_port=get_free_port())
+        self.assertEqual(returncode, 0)
+        for rank in range(2):
+            with open(prefix + str(rank)) as f:
+                self.assertEqual(f.read(), "2 3.0")
+
+    def test_launch_failure(self):
+        returncode = launch(
+            [sys.executable, "-c", "import os, sys, time\n"
+             "if os.environ['ORCANET_RANK'] == '1': sys.exit(3)\n"
+             "time.sleep(60)"],
+            n_processes=2, master_port=get_free_port())
+        self.assertEqual(returncode, 3)
+
+
+class TestTrainDistributed(TestCase):
+    def setUp(self):
+        self.temp_dir = os.path.join(os.path.dirname(__file__), ".temp",
+                                     "test_train_distributed")
+        os.makedirs(self.temp_dir, exist_ok=True)
+        self.filepaths = {}
+        for input_key, shape in (("input_A", (2, 3)), ("input_B", (3, 4))):
+            path = os.path.join(self.temp_dir, input_key + ".h5")
+            save_dummy_h5py(path, shape, 50, mode="asc")
+            self.filepaths[input_key] = (path, )
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def get_orga_and_model(self, seed):
+        orga = Organizer(self.temp_dir)
+        orga.cfg.batchsize = 5
+        orga.cfg.verbose_train = 0
+        orga.io.get_local_files = MagicMock(return_value=self.filepaths)
+        orga.io.get_file_sizes = MagicMock(return_value=[50])
+        ks.utils.set_random_seed(seed)
+        model = build_dummy_model(
+            {"input_A": (2, 3), "input_B": (3, 4)}, {"mc_A": 1, "mc_B": 1})
+        model.compile(loss="mse", optimizer=ks.optimizers.Adam(1e-3))
+        orga._auto_label_modifier = get_auto_label_modifier(model)
+        return orga, model
+
+    def test_train_two_workers(self):
+        # different initial weights, which are synced in the training
+        setups = [self.get_orga_and_model(seed) for seed in range(2)]
+        initial_weights = setups[0][1].get_weights()
+
+        def function(comm):
+            orga, model = setups[comm.rank]
+            history = train_model(orga, model, (1, 1), comm=comm)
+            return history, model.get_weights()
+
+        results = run_workers(function, 2)
+        self.assertEqual(results[0][0], results[1][0])
+        self.assertIn("loss", results[0][0])
+        for weights_0, weights_1, initial in zip(
+                results[0][1], results[1][1], initial_weights):
+            np.testing.assert_array_equal(weights_0, weights_1)
+        self.assertFalse(all(np.array_equal(weights, initial) for weights,
+                             initial in zip(results[0][1], initial_weights)))
+
+    def test_train_and_validate_two_workers(self):
+        # two files, so that the train step has to be reused
+        setups = []
+        for seed in range(2):
+            orga, model = self.get_orga_and_model(seed)
+            files = {key: paths * 2 for key, paths in self.filepaths.items()}
+            orga.io.get_local_files = MagicMock(return_value=files)
+            orga.io.get_file_sizes = MagicMock(return_value=[50, 50])
+            orga.cfg._files_dict = {"train": files, "val": files}
+            orga.cfg._list_file = "test.toml"
+            orga.cfg.summary_plot_background = False
+            orga.cfg.train_logger_display = 1
+            orga.io.check_connections = MagicMock()
+            orga.validate = MagicMock(return_value={})
+            # the metrics of the model are only known after it was trained,
+            # the weights are synced afterwards anyway
+            model.train_on_batch(
+                {"input_A": np.zeros((1, 2, 3)),
+                 "input_B": np.zeros((1, 3, 4))},
+                {"mc_A": np.zeros((1, 1)), "mc_B": np.zeros((1, 1))})
+            setups.append((orga, model))
+
+        def function(comm):
+            orga, model = setups[comm.rank]
+            orga._comm = comm
+            orga.train_and_validate(model, epochs=1)
+            return model.get_weights()
+
+        # plot_model needs graphviz
+        with patch("keras.utils.plot_model"), patch(
+                "orcanet.core.DistributedTrainStep",
+                wraps=DistributedTrainStep) as train_step:
+            results = run_workers(function, 2)
+        # built once per worker
+        self.assertEqual(train_step.call_count, 2)
+        for weights_0, weights_1 in zip(*results):
+            np.testing.assert_array_equal(weights_0, weights_1)
+        # only rank 0 saves and validates
+        saved_models = os.listdir(setups[0][0].io.get_subfolder(
+            "saved_models"))
+        self.assertEqual(sorted(saved_models), [
+            "model_arch.json", "model_epoch_1_file_1.h5",
+            "model_epoch_1_file_2.h5"])
+        setups[0][0].validate.assert_called_once()
+        setups[1][0].validate.assert_not_called()
+        self.assertEqual(len(setups[0][0].history.get_state()), 2)
+        # the connections are closed at the end
+        for orga, model in setups:
+            self.assertIsNone(orga._comm)
+            self.assertIsNone(orga._train_step)
+
+    def test_train_worker_failure_closes_comm(self):
+        orga, model = self.get_orga_and_model(0)
+        comm = MagicMock(rank=1, world_size=2)
+        comm.broadcast.return_value = np.array([1, 1])
+        orga._comm = comm
+        orga.cfg._list_file = "test.toml"
+        with patch("orcanet.core.backend.train_model",
+                   side_effect=ConnectionError), \
+                self.assertRaises(ConnectionError):
+            orga.train(model)
+        comm.close.assert_called_once()
+        self.assertIsNone(orga._comm)
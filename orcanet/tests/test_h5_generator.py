@@ -2,10 +2,15 @@ from unittest import TestCase
 from unittest.mock import MagicMock
 import os
 import shutil
+import h5py
 import numpy as np
 
 from orcanet.core import Organizer
-from orcanet.h5_generator import get_h5_generator
+from orcanet.h5_generator import (get_h5_generator, ChunkCache,
+                                  Hdf5BatchGenerator, ShuffleBuffer,
+                                  ProcessLoader, get_memmap, get_chunk_rows)
+from orcanet.in_out import concatenate_h5_files
+from orcanet.utilities.nn_utilities import make_xs_stats
 from orcanet.tests.test_backend import save_dummy_h5py, assert_dict_arrays_equal, assert_equal_struc_array
 
 
@@ -84,6 +89,375 @@ class TestBatchGenerator(TestCase):
         with self.assertRaises(StopIteration):
             next(gene)
 
+    def test_batch_prefetch(self):
+        filepaths = self.filepaths_file_1
+        self.orga.cfg.prefetch_batches = 2
+        generator = get_h5_generator(self.orga, filepaths)
+        gene = iter(generator)
+
+        target_xs_batch_1 = {
+            "input_A": self.train_A_file_1_ctnt[0][:2],
+            "input_B": self.train_B_file_1_ctnt[0][:2],
+        }
+        target_xs_batch_2 = {
+            "input_A": self.train_A_file_1_ctnt[0][2:],
+            "input_B": self.train_B_file_1_ctnt[0][2:],
+        }
+
+        xs, ys = next(gene)
+        assert_dict_arrays_equal(xs, target_xs_batch_1)
+        self.assertIn(1, generator._prefetched)
+
+        xs, ys = next(gene)
+        assert_dict_arrays_equal(xs, target_xs_batch_2)
+        assert_dict_arrays_equal(
+            ys, label_modifier({"y_values": self.train_A_file_1_ctnt[1][2:]}))
+
+        with self.assertRaises(StopIteration):
+            next(gene)
+        generator.close()
+
+    def test_batch_shuffle_chunks(self):
+        path = os.path.join(self.temp_dir, "chunked.h5")
+        xs = np.arange(50).reshape((25, 2))
+        ys = np.arange(25).astype([("mc_A", "<f8")])
+        with h5py.File(path, "w") as f:
+            f.create_dataset("x", data=xs, chunks=(4, 2))
+            f.create_dataset("y", data=ys, chunks=(5, ))
+
+        self.orga.cfg.batchsize = 3
+        self.orga.cfg.shuffle_chunk_buffer = 2
+        generator = get_h5_generator(self.orga, {"input_A": path},
+                                     keras_mode=False, shuffle="chunks")
+        x_seen, y_seen = [], []
+        for info_blob in generator:
+            x_seen.append(info_blob["x_values"]["input_A"])
+            y_seen.append(info_blob["y_values"]["mc_A"])
+        generator.close()
+        x_seen, y_seen = np.concatenate(x_seen), np.concatenate(y_seen)
+
+        # every sample exactly once, and x and y still belong together
+        np.testing.assert_array_equal(np.sort(x_seen[:, 0]), xs[:, 0])
+        np.testing.assert_array_equal(x_seen[:, 0] / 2, y_seen)
+        self.assertFalse(np.array_equal(x_seen, xs))
+
+    def test_chunk_cache_reads_chunks_once(self):
+        path = os.path.join(self.temp_dir, "chunked_cache.h5")
+        xs = np.arange(20)
+        with h5py.File(path, "w") as f:
+            f.create_dataset("x", data=xs, chunks=(4,))
+
+        with h5py.File(path, "r") as f:
+            cache = ChunkCache(f["x"], buffer_rows=8)
+            read_chunks = []
+            get_chunk = cache._get_chunk
+
+            def counting_get_chunk(chunk_no):
+                if chunk_no not in cache._chunks:
+                    read_chunks.append(chunk_no)
+                return get_chunk(chunk_no)
+            cache._get_chunk = counting_get_chunk
+
+            indices = np.array([5, 1, 7, 0, 2, 6, 3, 4])
+            np.testing.assert_array_equal(cache.read(indices[:4]), indices[:4])
+            np.testing.assert_array_equal(cache.read(indices[4:]), indices[4:])
+        self.assertSequenceEqual(read_chunks, [0, 1])
+
+    def test_batch_offset(self):
+        generator = Hdf5BatchGenerator(self.filepaths_file_1, batchsize=2,
+                                       f_offset=1, f_size=2)
+        gene = iter(generator)
+
+        xs, ys = next(gene)
+        self.assertIsNone(ys)
+        assert_dict_arrays_equal(xs, {
+            "input_A": self.train_A_file_1_ctnt[0][1:3],
+            "input_B": self.train_B_file_1_ctnt[0][1:3],
+        })
+        with self.assertRaises(StopIteration):
+            next(gene)
+
+    def test_shuffle_buffer_mixes_files(self):
+        paths = []
+        for file_no in range(2):
+            path = os.path.join(self.temp_dir, "mixed_{}.h5".format(file_no))
+            xs = np.arange(20) + 100 * file_no
+            ys = xs.astype([("mc_A", "<f8")])
+            with h5py.File(path, "w") as f:
+                f.create_dataset("x", data=xs)
+                f.create_dataset("y", data=ys)
+            paths.append(path)
+
+        generators = [
+            Hdf5BatchGenerator({"input_A": path}, batchsize=3, f_offset=2,
+                               f_size=16, keras_mode=False)
+            for path in paths]
+        # buffer of 8 samples
+        buffer = ShuffleBuffer(generators, batchsize=4, keras_mode=False,
+                               buffer_memory=8 * 16)
+        self.assertEqual(buffer.n_samples, 32)
+        self.assertEqual(len(buffer), 8)
+
+        batches = list(buffer)
+        buffer.close()
+        self.assertEqual(len(batches), 8)
+        x_seen = np.concatenate(
+            [info_blob["x_values"]["input_A"] for info_blob in batches])
+        y_seen = np.concatenate(
+            [info_blob["y_values"]["mc_A"] for info_blob in batches])
+
+        # every sample exactly once, and x and y still belong together
+        np.testing.assert_array_equal(
+            np.sort(x_seen), np.concatenate([np.arange(2, 18),
+                                             np.arange(102, 118)]))
+        np.testing.assert_array_equal(x_seen, y_seen)
+        # samples of both files in the first half
+        self.assertTrue(np.any(x_seen[:16] < 100))
+        self.assertTrue(np.any(x_seen[:16] >= 100))
+
+    def test_memmap_contiguous_datasets(self):
+        path = os.path.join(self.temp_dir, "memmap.h5")
+        xs = np.arange(24, dtype="<f4").reshape((12, 2))
+        ys = np.arange(12).astype([("mc_A", "<f8"), ("mc_B", "<i4")])
+        with h5py.File(path, "w") as f:
+            f.create_dataset("x", data=xs)
+            f.create_dataset("y", data=ys)
+            f.create_dataset("x_gzip", data=xs, compression="gzip")
+            f.create_dataset("empty", shape=(5, 2), dtype="<f4")
+
+        with h5py.File(path, "r") as f:
+            np.testing.assert_array_equal(get_memmap(f["x"]), xs)
+            np.testing.assert_array_equal(get_memmap(f["y"]), ys)
+            self.assertIsNone(get_memmap(f["x_gzip"]))
+            self.assertIsNone(get_memmap(f["empty"]))
+
+        generator = Hdf5BatchGenerator({"input_A": path}, batchsize=5,
+                                       keras_mode=False)
+        list(generator)
+        self.assertEqual(generator._memmaps, {})
+        generator.close()
+
+        generator = Hdf5BatchGenerator({"input_A": path}, batchsize=5,
+                                       keras_mode=False, use_memmap=True)
+        info_blobs = list(generator)
+        self.assertIsNotNone(generator._memmaps[("input_A", "x")])
+        generator.close()
+        np.testing.assert_array_equal(info_blobs[2]["x_values"]["input_A"],
+                                      xs[10:])
+        np.testing.assert_array_equal(info_blobs[1]["y_values"], ys[5:10])
+
+        # batches can be modified without changing the file
+        info_blobs[0]["x_values"]["input_A"][:] = -1
+        with h5py.File(path, "r") as f:
+            np.testing.assert_array_equal(f["x"][()], xs)
+
+    def test_virtual_file(self):
+        paths = []
+        for file_no in range(2):
+            path = os.path.join(self.temp_dir, "virtual_{}.h5".format(file_no))
+            xs = np.arange(7 + file_no, dtype="<f4") + 100 * file_no
+            ys = xs.astype([("mc_A", "<f8")])
+            with h5py.File(path, "w") as f:
+                f.create_dataset("x", data=xs)
+                f.create_dataset("y", data=ys)
+            paths.append(path)
+        virtual_path = os.path.join(self.temp_dir, "virtual.h5")
+        concatenate_h5_files(paths, virtual_path, virtual=True)
+        xs = np.concatenate([np.arange(7), np.arange(8) + 100])
+
+        with h5py.File(virtual_path, "r") as f:
+            self.assertIsNone(get_memmap(f["x"]))
+        generator = Hdf5BatchGenerator({"input_A": virtual_path},
+                                       batchsize=4, keras_mode=False)
+        info_blobs = list(generator)
+        generator.close()
+        self.assertEqual(len(info_blobs), 4)
+        # a batch with samples from both files
+        np.testing.assert_array_equal(
+            info_blobs[1]["x_values"]["input_A"], [4, 5, 6, 100])
+        np.testing.assert_array_equal(
+            np.concatenate([blob["y_values"]["mc_A"] for blob in info_blobs]),
+            xs)
+
+        xs_mean, xs_var = make_xs_stats([virtual_path], "x")
+        self.assertAlmostEqual(xs_mean, np.mean(xs))
+        self.assertAlmostEqual(xs_var, np.var(xs), places=3)
+
+    def test_virtual_file_chunk_shuffle(self):
+        paths = []
+        for file_no, chunk_rows in enumerate((3, 4)):
+            path = os.path.join(self.temp_dir,
+                                "virtual_chunks_{}.h5".format(file_no))
+            xs = np.arange(10, dtype="<f4") + 100 * file_no
+            with h5py.File(path, "w") as f:
+                f.create_dataset("x", data=xs, chunks=(chunk_rows, ))
+                f.create_dataset("y", data=xs.astype([("mc_A", "<f8")]))
+            paths.append(path)
+        virtual_path = os.path.join(self.temp_dir, "virtual_chunks.h5")
+        concatenate_h5_files(paths, virtual_path, virtual=True)
+
+        with h5py.File(virtual_path, "r") as f:
+            self.assertIsNone(f["x"].chunks)
+            self.assertEqual(get_chunk_rows(f["x"]), 4)
+        generator = Hdf5BatchGenerator(
+            {"input_A": virtual_path}, batchsize=5, keras_mode=False,
+            shuffle="chunks", chunk_buffer=1)
+        self.assertEqual(generator._get_chunk_rows(), 4)
+        x_values = np.concatenate([blob["x_values"]["input_A"]
+                                   for blob in generator])
+        generator.close()
+        np.testing.assert_array_equal(
+            np.sort(x_values), np.concatenate([np.arange(10),
+                                               np.arange(10) + 100]))
+        # shuffled in units of 4 rows of the virtual dataset
+        rows = np.where(x_values < 100, x_values, x_values - 90)
+        units = np.sort(rows.reshape(-1, 4), axis=1)
+        self.assertTrue(np.all(units[:, 0] % 4 == 0))
+        self.assertTrue(np.all(np.diff(units, axis=1) == 1))
+
+    def test_y_field_names(self):
+        path = os.path.join(self.temp_dir, "y_fields.h5")
+        xs = np.arange(24, dtype="<f4").reshape((12, 2))
+        ys = np.zeros(12, dtype=[("mc_A", "<f8"), ("mc_B", "<i4"),
+                                 ("mc_C", "<f4")])
+        for name in ys.dtype.names:
+            ys[name] = np.arange(12)
+        with h5py.File(path, "w") as f:
+            f.create_dataset("x", data=xs, chunks=(4, 2))
+            f.create_dataset("y", data=ys, chunks=(4,))
+            f.create_dataset("y_contiguous", data=ys)
+
+        for key_y_values, shuffle in (("y", False), ("y", "chunks"),
+                                      ("y_contiguous", False)):
+            generator = Hdf5BatchGenerator(
+                {"input_A": path}, batchsize=5, keras_mode=False,
+                key_y_values=key_y_values, shuffle=shuffle,
+                y_field_names=["mc_C", "mc_A"])
+            y_values = np.concatenate(
+                [info_blob["y_values"] for info_blob in generator])
+            generator.close()
+            self.assertEqual(y_values.dtype.names, ("mc_A", "mc_C"))
+            np.testing.assert_array_equal(np.sort(y_values["mc_C"]),
+                                          ys["mc_C"])
+
+        # unknown fields: read everything
+        generator = Hdf5BatchGenerator(
+            {"input_A": path}, batchsize=5, keras_mode=False,
+            y_field_names=["mc_D"])
+        self.assertEqual(generator[0]["y_values"].dtype.names,
+                         ("mc_A", "mc_B", "mc_C"))
+        generator.close()
+
+    def test_y_field_names_from_label_modifier(self):
+        def modifier(info_blob):
+            return {"mc_A": info_blob["y_values"]["mc_A"]}
+        modifier.y_field_names = ["mc_A"]
+        self.orga.cfg.label_modifier = modifier
+
+        generator = get_h5_generator(self.orga, self.filepaths_file_1)
+        self.assertEqual(generator.y_field_names, ["mc_A"])
+        xs, ys = generator[0]
+        np.testing.assert_array_equal(
+            ys["mc_A"], self.train_A_file_1_ctnt[1]["mc_A"][:2])
+        generator.close()
+
+        # all y_values are needed for inference
+        generator = get_h5_generator(self.orga, self.filepaths_file_1,
+                                     keras_mode=False)
+        self.assertIsNone(generator.y_field_names)
+        generator.close()
+
+    def test_y_field_names_with_sample_modifier(self):
+        def modifier(info_blob):
+            return {"mc_A": info_blob["y_values"]["mc_A"]}
+        modifier.y_field_names = ["mc_A"]
+        self.orga.cfg.label_modifier = modifier
+
+        def sample_modifier(info_blob):
+            # uses a field the label modifier does not need
+            mc_b = info_blob["y_values"]["mc_B"]
+            return {key: x_values + mc_b[:, None, None]
+                    for key, x_values in info_blob["x_values"].items()}
+        self.orga.cfg.sample_modifier = sample_modifier
+
+        # no fields stated by the sample modifier: read all of them
+        generator = get_h5_generator(self.orga, self.filepaths_file_1)
+        self.assertIsNone(generator.y_field_names)
+        xs, ys = generator[0]
+        generator.close()
+        np.testing.assert_array_equal(
+            xs["input_A"], self.train_A_file_1_ctnt[0][:2] +
+            self.train_A_file_1_ctnt[1]["mc_B"][:2, None, None])
+
+        sample_modifier.y_field_names = ["mc_B", "mc_A"]
+        generator = get_h5_generator(self.orga, self.filepaths_file_1)
+        self.assertEqual(generator.y_field_names, ["mc_A", "mc_B"])
+        xs, ys = generator[0]
+        generator.close()
+        np.testing.assert_array_equal(
+            ys["mc_A"], self.train_A_file_1_ctnt[1]["mc_A"][:2])
+
+    def test_process_loader(self):
+        path = os.path.join(self.temp_dir, "process_loader.h5")
+        xs = np.arange(46, dtype="<f4").reshape((23, 2))
+        ys = np.arange(23).astype([("mc_A", "<f8"), ("mc_B", "<i4")])
+        with h5py.File(path, "w") as f:
+            f.create_dataset("x", data=xs, chunks=(4, 2))
+            f.create_dataset("y", data=ys)
+
+        def get_generator(**kwargs):
+            return Hdf5BatchGenerator(
+                {"input_A": path}, batchsize=5, shuffle=True,
+                sample_modifier=cumsum_modifier,
+                label_modifier=label_modifier, **kwargs)
+
+        generator = get_generator()
+        loader = ProcessLoader(get_generator(), n_processes=2)
+        try:
+            self.assertEqual(len(loader), 5)
+            # yielded in the order of the generator
+            generator._sample_pos = loader.generator._sample_pos
+            for epoch in range(2):
+                batches = list(loader)
+                self.assertEqual(len(batches), 5)
+                # copies, so they are not overwritten by later batches
+                for index, (xs_batch, ys_batch) in enumerate(batches):
+                    target_xs, target_ys = generator[index]
+                    assert_dict_arrays_equal(xs_batch, target_xs)
+                    assert_dict_arrays_equal(ys_batch, target_ys)
+
+            # stopping early, and starting again
+            next(iter(loader))
+            self.assertEqual(len(list(loader)), 5)
+        finally:
+            loader.close()
+            generator.close()
+
+        # views into the slots
+        generator = get_generator()
+        loader = ProcessLoader(get_generator(), n_processes=2, n_keep=1,
+                               copy=False)
+        try:
+            self.assertEqual(loader.n_slots, 5)
+            generator._sample_pos = loader.generator._sample_pos
+            for index, (xs_batch, ys_batch) in enumerate(loader):
+                target_xs, target_ys = generator[index]
+                assert_dict_arrays_equal(xs_batch, target_xs)
+                assert_dict_arrays_equal(ys_batch, target_ys)
+        finally:
+            loader.close()
+            generator.close()
+
+        loader = ProcessLoader(
+            Hdf5BatchGenerator({"input_A": path}, batchsize=5,
+                               label_modifier=failing_modifier),
+            n_processes=2)
+        try:
+            with self.assertRaisesRegex(RuntimeError, "Last batch"):
+                list(loader)
+        finally:
+            loader.close()
+
     def test_batch_zero_center(self):
         filepaths = self.filepaths_file_1
 
@@ -114,6 +488,53 @@ class TestBatchGenerator(TestCase):
         assert_dict_arrays_equal(xs, target_xs_batch_2)
         assert_dict_arrays_equal(ys, target_ys_batch_2)
 
+    def test_batch_zero_center_std_dtype(self):
+        xs_mean = {name: np.ones(shape) * 0.5
+                   for name, shape in self.n_bins.items()}
+        xs_std = {name: np.ones(shape) * 2
+                  for name, shape in self.n_bins.items()}
+        xs_std["input_A"][0, 0] = 0
+        generator = Hdf5BatchGenerator(
+            self.filepaths_file_1, batchsize=2, xs_mean=xs_mean,
+            xs_std=xs_std, x_dtype="float16", n_buffers=2, keras_mode=False)
+
+        batches = [generator[0], generator[1], generator[0]]
+        generator.close()
+        x_values = batches[0]["x_values"]["input_A"]
+        self.assertEqual(x_values.dtype, np.float16)
+
+        target = (self.train_A_file_1_ctnt[0][:2] - 0.5) / 2
+        target[:, 0, 0] *= 2
+        np.testing.assert_array_equal(x_values, target)
+        np.testing.assert_array_equal(
+            batches[1]["x_values"]["input_B"],
+            (self.train_B_file_1_ctnt[0][2:] - 0.5) / 2)
+
+        # buffers are used in turns if n_buffers is given
+        self.assertFalse(np.shares_memory(
+            batches[0]["x_values"]["input_A"],
+            batches[1]["x_values"]["input_A"]))
+        self.assertTrue(np.shares_memory(
+            batches[0]["x_values"]["input_A"],
+            batches[2]["x_values"]["input_A"]))
+
+    def test_batch_zero_center_new_arrays_per_default(self):
+        xs_mean = {name: np.ones(shape) * 0.5
+                   for name, shape in self.n_bins.items()}
+        generator = Hdf5BatchGenerator(
+            self.filepaths_file_1, batchsize=2, xs_mean=xs_mean,
+            keras_mode=False)
+        batches = list(generator) + [generator[0]]
+        generator.close()
+
+        np.testing.assert_array_equal(
+            batches[0]["x_values"]["input_A"],
+            self.train_A_file_1_ctnt[0][:2] - 0.5)
+        for batch in batches[1:]:
+            self.assertFalse(np.shares_memory(
+                batches[0]["x_values"]["input_A"],
+                batch["x_values"]["input_A"]))
+
     def test_batch_sample_modifier(self):
         filepaths = self.filepaths_file_1
 
@@ -179,6 +600,16 @@ class TestBatchGenerator(TestCase):
         assert_equal_struc_array(info_blob["y_values"], target_mc_info_batch_2)
 
 
+def cumsum_modifier(info_blob):
+    return {"sum": np.cumsum(info_blob["x_values"]["input_A"], axis=1)}
+
+
+def failing_modifier(info_blob):
+    if len(info_blob["y_values"]) < 5:
+        raise ValueError("Last batch")
+    return label_modifier(info_blob)
+
+
 def label_modifier(info_blob):
     y_values = info_blob["y_values"]
     ys = dict()
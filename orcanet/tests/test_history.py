@@ -1,5 +1,7 @@
 from unittest import TestCase
+from unittest.mock import patch
 import os
+import shutil
 import numpy as np
 from orcanet.history import HistoryHandler
 
@@ -30,6 +32,23 @@ class TestHistoryHandler(TestCase):
                    ('val_loss', '<f8'), ('train_acc', '<f8'), ('val_acc', '<f8')])
         assert_equal_struc_array(summary_data, target)
 
+    @patch('orcanet.history.HistoryHandler._load_txt',
+           wraps=HistoryHandler._load_txt)
+    def test_get_summary_data_cached(self, mock_load_txt):
+        summary_data = self.history.get_summary_data()
+        summary_data["LR"] = 0
+        # the cached data is not changed by modifying the returned data
+        np.testing.assert_array_equal(
+            self.history.get_summary_data()["LR"], [0.005, 0.00465])
+        self.assertEqual(mock_load_txt.call_count, 1)
+
+        self.history.summary_filename = self.summary_filename_2
+        self.history.get_summary_data()
+        self.assertEqual(mock_load_txt.call_count, 2)
+        self.history.clear_cache()
+        self.history.get_summary_data()
+        self.assertEqual(mock_load_txt.call_count, 3)
+
     def test_get_train_data(self):
         train_data = self.history.get_train_data()
         print(train_data)
@@ -149,6 +168,46 @@ class TestHistoryHandler(TestCase):
         self.assertEqual(target, value)
 
 
+class TestHistoryTiming(TestCase):
+    """ Train log files where only some have the timing columns. """
+    def setUp(self):
+        self.temp_dir = os.path.join(os.path.dirname(__file__), ".temp",
+                                     "history_timing")
+        if os.path.exists(self.temp_dir):
+            shutil.rmtree(self.temp_dir)
+        shutil.copytree(os.path.join(os.path.dirname(__file__),
+                                     "data", "dummy_model"), self.temp_dir)
+        with open(os.path.join(self.temp_dir, "train_log",
+                               "log_epoch_2_file_1.txt"), "w") as f:
+            f.write("Batch | Batch_float | loss | acc | time_batch | "
+                    "samples_per_s\n")
+            f.write("------+-------------+------+-----+------------+"
+                    "--------------\n")
+            f.write("100 | 1.5 | 0.1 | 0.9 | 0.02 | 3200\n")
+            f.write("200 | 1.8 | 0.1 | 0.9 | 0.04 | 1600\n")
+        self.history = HistoryHandler(self.temp_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_get_train_data_missing_columns(self):
+        train_data = self.history.get_train_data()
+        self.assertEqual(len(train_data), 6)
+        np.testing.assert_array_equal(
+            train_data["samples_per_s"], [np.nan] * 4 + [3200, 1600])
+        np.testing.assert_array_equal(train_data["Batch_float"][-2:],
+                                      [1.5, 1.8])
+
+    @patch('orcanet.history.plot_history')
+    def test_plot_timing(self, mock_plot_history):
+        self.history.plot_timing("time_batch")
+        train_data, val_data = mock_plot_history.call_args[0]
+        np.testing.assert_array_equal(train_data[1][-2:], [0.02, 0.04])
+        self.assertIsNone(val_data)
+        with self.assertRaises(ValueError):
+            self.history.plot_timing("queue_fill")
+
+
 def assert_equal_struc_array(a, b):
     """  np.testing.assert_array_equal does not work for arrays containing nans...
      so test individual instead. """
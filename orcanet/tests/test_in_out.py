@@ -1,6 +1,7 @@
 from unittest import TestCase
-from unittest.mock import MagicMock
+from unittest.mock import MagicMock, patch
 import os
+import zlib
 import h5py
 import numpy as np
 import shutil
@@ -9,7 +10,8 @@ from keras.models import Model
 import keras.layers as layers
 
 from orcanet.core import Configuration
-from orcanet.in_out import IOHandler, split_name_of_predfile
+from orcanet.in_out import IOHandler, StagingManager, split_name_of_predfile, \
+    concatenate_h5_files
 
 
 class TestIOHandler(TestCase):
@@ -189,6 +191,86 @@ class TestIOHandler(TestCase):
 
             shutil.rmtree(temp_temp_dir)
 
+    def test_copy_to_ssd_on_demand(self):
+        self.io.cfg.use_scratch_ssd = True
+        scratch_dir = self.temp_dir + "/scratch_on_demand"
+        os.mkdir(scratch_dir)
+        tempdir_environ = os.environ.get("TMPDIR")
+        try:
+            os.environ["TMPDIR"] = scratch_dir
+            # sizes dont need the copies
+            self.assertSequenceEqual(self.io.get_file_sizes("train"),
+                                     self.train_sizes)
+            self.assertEqual(len(os.listdir(scratch_dir)), 0)
+
+            files_dict = self.io.get_file("train", 1)
+            self.assertEqual(files_dict["input_A"],
+                             scratch_dir + self.file_names[0])
+            with h5py.File(files_dict["input_A"], "r") as f:
+                np.testing.assert_array_equal(
+                    f["x"][()], self.train_A_file_1_ctnt[0])
+
+            # the second file gets copied in the background
+            self.io.get_file("train", 2)
+            self.assertTrue(os.path.exists(scratch_dir + self.file_names[3]))
+            self.io._staging.close()
+        finally:
+            if tempdir_environ is not None:
+                os.environ["TMPDIR"] = tempdir_environ
+            else:
+                os.environ.pop("TMPDIR")
+            shutil.rmtree(scratch_dir)
+
+    def test_staging_manager_evicts(self):
+        scratch_dir = self.temp_dir + "/scratch_evict"
+        os.mkdir(scratch_dir)
+        sources = [self.train_A_file_1["path"], self.train_A_file_2["path"]]
+        file_size = os.path.getsize(sources[1])
+        try:
+            staging = StagingManager(scratch_dir, max_size=1.5 * file_size)
+            copies = [staging.get_path(f_path) for f_path in sources]
+            staging.stage(sources[:1])
+            staging.prefetch(sources[1:])
+            # first one is in use, so it can not be deleted
+            staging.stage(sources[:1])
+            staging.close()
+            self.assertTrue(os.path.exists(copies[0]))
+
+            staging = StagingManager(scratch_dir, max_size=1.5 * file_size)
+            for f_path in sources:
+                staging.stage([f_path])
+                staging.release([f_path])
+            staging.close()
+            self.assertFalse(os.path.exists(copies[0]))
+            self.assertTrue(os.path.exists(copies[1]))
+            self.assertEqual(staging.get_source(copies[1]), sources[1])
+        finally:
+            shutil.rmtree(scratch_dir)
+
+    def test_staging_manager_keeps_files_until_released(self):
+        scratch_dir = self.temp_dir + "/scratch_release"
+        os.mkdir(scratch_dir)
+        sources = [self.train_A_file_1["path"], self.train_A_file_2["path"]]
+        file_size = os.path.getsize(sources[1])
+        try:
+            staging = StagingManager(scratch_dir, max_size=1.5 * file_size)
+            copies = [staging.get_path(f_path) for f_path in sources]
+            # e.g. used by two jobs at once, only one of them is done
+            staging.stage(sources[:1])
+            staging.stage(sources[:1])
+            staging.release(sources[:1])
+            with self.assertWarns(UserWarning):
+                staging.stage(sources[1:])
+            self.assertTrue(os.path.exists(copies[0]))
+            self.assertTrue(os.path.exists(copies[1]))
+
+            staging.release(sources)
+            with self.assertRaises(ValueError):
+                staging.release(sources[:1])
+            staging.close()
+        finally:
+            shutil.rmtree(scratch_dir)
+
     def test_check_connections_no_sample(self):
         input_shapes = self.n_bins
         output_shapes = {
@@ -294,6 +376,31 @@ class TestIOHandler(TestCase):
         value = self.io.get_file_sizes("train")
         self.assertSequenceEqual(value, self.train_sizes)
 
+    def test_get_file_sizes_cached(self):
+        self.io.get_file_sizes("train")
+        with patch("orcanet.in_out.h5py.File") as h5_file:
+            value = self.io.get_file_sizes("train")
+            h5_file.assert_not_called()
+        self.assertSequenceEqual(value, self.train_sizes)
+
+    def test_get_h5_metadata_changed_file(self):
+        path = os.path.join(self.temp_dir, "metadata_test.h5")
+        with h5py.File(path, "w") as f:
+            f.create_dataset("x", data=np.zeros((5, 2)), chunks=(2, 2))
+            f.create_dataset("group/y", data=np.zeros((5, )))
+        metadata = self.io.get_h5_metadata(path)
+        self.assertEqual(metadata["x"]["shape"], (5, 2))
+        self.assertEqual(metadata["x"]["chunks"], (2, 2))
+        self.assertEqual(metadata["group/y"]["dtype"], np.float64)
+        self.assertEqual(self.io.get_number_of_rows(path), 5)
+
+        with h5py.File(path, "w") as f:
+            f.create_dataset("x", data=np.zeros((7, 2)))
+        metadata = self.io.get_h5_metadata(path)
+        self.assertEqual(metadata["x"]["shape"], (7, 2))
+        self.assertIsNone(metadata["x"]["chunks"])
+        os.remove(path)
+
     def test_get_batch_xs(self):
         value = self.io.get_batch()
         target = {
@@ -431,6 +538,44 @@ class TestIOHandler(TestCase):
         }
         self.assertDictEqual(value, target)
 
+    def test_get_local_files_virtual(self):
+        self.io.cfg.virtual_files = ["train"]
+        self.io.cfg.output_folder = self.temp_dir + "/"
+        value = self.io.get_local_files("train")
+        virtual_folder = os.path.join(self.temp_dir, "virtual_files")
+        target = {
+            'input_A': (os.path.join(virtual_folder, "train_input_A.h5"), ),
+            'input_B': (os.path.join(virtual_folder, "train_input_B.h5"), ),
+        }
+        self.assertDictEqual(value, target)
+        self.assertEqual(self.io.get_no_of_files("train"), 1)
+        self.assertEqual(self.io.get_file_sizes("train"),
+                         [sum(self.train_sizes)])
+        with h5py.File(value["input_A"][0], "r") as f:
+            self.assertTrue(f["x"].is_virtual)
+            np.testing.assert_array_equal(
+                f["x"][()], np.concatenate([self.train_A_file_1_ctnt[0],
+                                            self.train_A_file_2_ctnt[0]]))
+            assert_equal_struc_array(
+                f["y"][()], np.concatenate([self.train_A_file_1_ctnt[1],
+                                            self.train_A_file_2_ctnt[1]]))
+        # other filesets are unchanged
+        self.assertEqual(self.io.get_no_of_files("val"), 2)
+
+        # up to date files are reused, e.g. from another worker
+        io = IOHandler(self.io.cfg)
+        with patch("orcanet.in_out.concatenate_h5_files") as mock_concat:
+            self.assertDictEqual(io.get_local_files("train"), target)
+        mock_concat.assert_not_called()
+        # but not if a file has changed since
+        os.utime(self.train_A_file_1["path"])
+        os.utime(value["input_B"][0], (0, 0))
+        io = IOHandler(self.io.cfg)
+        with patch("orcanet.in_out.concatenate_h5_files") as mock_concat:
+            io.get_local_files("train")
+        self.assertEqual(mock_concat.call_count, 2)
+        shutil.rmtree(virtual_folder)
+
     def test_get_no_of_files_train(self):
         value = self.io.get_no_of_files("train")
         target = 2
@@ -665,6 +810,73 @@ class TestFunctions(TestCase):
         self.assertSequenceEqual(split_name_of_predfile(filename), target)
 
 
+class TestConcatenateH5Files(TestCase):
+    def setUp(self):
+        self.temp_dir = os.path.join(os.path.dirname(__file__), ".temp",
+                                     "concatenate")
+        if os.path.exists(self.temp_dir):
+            shutil.rmtree(self.temp_dir)
+        os.makedirs(self.temp_dir)
+        self.output_file = os.path.join(self.temp_dir, "concatenated.h5")
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def make_files(self, sizes, **kwargs):
+        """ Make files with the given number of rows, and chunks of 4. """
+        dtypes = [('mc_A', '<f8'), ('mc_B', '<i4'), ]
+        files, xs, ys = [], [], []
+        for i, size in enumerate(sizes):
+            x = np.random.rand(size, 3, 2)
+            y = np.zeros(size, dtype=dtypes)
+            y["mc_A"] = np.random.rand(size)
+            y["mc_B"] = np.arange(size) + 100 * i
+            path = os.path.join(self.temp_dir, "file_{}.h5".format(i))
+            with h5py.File(path, "w") as f:
+                f.create_dataset("x", data=x, chunks=(4, 3, 2), **kwargs)
+                f.create_dataset("y", data=y, chunks=(4, ), **kwargs)
+            files.append(path)
+            xs.append(x)
+            ys.append(y)
+        return files, np.concatenate(xs), np.concatenate(ys)
+
+    def check_output(self, xs, ys):
+        with h5py.File(self.output_file, "r") as f:
+            np.testing.assert_array_equal(f["x"][()], xs)
+            np.testing.assert_array_equal(f["y"][()], ys)
+            return f["x"].chunks, f["x"].compression, f["x"].is_virtual
+
+    def test_gzip(self):
+        # the last file is not at a chunk border
+        files, xs, ys = self.make_files(
+            [8, 8, 5, 7], compression="gzip", compression_opts=1)
+        concatenate_h5_files(files, self.output_file, n_threads=2)
+        self.assertEqual(self.check_output(xs, ys),
+                         ((4, 3, 2), "gzip", False))
+        self.assertEqual([name for name in os.listdir(
+            os.path.dirname(self.output_file)) if name.endswith(".tmp")], [])
+
+    def test_copy_chunks(self):
+        files, xs, ys = self.make_files(
+            [8, 8, 5], compression="gzip", compression_opts=1)
+        with patch("orcanet.in_out.zlib.compress",
+                   wraps=zlib.compress) as mock_compress:
+            concatenate_h5_files(files, self.output_file, n_threads=2)
+        # only the last, partial chunk of each dataset gets compressed
+        self.assertEqual(mock_compress.call_count, 2)
+        self.check_output(xs, ys)
+
+    def test_lzf(self):
+        files, xs, ys = self.make_files([8, 5, 7], compression="lzf")
+        concatenate_h5_files(files, self.output_file, n_threads=2)
+        self.assertEqual(self.check_output(xs, ys), ((4, 3, 2), "lzf", False))
+
+    def test_virtual(self):
+        files, xs, ys = self.make_files([8, 5, 7])
+        concatenate_h5_files(files, self.output_file, virtual=True)
+        self.assertTrue(self.check_output(xs, ys)[2])
+
+
 def assert_equal_struc_array(a, b):
     """  np.testing.assert_array_equal does not work for arrays containing nans...
      so test individual instead. """
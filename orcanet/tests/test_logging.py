@@ -1,13 +1,18 @@
 from unittest import TestCase
 from unittest.mock import MagicMock
 import os
+import time
+import keras as ks
 from keras.models import Model
 import keras.layers as layers
 import numpy as np
 import shutil
 
-from orcanet.logging import SummaryLogger, merge_arrays, BatchLogger, gen_line_str
+from orcanet.logging import SummaryLogger, merge_arrays, BatchLogger, gen_line_str, \
+    TIMING_COLUMNS, BINARY_TRAIN_LOG, read_binary_train_log, \
+    convert_binary_to_txt_train_log, convert_txt_to_binary_train_log
 from orcanet.core import Organizer
+from orcanet.history import HistoryHandler
 
 
 class TestSummaryLogger(TestCase):
@@ -119,6 +124,26 @@ class TestSummaryLogger(TestCase):
                              history_train=history_train_1)
         self.check_file(target)
 
+    def test_update_last_line_of_long_file(self):
+        smry = SummaryLogger(
+            self.orga, MagicMock(metrics_names=["loss", "mae"]))
+        n_lines = 100
+        for i in range(n_lines):
+            smry.write_line(i + 0.5, 0.001, history_train={"loss": i, "mae": 1})
+        with open(self.summary_file) as file:
+            lines = file.readlines()
+        # summary data is read again after writing
+        self.assertEqual(len(self.orga.history.get_summary_data()), n_lines)
+
+        smry.write_line(n_lines - 0.5, "n/a",
+                        history_val={"loss": 2, "mae": 3})
+        with open(self.summary_file) as file:
+            new_lines = file.readlines()
+        self.assertEqual(new_lines[:-1], lines[:-1])
+        summary_data = self.orga.history.get_summary_data()
+        self.assertEqual(len(summary_data), n_lines)
+        self.assertEqual(tuple(summary_data[-1]), (99.5, 0.001, 99, 2, 1, 3))
+
     def tearDown(self):
         os.remove(self.summary_file)
 
@@ -274,6 +299,124 @@ class TestBatchLogger(TestCase):
             lines = file.readlines()
         return lines
 
+    def test_batch_logger_timing(self):
+        self.orga.cfg.train_logger_timing = True
+        self.orga.io.print_log = MagicMock()
+        generator = MagicMock(n_ready=3)
+        batch_logger = BatchLogger(self.orga, (1, 1), generator=generator)
+
+        batch_logger.set_model(MagicMock(metrics_names=["loss"]))
+        batch_logger.on_epoch_begin(0)
+        for batch in range(4):
+            batch_logger.on_batch_begin(batch)
+            batch_logger.on_batch_end(batch, logs={"loss": 0.25})
+        batch_logger.on_epoch_end(0)
+
+        logfile_path = os.path.join(self.temp_dir, "train_log",
+                                    "log_epoch_1_file_1.txt")
+        data = np.genfromtxt(logfile_path, names=True, delimiter="|",
+                             autostrip=True, comments="--")
+        for column in TIMING_COLUMNS:
+            self.assertIn(column, data.dtype.names)
+        self.assertEqual(data["queue_fill"], 3)
+        self.assertGreater(data["samples_per_s"], 0)
+        self.assertAlmostEqual(data["time_fetch"] + data["time_step"],
+                               data["time_batch"], places=5)
+        self.assertTrue(any(
+            ["Timing" in call[0][0]
+             for call in self.orga.io.print_log.call_args_list]))
+
+    def test_batch_logger_timing_slow_generator(self):
+        self.orga.cfg.train_logger_timing = True
+        self.orga.io.print_log = MagicMock()
+        logfile_path = os.path.join(self.temp_dir, "train_log",
+                                    "log_epoch_1_file_1.txt")
+        # the metrics of the model are only known after it was trained
+        self.model.train_on_batch(*SlowSequence(
+            *self.data_file1, batchsize=10, delay=0)[0])
+
+        def get_time_fetch(delay, as_iterator):
+            batch_logger = BatchLogger(self.orga, (1, 1))
+            generator = batch_logger.time_generator(
+                SlowSequence(*self.data_file1, batchsize=10, delay=delay))
+            if as_iterator:
+                generator = batch_logger.time_generator(iter(generator))
+            self.model.fit(generator, steps_per_epoch=4, verbose=0,
+                           callbacks=[batch_logger])
+            data = np.genfromtxt(logfile_path, names=True, delimiter="|",
+                                 autostrip=True, comments="--")
+            return data["time_fetch"]
+
+        for as_iterator in (False, True):
+            fast = get_time_fetch(0, as_iterator)
+            slow = get_time_fetch(0.05, as_iterator)
+            self.assertGreaterEqual(slow, 0.05)
+            self.assertGreater(slow, fast + 0.04)
+
+    def test_batch_logger_binary(self):
+        self.orga.cfg.train_logger_format = "h5"
+        self.orga.cfg.train_logger_timing = True
+        self.orga.cfg.train_logger_display = 2
+        self.orga.io.print_log = MagicMock()
+        for f_number in (1, 2):
+            batch_logger = BatchLogger(self.orga, (1, f_number))
+            batch_logger.set_model(MagicMock(metrics_names=["loss"]))
+            batch_logger.on_epoch_begin(0)
+            for batch in range(4):
+                batch_logger.on_batch_begin(batch)
+                batch_logger.on_batch_end(batch, logs={"loss": 0.25 * batch})
+            batch_logger.on_epoch_end(0)
+
+        train_log_folder = os.path.join(self.temp_dir, "train_log")
+        logs = read_binary_train_log(
+            os.path.join(train_log_folder, BINARY_TRAIN_LOG))
+        self.assertCountEqual(logs.keys(), [(1, 1), (1, 2)])
+        data = logs[(1, 2)]
+        self.assertEqual(data.dtype.names,
+                         ("Batch", "Batch_float", "loss") + TIMING_COLUMNS)
+        np.testing.assert_array_equal(data["Batch"], [2, 4])
+        np.testing.assert_array_almost_equal(data["loss"], [0.125, 0.625])
+        # no text files are written
+        self.assertEqual(os.listdir(train_log_folder), [BINARY_TRAIN_LOG])
+
+        train_data = HistoryHandler(self.temp_dir).get_train_data()
+        np.testing.assert_array_equal(
+            train_data["Batch_float"],
+            np.concatenate([logs[(1, 1)], logs[(1, 2)]])["Batch_float"])
+
+        # convert to text and back
+        convert_binary_to_txt_train_log(train_log_folder)
+        os.remove(os.path.join(train_log_folder, BINARY_TRAIN_LOG))
+        train_data_txt = HistoryHandler(self.temp_dir).get_train_data()
+        np.testing.assert_array_almost_equal(
+            train_data_txt["loss"], train_data["loss"])
+        convert_txt_to_binary_train_log(train_log_folder)
+        logs_converted = read_binary_train_log(
+            os.path.join(train_log_folder, BINARY_TRAIN_LOG))
+        np.testing.assert_array_almost_equal(
+            logs_converted[(1, 2)]["loss"], data["loss"])
+
+    def test_batch_logger_unknown_format(self):
+        self.orga.cfg.train_logger_format = "csv"
+        with self.assertRaises(ValueError):
+            BatchLogger(self.orga, (1, 1))
+
+
+class SlowSequence(ks.utils.Sequence):
+    """ Batches of the test data, which take some time to get. """
+    def __init__(self, xs, ys, batchsize, delay):
+        self.xs, self.ys = xs, ys
+        self.batchsize = batchsize
+        self.delay = delay
+
+    def __len__(self):
+        return len(self.xs) // self.batchsize
+
+    def __getitem__(self, index):
+        time.sleep(self.delay)
+        batch = slice(index * self.batchsize, (index + 1) * self.batchsize)
+        return {"inp": self.xs[batch]}, {"out": self.ys[batch]["inp"]}
+
 
 def build_test_model():
     input_shape = (1,)
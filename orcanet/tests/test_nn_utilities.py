@@ -2,15 +2,19 @@
 # -*- coding: utf-8 -*-
 
 import numpy as np
+import errno
 import os
 import shutil
+import multiprocessing
 import h5py
-from unittest import TestCase
+from unittest import TestCase, mock
 from keras.models import Model
 import keras.layers as layers
 
 from orcanet.core import Organizer
-from orcanet.utilities.nn_utilities import load_zero_center_data, get_layer_output
+import orcanet.utilities.nn_utilities as nn_utilities
+from orcanet.utilities.nn_utilities import load_zero_center_data, get_layer_output, make_xs_stats, MeanVarAccumulator, \
+    get_xs_mean_path, save_xs_mean, load_zero_center_std
 
 
 class TetstZeroCenter(TestCase):
@@ -91,6 +95,117 @@ class TetstZeroCenter(TestCase):
         self.assertTrue(np.array_equal(used_files_A, self.train_inp_A))
         self.assertTrue(np.array_equal(used_files_B, self.train_inp_B))
 
+    def test_xs_var_is_saved(self):
+        load_zero_center_data(self.orga, logging=False)
+        file_A = self.orga.cfg.zero_center_folder + "/" + \
+            self.orga.cfg._list_file + '_input_testing_input_A.npz'
+        # 100 ones and 300 zeros
+        np.testing.assert_array_almost_equal(
+            np.load(file_A)["xs_var"], np.ones(self.shape) * 0.25 * 0.75)
+        xs_std = load_zero_center_std(self.orga)
+        np.testing.assert_array_almost_equal(
+            xs_std["testing_input_A"], np.ones(self.shape) * 0.75**0.5 / 2)
+
+    def test_zero_center_invalidated_by_changed_file(self):
+        load_zero_center_data(self.orga, logging=False)
+        file_A = self.orga.cfg.zero_center_folder + "/" + \
+            self.orga.cfg._list_file + '_input_testing_input_A.npz'
+        self.assertEqual(
+            get_xs_mean_path(self.temp_dir, self.train_inp_A), file_A)
+
+        # change the train files: now only ones
+        for path in self.train_inp_A:
+            with h5py.File(path, "r+") as f:
+                f["x"][...] = 1
+        self.assertIsNone(get_xs_mean_path(self.temp_dir, self.train_inp_A))
+
+        xs_mean = load_zero_center_data(self.orga, logging=False)
+        np.testing.assert_array_almost_equal(
+            xs_mean["testing_input_A"], np.ones(self.shape))
+        npz_files = [file for file in os.listdir(self.temp_dir)
+                     if file.endswith(".npz")]
+        self.assertEqual(len(npz_files), 2)
+
+    def test_zero_center_legacy_npz(self):
+        legacy_file = os.path.join(self.temp_dir, "old.npz")
+        np.savez(legacy_file, xs_mean=np.zeros(self.shape),
+                 zero_center_used_ip_files=self.train_inp_B)
+
+        self.assertEqual(
+            get_xs_mean_path(self.temp_dir, self.train_inp_B), legacy_file)
+        self.assertIsNone(get_xs_mean_path(self.temp_dir, self.train_inp_A))
+
+    def test_zero_center_without_flock(self):
+        with mock.patch.object(nn_utilities.fcntl, "flock", side_effect=OSError(
+                errno.ENOSYS, "Function not implemented")):
+            path = _save_dummy_xs_mean(self.temp_dir, "input", ["file"])
+            self.assertEqual(get_xs_mean_path(self.temp_dir, ["file"]), path)
+
+    def test_zero_center_read_only_folder(self):
+        legacy_file = os.path.join(self.temp_dir, "old.npz")
+        np.savez(legacy_file, xs_mean=np.zeros(self.shape),
+                 zero_center_used_ip_files=self.train_inp_B)
+        with mock.patch.object(nn_utilities.os, "access", return_value=False):
+            self.assertEqual(
+                get_xs_mean_path(self.temp_dir, self.train_inp_B), legacy_file)
+        self.assertFalse(os.path.exists(
+            os.path.join(self.temp_dir, nn_utilities.ZERO_CENTER_INDEX)))
+        self.assertFalse(os.path.exists(
+            os.path.join(self.temp_dir, ".zero_center_index.lock")))
+
+    def test_zero_center_reader_does_not_create_lock(self):
+        path = _save_dummy_xs_mean(self.temp_dir, "input", ["file"])
+        lock_path = os.path.join(self.temp_dir, ".zero_center_index.lock")
+        os.remove(lock_path)
+        self.assertEqual(get_xs_mean_path(self.temp_dir, ["file"]), path)
+        self.assertFalse(os.path.exists(lock_path))
+
+    def test_zero_center_concurrent_writers(self):
+        args = [(self.temp_dir, "input_{}".format(i), ["file_{}".format(i)])
+                for i in range(6)]
+        with multiprocessing.Pool(3) as pool:
+            pool.starmap(_save_dummy_xs_mean, args)
+
+        for i in range(6):
+            self.assertEqual(
+                get_xs_mean_path(self.temp_dir, ["file_{}".format(i)]),
+                os.path.join(self.temp_dir, "input_{}.npz".format(i)))
+
+    def test_make_xs_stats_chunked(self):
+        xs = [np.random.rand(107, 4, 3) * 100 + 1e6,
+              np.random.rand(31, 4, 3) * 100 + 1e6]
+        paths = [self.temp_dir + "/chunked_{}.h5".format(i) for i in range(2)]
+        for x, path in zip(xs, paths):
+            with h5py.File(path, "w") as f:
+                f.create_dataset("x", data=x, chunks=(10, 4, 3),
+                                 compression="gzip")
+
+        all_xs = np.concatenate(xs)
+        for n_processes in (1, 2):
+            # memory for two chunks per step, and their float64 copy
+            xs_mean, xs_var = make_xs_stats(
+                paths, "x", total_memory=2 * 10 * 12 * 16 * n_processes,
+                n_processes=n_processes)
+            np.testing.assert_allclose(xs_mean, np.mean(all_xs, axis=0))
+            np.testing.assert_allclose(xs_var, np.var(all_xs, axis=0))
+
+        with mock.patch.object(MeanVarAccumulator, "update",
+                          autospec=True,
+                          side_effect=MeanVarAccumulator.update) as update:
+            make_xs_stats(paths, "x", total_memory=2 * 10 * 12 * 16,
+                          n_processes=1)
+        self.assertEqual(max(len(call[0][1]) for call in
+                             update.call_args_list), 20)
+
+    def test_mean_var_accumulator(self):
+        data = np.random.rand(50, 3)
+        stats = MeanVarAccumulator()
+        for block in (data[:7], data[7:7], data[7:40], data[40:]):
+            stats.update(block)
+        self.assertEqual(stats.n, 50)
+        np.testing.assert_allclose(stats.mean, np.mean(data, axis=0))
+        np.testing.assert_allclose(stats.var, np.var(data, axis=0))
+
     def _check_dict_ndarray(self, val, target):
         self.assertSetEqual(set(val.keys()), set(target.keys()))
         for key in val.keys():
@@ -142,6 +257,11 @@ class TestModel(TestCase):
         np.testing.assert_array_equal(value, target)
 
 
+def _save_dummy_xs_mean(zero_center_folder, name, train_filepaths):
+    return save_xs_mean(zero_center_folder, name, train_filepaths,
+                 xs_mean=np.ones(3))
+
+
 def make_dummy_data(filepath1, filepath2, shape, mode=1):
     """
     Make two dummy data files.
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import numpy as np
+from unittest import TestCase
+
+from orcanet_contrib.orca_handler_util import orca_sample_modifiers, \
+    orca_label_modifiers, LabelModifier, SampleModifier
+
+
+class TestSampleModifier(TestCase):
+    def setUp(self):
+        self.x_values = {
+            "xyz-t": np.random.rand(3, 2, 4, 5, 6),
+            "xyz-c": np.random.rand(3, 2, 4, 5, 7),
+        }
+
+    def test_transpose(self):
+        modifier = orca_sample_modifiers("xyz-t_and_yzt-x")
+        xs = modifier({"x_values": self.x_values})
+        self.assertIs(xs["xyz-t"], self.x_values["xyz-t"])
+        np.testing.assert_array_equal(
+            xs["yzt-x"], np.transpose(self.x_values["xyz-t"], (0, 2, 3, 4, 1)))
+        self.assertTrue(xs["yzt-x"].flags["C_CONTIGUOUS"])
+
+    def test_concat(self):
+        modifier = orca_sample_modifiers("xyz-t_and_xyz-c_single_input")
+        xs = modifier({"x_values": self.x_values})
+        np.testing.assert_array_equal(
+            xs["xyz-t_and_xyz-c_single_input"],
+            np.concatenate([self.x_values["xyz-t"], self.x_values["xyz-c"]],
+                           axis=-1))
+
+    def test_buffers_are_reused_in_turn(self):
+        modifier = SampleModifier(
+            {"out": ("transpose", "xyz-t", (0, 2, 1, 3, 4))},
+            dtype="float32", n_buffers=2)
+        outs = [modifier({"x_values": self.x_values})["out"]
+                for i in range(3)]
+        self.assertIsNot(outs[0], outs[1])
+        self.assertIs(outs[0], outs[2])
+        self.assertEqual(outs[0].dtype, np.float32)
+
+    def test_new_arrays_per_default(self):
+        modifier = orca_sample_modifiers("xyz-t_and_yzt-x")
+        outs = [modifier({"x_values": self.x_values})["yzt-x"]
+                for i in range(2)]
+        self.assertFalse(np.shares_memory(outs[0], outs[1]))
+
+    def test_unknown_operation(self):
+        with self.assertRaises(ValueError):
+            SampleModifier({"out": ("stack", "xyz-t", 0)})
+
+
+class TestLabelModifier(TestCase):
+    def setUp(self):
+        fields = ["particle_type", "is_cc", "energy", "bjorkeny", "dir_x",
+                  "dir_y", "dir_z", "vertex_pos_x", "vertex_pos_y",
+                  "vertex_pos_z", "time_residual_vertex"]
+        self.y_values = np.zeros(
+            (6, ), dtype=[(field, "<f8") for field in fields])
+        for field in fields:
+            self.y_values[field] = np.random.rand(6)
+        self.y_values["particle_type"] = [12, -12, 14, 12, -12, 16]
+        self.y_values["is_cc"] = [0, 0, 0, 1, 0, 1]
+        self.y_values_orig = self.y_values.copy()
+
+    def test_energy_dir_bjorken_y_vtx_errors(self):
+        modifier = orca_label_modifiers("energy_dir_bjorken-y_vtx_errors")
+        ys = modifier({"y_values": self.y_values})
+
+        elec_nc = np.array([1, 1, 0, 0, 1, 0], dtype=bool)
+        target_energy = np.where(
+            elec_nc, self.y_values["energy"] * self.y_values["bjorkeny"],
+            self.y_values["energy"]).astype(np.float32)
+        target_by = np.where(
+            elec_nc, 1, self.y_values["bjorkeny"]).astype(np.float32)
+
+        self.assertEqual(len(ys), 18)
+        np.testing.assert_array_equal(ys["e"], target_energy)
+        np.testing.assert_array_equal(ys["e_err"], target_energy)
+        np.testing.assert_array_equal(ys["by"], target_by)
+        np.testing.assert_array_equal(
+            ys["vt"], self.y_values["time_residual_vertex"].astype(np.float32))
+        self.assertEqual(ys["dx"].dtype, np.float32)
+        self.assertCountEqual(modifier.y_field_names,
+                              self.y_values.dtype.names)
+        # input is not modified
+        np.testing.assert_array_equal(self.y_values, self.y_values_orig)
+
+    def test_overrides_with_field_and_comparisons(self):
+        modifier = LabelModifier(
+            columns={"a": "energy", "b": "dir_x"},
+            overrides=[{
+                "where": [("particle_type", ">", 12)],
+                "set": {"energy": "dir_y", "dir_x": -1}
+            }],
+            dtype="float64",
+        )
+        ys = modifier({"y_values": self.y_values})
+        larger = self.y_values["particle_type"] > 12
+        np.testing.assert_array_equal(
+            ys["a"], np.where(larger, self.y_values["dir_y"],
+                              self.y_values["energy"]))
+        np.testing.assert_array_equal(
+            ys["b"], np.where(larger, -1, self.y_values["dir_x"]))
+
+    def test_unknown_comparison(self):
+        with self.assertRaises(ValueError):
+            LabelModifier(columns={"a": "energy"}, overrides=[
+                {"where": [("is_cc", "=", 0)], "set": {"energy": 1}}])
@@ -1,7 +1,14 @@
 from unittest import TestCase
+from unittest.mock import patch
+import os
+import shutil
 import numpy as np
+import matplotlib.pyplot as plt
 
-from orcanet.utilities.visualization import get_ylims, get_epoch_xticks, sort_metrics
+from orcanet.core import Organizer
+from orcanet.utilities.visualization import get_ylims, get_epoch_xticks, \
+    sort_metrics, average_lines, SummaryPlotter, gaussian_smooth, \
+    lttb_indices, TrainValPlotter
 
 
 class TestFunctions(TestCase):
@@ -77,3 +84,122 @@ class TestFunctions(TestCase):
         target = ['e_err_loss', 'dx_err_loss']
         self.assertSequenceEqual(value, target)
 
+    def test_average_lines(self):
+        data = np.zeros(7, dtype=[("a", "<f8"), ("b", "<f8")])
+        data["a"] = np.arange(7)
+        data["b"] = [np.nan, 1, np.nan, np.nan, 2, 4, np.nan]
+        averaged = average_lines(data, 3)
+        np.testing.assert_array_equal(averaged["a"], [0.5, 2.5, 5])
+        np.testing.assert_array_equal(averaged["b"], [1, np.nan, 3])
+        np.testing.assert_array_equal(average_lines(data, None)["a"],
+                                      data["a"])
+
+    def test_gaussian_smooth_fft(self):
+        y = np.random.RandomState(0).rand(1000)
+        kernel_x = np.arange(-40, 41)
+        kernel = np.exp(-kernel_x**2 / 200) / np.sqrt(200 * np.pi)
+        target = np.convolve(np.pad(y, 40, "edge"), kernel, "valid")
+        np.testing.assert_allclose(gaussian_smooth(y, 10), target, atol=1e-12)
+
+    def test_gaussian_smooth_fft_nan(self):
+        y = np.random.RandomState(0).rand(1000)
+        y[[0, 500, 501]] = np.nan
+        kernel_x = np.arange(-40, 41)
+        kernel = np.exp(-kernel_x**2 / 200) / np.sqrt(200 * np.pi)
+        target = np.convolve(np.pad(y, 40, "edge"), kernel, "valid")
+        smoothed = gaussian_smooth(y, 10)
+        np.testing.assert_array_equal(np.isnan(smoothed), np.isnan(target))
+        self.assertEqual(np.sum(np.isfinite(smoothed)), 1000 - 41 - 82)
+        np.testing.assert_allclose(smoothed, target, atol=1e-12)
+
+    def test_lttb_indices(self):
+        x = np.arange(1000.)
+        y = np.sin(x / 100)
+        y[500] = 10
+        y[700] = -10
+        indices = lttb_indices(x, y, 50)
+        self.assertEqual(len(indices), 50)
+        self.assertEqual(indices[0], 0)
+        self.assertEqual(indices[-1], 999)
+        self.assertTrue(np.all(np.diff(indices) > 0))
+        self.assertIn(500, indices)
+        self.assertIn(700, indices)
+        np.testing.assert_array_equal(lttb_indices(x[:10], y[:10], 50),
+                                      np.arange(10))
+
+    def test_train_val_plotter_max_points(self):
+        tvp = TrainValPlotter(max_points=100)
+        y = np.linspace(1, 2, num=10000)
+        y[10] = np.nan
+        tvp.plot_curves((np.linspace(0, 2, num=10000), y), self.val_data)
+        self.assertEqual(len(tvp._xpoints_train), 100)
+        self.assertEqual(len(tvp._ypoints_train), 100)
+        self.assertFalse(np.any(np.isnan(tvp._ypoints_train)))
+        self.assertEqual(len(tvp._xpoints_val), 6)
+        tvp.apply_layout()
+        plt.close()
+
+
+class TestSummaryPlotter(TestCase):
+    def setUp(self):
+        self.temp_dir = os.path.join(os.path.dirname(__file__), ".temp",
+                                     "summary_plotter")
+        if os.path.exists(self.temp_dir):
+            shutil.rmtree(self.temp_dir)
+        shutil.copytree(os.path.join(os.path.dirname(__file__),
+                                     "data", "dummy_model"), self.temp_dir)
+        self.orga = Organizer(self.temp_dir)
+        self.orga.cfg.summary_plot_points = 1
+        self.plots_folder = os.path.join(self.temp_dir, "plots")
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_update(self):
+        self.orga.cfg.summary_plot_formats = ["pdf", "png"]
+        plotter = SummaryPlotter(self.orga, background=False)
+        with patch.object(self.orga.history, "plot_metric",
+                          wraps=self.orga.history.plot_metric) as plot_metric:
+            plotter.update()
+        self.assertCountEqual(
+            os.listdir(self.plots_folder),
+            ["summary_plot.pdf", "summary_plot_loss.png",
+             "summary_plot_acc.png", "summary_plot_lr.png"])
+        # the lines of each of the two train log files are averaged
+        full_train_data = plot_metric.call_args[1]["full_train_data"]
+        self.assertEqual(len(full_train_data), 2)
+
+    def test_update_reads_changed_logs_only(self):
+        plotter = SummaryPlotter(self.orga, background=False)
+        plotter.update()
+        with patch("orcanet.utilities.visualization.average_lines",
+                   wraps=average_lines) as mock_average_lines:
+            plotter.update()
+            self.assertEqual(mock_average_lines.call_count, 0)
+            with open(os.path.join(self.temp_dir, "train_log",
+                                   "log_epoch_1_file_2.txt"), "a") as f:
+                f.write("500 | 0.9 | 0.1 | 0.9\n")
+            plotter.update()
+            self.assertEqual(mock_average_lines.call_count, 1)
+
+    def test_update_background(self):
+        self.orga.cfg.summary_plot_formats = ["svg"]
+        plotter = SummaryPlotter(self.orga, background=True)
+        plotter.update()
+        plotter.wait()
+        self.assertCountEqual(
+            os.listdir(self.plots_folder),
+            ["summary_plot_loss.svg", "summary_plot_acc.svg",
+             "summary_plot_lr.svg"])
+
+    def test_update_background_failure_warns(self):
+        plotter = SummaryPlotter(self.orga, background=True)
+        plotter.formats = ["unknown"]
+        plotter.update()
+        with self.assertWarns(UserWarning):
+            plotter.wait()
+
+    def test_unknown_format(self):
+        self.orga.cfg.summary_plot_formats = ["jpg"]
+        with self.assertRaises(ValueError):
+            SummaryPlotter(self.orga)
@@ -0,0 +1,385 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import tempfile
+import time
+import h5py
+import numpy as np
+
+from orcanet.core import Organizer
+from orcanet.h5_generator import Hdf5BatchGenerator, ProcessLoader, \
+    get_n_buffers, get_y_field_names
+
+# the stages of reading out one batch, in order
+STAGES = ("read", "zero_center", "sample_modifier", "label_modifier")
+
+
+class PipelineBenchmark:
+    """
+    Measure the throughput of the input pipeline, without a model.
+
+    For every combination of the given batchsizes, shuffle modes, number
+    of worker processes and compressions, some batches are read out
+    with a Hdf5BatchGenerator. Without workers, the time of each stage is
+    measured separately: the raw read from the h5 files, zero centering,
+    and the sample and label modifiers. With workers, batches are read
+    with the ProcessLoader, and only the total time is measured.
+
+    Note that datasets read via memmaps (cfg.use_memmap) are only
+    read from disk when they are first used, e.g. during zero centering.
+
+    Attributes
+    ----------
+    orga : Organizer
+        Contains the configurable options, e.g. the modifiers, the zero
+        center folder, and the list file.
+    batchsizes : List
+        The batchsizes to use. Default: orga.cfg.batchsize.
+    shuffles : List
+        The shuffle modes to use (False, True or "chunks").
+    workers : List
+        The numbers of worker processes to use. 0 reads in this process.
+    compressions : List, optional
+        If given, the benchmark is done on synthetic files instead of the
+        first train files of the list file, which are generated with
+        each of these compressions. E.g. None, "lzf", "gzip" or "gzip:1".
+    synthetic_shape : tuple
+        Shape of one sample in the synthetic files.
+    synthetic_samples : int
+        Number of samples in the synthetic files.
+    synthetic_chunk_rows : int
+        Number of samples per chunk in the synthetic files.
+    n_batches : int
+        How many batches to read out for each combination.
+    zero_center : bool
+        Whether to zero center. Uses the zero center image of the orga if
+        orga.cfg.zero_center_folder is set, or a dummy image otherwise.
+
+    """
+    def __init__(self, orga,
+                 batchsizes=None,
+                 shuffles=(False, ),
+                 workers=(0, ),
+                 compressions=None,
+                 synthetic_shape=(11, 13, 18, 60),
+                 synthetic_samples=2000,
+                 synthetic_chunk_rows=32,
+                 n_batches=20,
+                 zero_center=True):
+        self.orga = orga
+        self.batchsizes = batchsizes
+        self.shuffles = shuffles
+        self.workers = workers
+        self.compressions = compressions
+        self.synthetic_shape = synthetic_shape
+        self.synthetic_samples = synthetic_samples
+        self.synthetic_chunk_rows = synthetic_chunk_rows
+        self.n_batches = n_batches
+        self.zero_center = zero_center
+
+    def run(self):
+        """
+        Run the benchmark for every combination of settings.
+
+        Returns
+        -------
+        records : List
+            One dict for each combination, with the settings, the time per
+            batch of each stage (only without workers), the total time per
+            batch and the samples per second.
+
+        """
+        batchsizes = self.batchsizes
+        if batchsizes is None:
+            batchsizes = [self.orga.cfg.batchsize]
+
+        records = []
+        temp_dir = tempfile.mkdtemp(prefix="orcanet_benchmark_")
+        try:
+            for compression, files_dict in self._get_files(temp_dir):
+                for batchsize in batchsizes:
+                    for shuffle in self.shuffles:
+                        for n_workers in self.workers:
+                            record = self._measure(
+                                files_dict, batchsize, shuffle, n_workers)
+                            record["compression"] = compression
+                            print(_format_record(record))
+                            records.append(record)
+        finally:
+            shutil.rmtree(temp_dir)
+        return records
+
+    def save(self, records, path):
+        """
+        Save the records as a json file, together with infos about the host.
+
+        Parameters
+        ----------
+        records : List
+            The output of run.
+        path : str
+            Path of the json file.
+
+        """
+        report = {
+            "host": platform.node(),
+            "cpu_count": os.cpu_count(),
+            "n_batches": self.n_batches,
+            "records": records,
+        }
+        with open(path + ".tmp", "w") as f:
+            json.dump(report, f, indent=2)
+        os.replace(path + ".tmp", path)
+
+    def _get_files(self, temp_dir):
+        """ Yield the compression and the files dict to benchmark on. """
+        if self.compressions is None:
+            files = self.orga.io.get_local_files("train")
+            files_dict = {key: files[key][0] for key in files}
+            first_file = list(files_dict.values())[0]
+            with h5py.File(first_file, "r") as f:
+                compression = f[self.orga.cfg.key_x_values].compression
+            yield compression, files_dict
+            return
+
+        for compression in self.compressions:
+            path = os.path.join(temp_dir, "synthetic_{}.h5".format(
+                str(compression).replace(":", "_")))
+            make_synthetic_file(
+                path, self.synthetic_samples, self.synthetic_shape,
+                compression=compression,
+                chunk_rows=self.synthetic_chunk_rows,
+                key_x_values=self.orga.cfg.key_x_values,
+                key_y_values=self.orga.cfg.key_y_values)
+            yield compression, {"input": path}
+
+    def _measure(self, files_dict, batchsize, shuffle, n_workers):
+        """ Read out batches with one combination of settings. """
+        cfg = self.orga.cfg
+        label_modifier = cfg.label_modifier
+        generator = Hdf5BatchGenerator(
+            files_dict,
+            batchsize=batchsize,
+            key_x_values=cfg.key_x_values,
+            key_y_values=cfg.key_y_values,
+            y_field_names=get_y_field_names(
+                label_modifier, cfg.sample_modifier),
+            sample_modifier=cfg.sample_modifier,
+            label_modifier=label_modifier,
+            shuffle=shuffle,
+            chunk_buffer=cfg.shuffle_chunk_buffer,
+            use_memmap=cfg.use_memmap,
+            **self._get_zero_center_options(files_dict),
+        )
+        n_batches = min(self.n_batches, len(generator))
+        record = {
+            "batchsize": batchsize,
+            "shuffle": shuffle,
+            "workers": n_workers,
+            "n_batches": n_batches,
+        }
+        if n_workers == 0:
+            try:
+                stage_times = _time_stages(generator, n_batches)
+            finally:
+                generator.close()
+            n_samples = stage_times.pop("n_samples")
+            total = sum(stage_times.values())
+            for stage in STAGES:
+                record[stage + "_s"] = stage_times[stage] / n_batches
+        else:
+            loader = ProcessLoader(generator, n_workers)
+            try:
+                n_samples = 0
+                start_time = time.perf_counter()
+                for batch_no, (xs, ys) in enumerate(loader, 1):
+                    n_samples += len(list(xs.values())[0])
+                    if batch_no == n_batches:
+                        break
+                total = time.perf_counter() - start_time
+            finally:
+                loader.close()
+        record["total_s"] = total / n_batches
+        record["samples_per_s"] = n_samples / total
+        return record
+
+    def _get_zero_center_options(self, files_dict):
+        """ The zero centering arguments of the Hdf5BatchGenerator. """
+        if not self.zero_center:
+            return {}
+        cfg = self.orga.cfg
+        if cfg.zero_center_folder is not None and self.compressions is None:
+            xs_mean = self.orga.get_xs_mean()
+            xs_std = self.orga.get_xs_std() if cfg.zero_center_scale else None
+        else:
+            # timing does not depend on the actual values
+            xs_mean, xs_std = {}, None
+            for key, path in files_dict.items():
+                with h5py.File(path, "r") as f:
+                    xs_mean[key] = np.zeros(f[cfg.key_x_values].shape[1:])
+        return {
+            "xs_mean": xs_mean,
+            "xs_std": xs_std,
+            "x_dtype": cfg.zero_center_dtype,
+            "n_buffers": get_n_buffers(self.orga),
+        }
+
+
+def _time_stages(generator, n_batches):
+    """
+    Read out batches like the Hdf5BatchGenerator does, and measure the
+    total time of each stage.
+
+    """
+    times = {stage: 0. for stage in STAGES}
+    n_samples = 0
+    for index in range(n_batches):
+        sample_pos = generator._sample_pos[index]
+
+        start_time = time.perf_counter()
+        x_values = {input_key: generator._read(
+                        input_key, generator.key_x_values, sample_pos)
+                    for input_key in generator._files}
+        y_values = generator.get_y_values(sample_pos)
+        times["read"] += time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        if generator.xs_mean is not None:
+            x_values = {input_key: generator._zero_center(input_key, x)
+                        for input_key, x in x_values.items()}
+        times["zero_center"] += time.perf_counter() - start_time
+
+        info_blob = {"x_values": x_values, "y_values": y_values}
+        start_time = time.perf_counter()
+        if generator.sample_modifier is not None:
+            info_blob["xs"] = generator.sample_modifier(info_blob)
+        times["sample_modifier"] += time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        if y_values is not None and generator.label_modifier is not None:
+            info_blob["ys"] = generator.label_modifier(info_blob)
+        times["label_modifier"] += time.perf_counter() - start_time
+
+        n_samples += len(list(x_values.values())[0])
+    times["n_samples"] = n_samples
+    return times
+
+
+def make_synthetic_file(path, n_samples, shape, compression=None,
+                        chunk_rows=32, key_x_values="x", key_y_values="y",
+                        n_fields=20):
+    """
+    Generate a h5 file with random samples and labels.
+
+    Parameters
+    ----------
+    path : str
+        Where to save the file.
+    n_samples : int
+        Number of samples.
+    shape : tuple
+        Shape of one sample.
+    compression : str or None
+        Compression of the datasets, e.g. "lzf", "gzip", or "gzip:4" for a
+        compression level.
+    chunk_rows : int
+        Number of samples per chunk.
+    key_x_values : str
+        Name of the dataset with the samples.
+    key_y_values : str
+        Name of the dataset with the labels.
+    n_fields : int
+        Number of fields of the labels.
+
+    """
+    compression_opts = None
+    if compression is not None and ":" in compression:
+        compression, compression_opts = compression.split(":")
+        compression_opts = int(compression_opts)
+    chunk_rows = min(chunk_rows, n_samples)
+    y_dtype = np.dtype([("field_{}".format(i), "<f8")
+                        for i in range(n_fields)])
+    with h5py.File(path, "w") as f:
+        x_dset = f.create_dataset(
+            key_x_values, shape=(n_samples, ) + tuple(shape), dtype="<f4",
+            chunks=(chunk_rows, ) + tuple(shape),
+            compression=compression, compression_opts=compression_opts)
+        y_dset = f.create_dataset(
+            key_y_values, shape=(n_samples, ), dtype=y_dtype,
+            chunks=(chunk_rows, ),
+            compression=compression, compression_opts=compression_opts)
+        for start in range(0, n_samples, chunk_rows):
+            stop = min(start + chunk_rows, n_samples)
+            # sparse, like hit images
+            x = np.random.poisson(0.1, (stop - start, ) + tuple(shape))
+            x_dset[start:stop] = x
+            y_dset[start:stop] = np.random.rand(
+                stop - start, n_fields).ravel().view(y_dtype)
+
+
+def _format_record(record):
+    """ One line of text with the results of one combination. """
+    line = "batchsize {batchsize}, shuffle {shuffle}, workers {workers}, " \
+           "compression {compression}: {samples_per_s:.1f} samples/s".format(
+            **record)
+    if record["workers"] == 0:
+        line += " ({})".format(", ".join(
+            ["{} {:.2f} ms".format(stage, 1000 * record[stage + "_s"])
+             for stage in STAGES]))
+    return line
+
+
+def _parse_shuffle(value):
+    """ Shuffle modes are given as false, true or chunks. """
+    return {"false": False, "true": True}.get(value.lower(), value)
+
+
+def _parse_compression(value):
+    return None if value.lower() == "none" else value
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=str(PipelineBenchmark.__doc__),
+        formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('-list_file', type=str, nargs="?",
+                        help="Toml list file. The first train files "
+                             "are used.")
+    parser.add_argument('-config_file', type=str, nargs="?")
+    parser.add_argument('-batchsizes', type=int, nargs="*")
+    parser.add_argument('-shuffles', type=_parse_shuffle, nargs="*",
+                        help="false, true or chunks")
+    parser.add_argument('-workers', type=int, nargs="*")
+    parser.add_argument('-compressions', type=_parse_compression, nargs="*",
+                        help="Use synthetic files, e.g. none lzf gzip:1")
+    parser.add_argument('-synthetic_shape', type=int, nargs="*")
+    parser.add_argument('-synthetic_samples', type=int, nargs="?")
+    parser.add_argument('-n_batches', type=int, nargs="?")
+    parser.add_argument('-no_zero_center', action="store_true")
+    parser.add_argument('-output', type=str, default="benchmark.json",
+                        help="Path of the json report.")
+    args = vars(parser.parse_args())
+    list_file = args.pop("list_file")
+    config_file = args.pop("config_file")
+    output = args.pop("output")
+    args["zero_center"] = not args.pop("no_zero_center")
+    for key in list(args.keys()):
+        if args[key] is None:
+            args.pop(key)
+    if list_file is None and "compressions" not in args:
+        args["compressions"] = [None]
+
+    temp_dir = tempfile.mkdtemp(prefix="orcanet_benchmark_")
+    try:
+        orga = Organizer(temp_dir, list_file, config_file)
+        benchmark = PipelineBenchmark(orga, **args)
+        benchmark.save(benchmark.run(), output)
+    finally:
+        shutil.rmtree(temp_dir)
+    print("Saved report to {}".format(output))
+
+
+if __name__ == '__main__':
+    main()
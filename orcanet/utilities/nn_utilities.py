@@ -5,8 +5,19 @@
 import numpy as np
 import h5py
 import os
+import hashlib
+import json
+import multiprocessing
+from contextlib import contextmanager
 import keras as ks
-from functools import reduce
+try:
+    import fcntl
+except ImportError:
+    # not available on non-posix systems
+    fcntl = None
+
+# Name of the index file in the zero center folder
+ZERO_CENTER_INDEX = "zero_center_index.json"
 
 
 def get_auto_label_modifier(model):
@@ -32,6 +43,8 @@ def get_auto_label_modifier(model):
         y_values = info_blob["y_values"]
         ys = {name: y_values[name] for name in names}
         return ys
+    # only these fields have to be read from the files
+    label_modifier.y_field_names = list(names)
     return label_modifier
 
 
@@ -95,7 +108,8 @@ def load_zero_center_data(orga, logging=False):
 
     The arrays are either loaded from a previously saved .npz file or they
     are calculated on the fly by calculating the mean value per bin for the
-    given training files. The name of the saved image is derived from the
+    given training files. The variance per bin is saved in the .npz file
+    as well (as xs_var). The name of the saved image is derived from the
     name of the list file which was given to the cfg.
 
     Parameters
@@ -141,11 +155,12 @@ def load_zero_center_data(orga, logging=False):
             orga.io.print_log('{}:   Making new zero centering'.format(
                 input_key), logging)
 
-            xs_mean_ip_i = make_xs_mean(train_filepaths, key_samples)
-            filename = zero_center_folder + train_files_list_name \
-                                          + '_input_' + str(input_key) + '.npz'
-            np.savez(filename, xs_mean=xs_mean_ip_i,
-                     zero_center_used_ip_files=train_filepaths)
+            xs_mean_ip_i, xs_var_ip_i = make_xs_stats(
+                train_filepaths, key_samples)
+            filename = save_xs_mean(
+                zero_center_folder,
+                train_files_list_name + '_input_' + str(input_key),
+                train_filepaths, xs_mean=xs_mean_ip_i, xs_var=xs_var_ip_i)
 
             orga.io.print_log('\tSaved as {} with shape {}'.format(
                 os.path.basename(filename), xs_mean_ip_i.shape), logging)
@@ -156,13 +171,59 @@ def load_zero_center_data(orga, logging=False):
     return xs_mean
 
 
+def load_zero_center_std(orga):
+    """
+    Gets the standard deviation of each bin of the train data.
+
+    It is read from the .npz files that load_zero_center_data
+    has created.
+
+    Parameters
+    ----------
+    orga : object Organizer
+        Contains all the configurable options in the OrcaNet scripts.
+
+    Returns
+    -------
+    xs_std : dict
+        Dict of ndarray(s) with the standard deviation, in the same
+        format as the xs_mean from load_zero_center_data.
+
+    Raises
+    ------
+    ValueError
+        If there is no saved xs_var for the train files, e.g. because
+        the .npz file was made with an older version of OrcaNet.
+
+    """
+    zero_center_folder = orga.cfg.zero_center_folder
+    if not zero_center_folder.endswith("/"):
+        zero_center_folder += "/"
+
+    xs_std = {}
+    for input_key, train_filepaths in orga.cfg.get_files("train").items():
+        xs_mean_path = get_xs_mean_path(zero_center_folder, train_filepaths)
+        if xs_mean_path is None:
+            raise ValueError("No zero center file found for input " +
+                             str(input_key))
+        zero_center_file = np.load(xs_mean_path)
+        if "xs_var" not in zero_center_file:
+            raise ValueError(
+                "Zero center file {} has no xs_var. Delete it to calculate "
+                "it again.".format(xs_mean_path))
+        xs_std[input_key] = np.sqrt(zero_center_file["xs_var"])
+    return xs_std
+
+
 def get_xs_mean_path(zero_center_folder, train_filepaths):
     """
     Search for precalculated xs_mean arrays in the zero_center_folder.
 
-    The function opens every .npz file in the zero center folder and checks
-    if the files used to generate this xs_mean (stored as subarray
-    'zero_center_used_ip_files') is the same as the given train_filepaths.
+    The .npz files in the zero center folder are registered in an index
+    file, under a key made from the filepaths, sizes and modification
+    times of the files used to generate them (see get_zero_center_key).
+    Changing one of the files will thus invalidate the saved xs_mean.
+    .npz files from before the index existed are added to it once.
 
     Parameters
     ----------
@@ -178,24 +239,185 @@ def get_xs_mean_path(zero_center_folder, train_filepaths):
         it exists in the zero_center_files. If not, returns None.
 
     """
-    xs_mean_path = None
-
     if not os.path.isdir(zero_center_folder):
-        os.mkdir(zero_center_folder)
+        os.makedirs(zero_center_folder, exist_ok=True)
+
+    key = get_zero_center_key(train_filepaths)
+    index_path = os.path.join(zero_center_folder, ZERO_CENTER_INDEX)
+    if os.path.exists(index_path):
+        with _locked(zero_center_folder, exclusive=False):
+            index = _read_index(zero_center_folder)
+    elif not os.access(zero_center_folder, os.W_OK):
+        # read-only folder: index the existing files only in memory
+        index = {}
+        _add_legacy_files(zero_center_folder, index)
+    else:
+        with _locked(zero_center_folder, exclusive=True):
+            index = _read_index(zero_center_folder)
+            if not os.path.exists(index_path):
+                _add_legacy_files(zero_center_folder, index)
+                _write_index(zero_center_folder, index)
+
+    entry = index.get(key)
+    if entry is None:
+        return None
+    xs_mean_path = os.path.join(zero_center_folder, entry["file"])
+    if not os.path.exists(xs_mean_path):
+        return None
+    return xs_mean_path
 
-    for file in os.listdir(zero_center_folder):
-        if not file.endswith('.npz'):
-            continue
-        file = zero_center_folder + file
-        used_ip_files = np.load(file)['zero_center_used_ip_files']
-        if np.array_equal(used_ip_files, train_filepaths):
-            xs_mean_path = file
-            break
 
+def save_xs_mean(zero_center_folder, name, train_filepaths, **arrays):
+    """
+    Save the zero center arrays to a .npz file and add it to the index.
+
+    Other entries for the same train_filepaths are outdated (since
+    some of the files have changed), so they are removed.
+    Several processes can save to the same folder at the same time.
+
+    Parameters
+    ----------
+    zero_center_folder : str
+        Full path to the folder where the zero_centering arrays are stored.
+    name : str
+        Name of the .npz file (without the extension). A hash is appended
+        if another entry in the index uses this name already.
+    train_filepaths : list
+        The filepaths of all train_files.
+    arrays : dict
+        The arrays to save, e.g. xs_mean.
+
+    Returns
+    -------
+    xs_mean_path : str
+        The path of the .npz file.
+
+    """
+    key = get_zero_center_key(train_filepaths)
+    used_files = [str(path) for path in train_filepaths]
+    with _locked(zero_center_folder, exclusive=True):
+        index = _read_index(zero_center_folder)
+        for old_key, entry in list(index.items()):
+            if old_key != key and entry["used_ip_files"] == used_files:
+                index.pop(old_key)
+                old_path = os.path.join(zero_center_folder, entry["file"])
+                if os.path.exists(old_path):
+                    os.remove(old_path)
+
+        filename = name + ".npz"
+        if any(entry["file"] == filename for old_key, entry in index.items()
+               if old_key != key):
+            filename = "{}_{}.npz".format(name, key[:10])
+        xs_mean_path = os.path.join(zero_center_folder, filename)
+
+        temp_path = xs_mean_path + ".tmp"
+        with open(temp_path, "wb") as f:
+            np.savez(f, zero_center_used_ip_files=train_filepaths, **arrays)
+        os.replace(temp_path, xs_mean_path)
+
+        index[key] = {"file": filename, "used_ip_files": used_files}
+        _write_index(zero_center_folder, index)
     return xs_mean_path
 
 
-def make_xs_mean(filepaths, key_samples, total_memory=4e9):
+def get_zero_center_key(train_filepaths):
+    """
+    Get a key which identifies the given files in their current state.
+
+    Parameters
+    ----------
+    train_filepaths : list
+        The filepaths of all train_files.
+
+    Returns
+    -------
+    key : str
+        A hash of the filepaths, together with their sizes and
+        modification times.
+
+    """
+    file_infos = []
+    for path in train_filepaths:
+        path = str(path)
+        try:
+            stat = os.stat(path)
+            file_infos.append([path, stat.st_size, stat.st_mtime_ns])
+        except FileNotFoundError:
+            file_infos.append([path, None, None])
+    return hashlib.sha256(json.dumps(file_infos).encode()).hexdigest()
+
+
+@contextmanager
+def _locked(zero_center_folder, exclusive=True):
+    """
+    Lock the index of the zero center folder.
+
+    Readers only take a shared lock, and do not need write access.
+    If the lock file can not be opened, or the file system does not
+    support locking (e.g. some network file systems), the index is used
+    without a lock. It is still always replaced atomically when written,
+    so this can only lose entries that are saved at the same time.
+
+    """
+    lock_path = os.path.join(zero_center_folder, ".zero_center_index.lock")
+    if fcntl is None:
+        yield
+        return
+    try:
+        lock_file = open(lock_path, "a" if exclusive else "r")
+    except OSError:
+        # e.g. read-only folder, or no lock file for readers yet
+        yield
+        return
+    with lock_file:
+        try:
+            fcntl.flock(lock_file,
+                        fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        except OSError:
+            # locking is not supported, e.g. ENOSYS or EOPNOTSUPP
+            yield
+            return
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _read_index(zero_center_folder):
+    """ Read the index. Needs to be locked. """
+    index_path = os.path.join(zero_center_folder, ZERO_CENTER_INDEX)
+    if not os.path.exists(index_path):
+        return {}
+    with open(index_path) as f:
+        return json.load(f)
+
+
+def _write_index(zero_center_folder, index):
+    """ Write the index. Needs to be locked exclusively. """
+    index_path = os.path.join(zero_center_folder, ZERO_CENTER_INDEX)
+    temp_path = index_path + ".tmp"
+    with open(temp_path, "w") as f:
+        json.dump(index, f, indent=1)
+    os.replace(temp_path, index_path)
+
+
+def _add_legacy_files(zero_center_folder, index):
+    """ Add the .npz files in the folder that are not in the index yet. """
+    indexed = {entry["file"] for entry in index.values()}
+    for file in sorted(os.listdir(zero_center_folder)):
+        if not file.endswith('.npz') or file in indexed:
+            continue
+        try:
+            used_ip_files = np.load(os.path.join(
+                zero_center_folder, file))['zero_center_used_ip_files']
+        except (KeyError, OSError, ValueError):
+            continue
+        used_files = [str(path) for path in used_ip_files]
+        index[get_zero_center_key(used_files)] = {
+            "file": file, "used_ip_files": used_files}
+
+
+def make_xs_mean(filepaths, key_samples, total_memory=4e9, n_processes=None):
     """
     Calculates the zero center image of a dataset.
 
@@ -214,6 +436,9 @@ def make_xs_mean(filepaths, key_samples, total_memory=4e9):
         check available memory and divide the mean calculation in steps
         total_memory = 4e9  # * n_gpu # In bytes.
         Take max. 1/2 of what is available per GPU (16G), just to make sure.
+    n_processes : int or None
+        Number of processes that go through the files in parallel.
+        Default: One per file, up to the number of cpus.
 
     Returns
     -------
@@ -221,59 +446,153 @@ def make_xs_mean(filepaths, key_samples, total_memory=4e9):
         The zero center image.
 
     """
-    xs_means = []
-    file_sizes = []
-
-    for filepath in filepaths:
-
-        with h5py.File(filepath, "r") as file:
-            filesize = get_array_memsize(file['x'])
-            steps = int(np.ceil(filesize/total_memory))
-            n_rows = file[key_samples].shape[0]
-            stepsize = int(n_rows / float(steps))
-
-            # create xs_mean_arr that stores intermediate mean_temp results
-            xs_mean_arr = np.zeros((steps, ) + file['x'].shape[1:],
-                                   dtype=np.float64)
-            print("\tCalculating for file: " + filepath)
-            for i in range(steps):
-                if i % 5 == 0:
-                    print('\t   Step ' + str(i) + " of " + str(steps))
-
-                # for the last step, calculate mean till the end of the file
-                if i == steps-1 or steps == 1:
-                    xs_mean_temp = np.mean(
-                        file[key_samples][i * stepsize: n_rows],
-                        axis=0, dtype=np.float64)
-                else:
-                    xs_mean_temp = np.mean(
-                        file[key_samples][i*stepsize: (i+1) * stepsize],
-                        axis=0, dtype=np.float64)
-
-                xs_mean_arr[i] = xs_mean_temp
-
-        print("\tDone!")
-        # The mean for this file
-        xs_means.append(np.mean(xs_mean_arr, axis=0,
-                                dtype=np.float64).astype(np.float32))
-        # the number of samples in this file
-        file_sizes.append(n_rows)
-
-    # calculate weighted average depending on no of samples in the files
-    file_sizes = [size / np.sum(file_sizes) for size in file_sizes]
-    xs_mean = np.average(xs_means, weights=file_sizes, axis=0)
+    xs_mean, xs_var = make_xs_stats(filepaths, key_samples,
+                                    total_memory=total_memory,
+                                    n_processes=n_processes)
     return xs_mean
 
 
-def get_array_memsize(array):
+def make_xs_stats(filepaths, key_samples, total_memory=4e9, n_processes=None):
+    """
+    Calculates the mean and the variance of each bin of a dataset.
+
+    The files are read in parallel in steps of whole chunks,
+    so that every chunk is decompressed only once. The statistics of the
+    steps and files are combined in a numerically stable way
+    (see MeanVarAccumulator). The processes are spawned, since
+    tensorflow has usually been used in this process already.
+
+    Parameters
+    ----------
+    filepaths : List
+        Filepaths of the data files with the samples.
+    key_samples : str
+        The name of the datagroup in your h5 input files which contains
+        the samples to the network.
+    total_memory : int
+        How much memory all processes together may use for reading, in bytes.
+        This includes the float64 array the samples are converted to.
+    n_processes : int or None
+        Number of processes that go through the files in parallel.
+        Default: One per file, up to the number of cpus.
+
+    Returns
+    -------
+    xs_mean : ndarray
+        The mean of the samples.
+    xs_var : ndarray
+        The variance of the samples.
+
+    """
+    if n_processes is None:
+        n_processes = min(len(filepaths), os.cpu_count() or 1)
+    memory = total_memory / max(n_processes, 1)
+    args = [(filepath, key_samples, memory) for filepath in filepaths]
+
+    if n_processes > 1:
+        context = multiprocessing.get_context("spawn")
+        with context.Pool(n_processes) as pool:
+            file_stats = pool.starmap(_get_file_stats, args)
+    else:
+        file_stats = [_get_file_stats(*arg) for arg in args]
+
+    stats = MeanVarAccumulator()
+    for file_stat in file_stats:
+        stats.merge(file_stat)
+    return stats.mean, stats.var
+
+
+def _get_file_stats(filepath, key_samples, memory):
     """
-    Calculates the approximate memory size of an array.
-    :param ndarray array: an array.
-    :return: float memsize: size of the array in bytes.
+    Get a MeanVarAccumulator for the samples in a file.
+
+    The file is read in steps of whole chunks, such that each step
+    takes up at most memory bytes, together with the float64 array
+    of the same shape used in MeanVarAccumulator.update.
+
     """
-    shape = array.shape
-    n_numbers = reduce(lambda x, y: x*y, shape)  # number of entries in an array
-    precision = 8  # Precision of each entry, typically uint8 for xs datasets
-    memsize = (n_numbers * precision) / float(8)  # in bytes
+    print("\tCalculating for file: " + filepath)
+    stats = MeanVarAccumulator()
+    with h5py.File(filepath, "r") as file:
+        dataset = file[key_samples]
+        n_rows = dataset.shape[0]
+        if dataset.chunks is None:
+            chunk_rows = 1
+        else:
+            chunk_rows = dataset.chunks[0]
+        row_memsize = np.prod(dataset.shape[1:], dtype=np.float64) * (
+            dataset.dtype.itemsize + 8)
+        step_rows = max(1, int(memory / row_memsize / chunk_rows)) * chunk_rows
 
-    return memsize
+        for start in range(0, n_rows, step_rows):
+            stats.update(dataset[start: start + step_rows])
+    print("\tDone: " + filepath)
+    return stats
+
+
+class MeanVarAccumulator:
+    """
+    Calculates the mean and the variance of arrays along the first axis,
+    which are given in one or more blocks.
+
+    The blocks are combined with the parallel algorithm of Chan et al.,
+    which is a generalization of Welford's online algorithm.
+
+    """
+    def __init__(self):
+        self.n = 0
+        self.mean = None
+        # sum of squared differences from the mean
+        self.m2 = None
+
+    @property
+    def var(self):
+        """ The (population) variance. """
+        if self.n == 0:
+            return None
+        return self.m2 / self.n
+
+    def update(self, block):
+        """ Add the samples of a block. """
+        block_stats = MeanVarAccumulator()
+        block_stats.n = len(block)
+        if block_stats.n == 0:
+            return
+        block_stats.mean = np.mean(block, axis=0, dtype=np.float64)
+        # only one float64 array of the size of the block
+        diffs = np.subtract(block, block_stats.mean, dtype=np.float64)
+        np.square(diffs, out=diffs)
+        block_stats.m2 = np.sum(diffs, axis=0)
+        self.merge(block_stats)
+
+    def merge(self, other):
+        """ Add the samples of another MeanVarAccumulator. """
+        if other.n == 0:
+            return
+        if self.n == 0:
+            self.n, self.mean, self.m2 = other.n, other.mean, other.m2
+            return
+        n = self.n + other.n
+        delta = other.mean - self.mean
+        self.mean = self.mean + delta * other.n / n
+        self.m2 = self.m2 + other.m2 + np.square(delta) * self.n * other.n / n
+        self.n = n
+
+
+def get_array_memsize(array):
+    """
+    Calculates the memory size of an array.
+
+    Parameters
+    ----------
+    array : ndarray or h5py.Dataset
+        An array.
+
+    Returns
+    -------
+    memsize : float
+        Size of the array in bytes.
+
+    """
+    n_numbers = np.prod(array.shape, dtype=np.float64)
+    return float(n_numbers * array.dtype.itemsize)
@@ -3,6 +3,10 @@
 Visualization tools used without Keras.
 Makes performance graphs for training and validating.
 """
+import os
+import multiprocessing
+import traceback
+import warnings
 import numpy as np
 
 import matplotlib.pyplot as plt
@@ -20,10 +24,17 @@ class TrainValPlotter:
     2. When all lines are plotted, use tvp.apply_layout() once for proper
         scaling, ylims, etc.
 
+    Train curves with more than max_points points are decimated with
+    the largest triangle three buckets algorithm, which keeps the
+    shape of the curve including its peaks. The ylims are calculated
+    from the decimated points.
+
     """
-    def __init__(self):
+    def __init__(self, max_points=10000):
         # White space added below and above points
         self.y_lim_padding = [0.10, 0.25]
+        # Maximum number of points drawn per train curve, None for all
+        self.max_points = max_points
         # Store all plotted points for setting x/y lims
         self._xpoints_train = np.array([])
         self._xpoints_val = np.array([])
@@ -60,7 +71,8 @@ class TrainValPlotter:
         color : str, optional
             Color used for the train/val line.
         smooth_sigma : int, optional
-            Apply gaussian blur to the train curve with given sigma.
+            Apply gaussian blur to the train curve with given sigma. The train
+            curve is smoothed before it is decimated.
         tlw : float
             Linewidth of train curve.
         vlw : float
@@ -77,6 +89,11 @@ class TrainValPlotter:
             epoch, y_data = train_data
             if smooth_sigma is not None:
                 y_data = gaussian_smooth(y_data, smooth_sigma)
+            if self.max_points is not None and len(y_data) > self.max_points:
+                epoch, y_data = skip_nans((np.asarray(epoch),
+                                           np.asarray(y_data)))
+                indices = lttb_indices(epoch, y_data, self.max_points)
+                epoch, y_data = epoch[indices], y_data[indices]
 
             self._xpoints_train = np.concatenate((self._xpoints_train, epoch))
             self._ypoints_train = np.concatenate((self._ypoints_train, y_data))
@@ -173,15 +190,90 @@ class TrainValPlotter:
 
 
 def gaussian_smooth(y, sigma, truncate=4):
-    """ Smooth a 1d ndarray with a gaussian filter. """
+    """
+    Smooth a 1d ndarray with a gaussian filter.
+
+    Long kernels are applied via fft, which takes n log n instead of
+    n * kernel width operations. Like with the direct convolution, a nan
+    only makes the points within one kernel width around it nan.
+
+    """
     # kernel_width = 2 * sigma * truncate + 1
     kernel_x = np.arange(-truncate * sigma, truncate * sigma + 1)
     kernel = _gauss(kernel_x, 0, sigma)
     y = np.pad(np.asarray(y), int(len(kernel)/2), "edge")
-    blurred = np.convolve(y, kernel, "valid")
+    if len(kernel) > 64:
+        # the fft would spread nans over the whole curve
+        nans = np.isnan(y)
+        blurred = _fft_convolve_valid(np.where(nans, 0, y), kernel)
+        if nans.any():
+            nan_counts = np.concatenate([[0], np.cumsum(nans)])
+            in_window = nan_counts[len(kernel):] - nan_counts[:-len(kernel)]
+            blurred[in_window > 0] = np.nan
+    else:
+        blurred = np.convolve(y, kernel, "valid")
     return blurred
 
 
+def _fft_convolve_valid(y, kernel):
+    """ Same as np.convolve(y, kernel, "valid"), but via fft. """
+    n_full = len(y) + len(kernel) - 1
+    n_fft = 1 << int(np.ceil(np.log2(n_full)))
+    full = np.fft.irfft(
+        np.fft.rfft(y, n_fft) * np.fft.rfft(kernel, n_fft), n_fft)[:n_full]
+    return full[len(kernel) - 1:len(y)]
+
+
+def lttb_indices(x, y, n_out):
+    """
+    Select points of a curve with the largest triangle three buckets
+    algorithm.
+
+    The first and the last point are always kept. The points in between
+    are split into n_out - 2 buckets, and from each bucket the point is
+    taken that forms the largest triangle with the point taken from the
+    previous bucket, and the average of the next bucket.
+
+    Parameters
+    ----------
+    x : ndarray
+        X data of the curve, sorted.
+    y : ndarray
+        Y data of the curve, without nans.
+    n_out : int
+        Number of points to select.
+
+    Returns
+    -------
+    indices : ndarray
+        Indices of the selected points, sorted.
+
+    """
+    n_points = len(x)
+    if n_out >= n_points or n_out < 3:
+        return np.arange(min(n_points, max(n_out, 0)))
+    # bucket edges of the points between the first and the last
+    edges = np.linspace(1, n_points - 1, n_out - 1).astype(int)
+    # averages of each bucket, and of the last point as the final bucket
+    counts = np.diff(edges)
+    x_means = np.append(np.add.reduceat(x[:-1], edges[:-1]) / counts, x[-1])
+    y_means = np.append(np.add.reduceat(y[:-1], edges[:-1]) / counts, y[-1])
+
+    indices = np.empty(n_out, dtype=int)
+    indices[0], indices[-1] = 0, n_points - 1
+    previous = 0
+    for bucket in range(n_out - 2):
+        start, stop = edges[bucket], edges[bucket + 1]
+        x_prev, y_prev = x[previous], y[previous]
+        # twice the triangle areas, the constant factor does not matter
+        areas = np.abs(
+            (x_prev - x_means[bucket + 1]) * (y[start:stop] - y_prev) -
+            (x_prev - x[start:stop]) * (y_means[bucket + 1] - y_prev))
+        previous = start + np.argmax(areas)
+        indices[bucket + 1] = previous
+    return indices
+
+
 def _gauss(x, mu=0, sigma=1):
     return (1/(np.sqrt(2*np.pi)*sigma)) * np.exp(-np.power(x - mu, 2.) / (2 * np.power(sigma, 2.)))
 
@@ -191,6 +283,7 @@ def plot_history(train_data,
                  train_label="training",
                  val_label="validation",
                  color=None,
+                 max_points=10000,
                  **kwargs):
     """
     Plot the train/val curves in a single plot.
@@ -198,7 +291,7 @@ def plot_history(train_data,
     For backward compat. Functionality moved to TrainValPlotter
 
     """
-    tvp = TrainValPlotter()
+    tvp = TrainValPlotter(max_points=max_points)
     tvp.plot_curves(train_data,
                     val_data,
                     train_label=train_label,
@@ -351,33 +444,191 @@ def update_summary_plot(orga):
         Contains all the configurable options in the OrcaNet scripts.
 
     """
-    plt.ioff()
-    pdf_name = orga.io.get_subfolder("plots", create=True) + "/summary_plot.pdf"
+    SummaryPlotter(orga, background=False).update()
+
 
-    # Extract the names of the metrics
-    all_metrics = orga.history.get_metrics()
-    # Sort them
-    all_metrics = sort_metrics(all_metrics)
+class SummaryPlotter:
+    """
+    For updating the summary plot repeatedly during training.
+
+    The training log files are only read again if they have changed,
+    and the lines of every file are averaged down to at most
+    cfg.summary_plot_points lines, which are kept. This way, the
+    time for plotting does not grow much with the length of the training.
+    If background is True, the plots are rendered in a spawned
+    process, so that the training can continue in the meantime. The
+    process gets the data to plot, and failed plots only give a warning.
+
+    """
+    def __init__(self, orga, background=None):
+        """
+        Parameters
+        ----------
+        orga : object Organizer
+            Contains all the configurable options in the OrcaNet scripts.
+        background : bool, optional
+            Render in a background process. Default: Read from
+            orga.cfg.summary_plot_background.
+
+        """
+        if background is None:
+            background = orga.cfg.summary_plot_background
+        for plot_format in orga.cfg.summary_plot_formats:
+            if plot_format not in ("pdf", "png", "svg"):
+                raise ValueError(
+                    "Unknown summary plot format {}, must be pdf, png or "
+                    "svg".format(plot_format))
+        self.orga = orga
+        self.background = background
+        self.max_points = orga.cfg.summary_plot_points
+        self.formats = orga.cfg.summary_plot_formats
+
+        # keys are (epoch, fileno), values the log as read out, and its
+        # averaged lines
+        self._train_logs = {}
+        self._process = None
+
+    def update(self):
+        """
+        Plot all metrics and the learning rate.
+
+        If rendering in the background, the previous plots are waited for
+        first.
+
+        """
+        self.wait()
+        summary_data = self.orga.history.get_summary_data()
+        full_train_data = self._get_train_data()
+        plots_folder = self.orga.io.get_subfolder("plots", create=True)
+        all_metrics = sort_metrics(self.orga.history.get_metrics())
+        args = (self.orga.history, plots_folder, all_metrics, summary_data,
+                full_train_data, self.formats)
+
+        if not self.background:
+            _plot_summary(*args)
+        else:
+            # tensorflow and the threads of the training are running in
+            # this process, so fork is not safe
+            ctx = multiprocessing.get_context("spawn")
+            self._process = ctx.Process(target=_plot_summary_process,
+                                        args=args)
+            self._process.start()
+
+    def wait(self):
+        """ Wait until the plots rendered in the background are done. """
+        if self._process is None:
+            return
+        self._process.join()
+        exitcode = self._process.exitcode
+        self._process = None
+        if exitcode != 0:
+            warnings.warn(
+                "Updating the summary plot failed (exit code {})".format(
+                    exitcode))
+
+    def _get_train_data(self):
+        """ Get the averaged lines of all training log files. """
+        train_logs = self.orga.history.get_train_logs()
+        for epoch_file, file_data in train_logs.items():
+            cached = self._train_logs.get(epoch_file)
+            if cached is None or cached[0] is not file_data:
+                self._train_logs[epoch_file] = (
+                    file_data, average_lines(file_data, self.max_points))
+        self._train_logs = {epoch_file: self._train_logs[epoch_file]
+                            for epoch_file in train_logs}
+        return self.orga.history.get_train_data(train_logs={
+            epoch_file: averaged
+            for epoch_file, (file_data, averaged) in self._train_logs.items()})
+
+
+def average_lines(data, max_lines):
+    """
+    Average consecutive lines of a structured array, so that there are
+    at most max_lines lines. nan values are ignored.
+
+    Parameters
+    ----------
+    data : ndarray
+        Structured array with float fields.
+    max_lines : int or None
+        Maximum number of lines. None for no averaging.
+
+    Returns
+    -------
+    averaged : ndarray
+        The averaged structured array.
+
+    """
+    data = data.reshape(-1)
+    if max_lines is None or len(data) <= max_lines:
+        return data
+    starts = np.linspace(0, len(data), max_lines, endpoint=False).astype(int)
+    averaged = np.empty(max_lines, dtype=data.dtype)
+    for name in data.dtype.names:
+        values = data[name]
+        is_nan = np.isnan(values)
+        sums = np.add.reduceat(np.where(is_nan, 0, values), starts)
+        counts = np.add.reduceat(~is_nan, starts)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            averaged[name] = sums / counts
+    return averaged
+
+
+def _plot_summary_process(*args):
+    try:
+        _plot_summary(*args)
+    except Exception:
+        traceback.print_exc()
+        raise
+
+
+def _plot_summary(history, plots_folder, all_metrics, summary_data,
+                  full_train_data, formats):
+    """
+    Plot the pages of the summary plot, and save them in the given
+    formats. The pdf contains all pages, the other formats one file per
+    page. Files are written under a temporary name first.
+
+    """
+    plt.ioff()
     # Plot them w/ custom color cycle
     colors = ['#000000', '#332288', '#88CCEE', '#44AA99', '#117733', '#999933',
               '#DDCC77', '#CC6677', '#882255', '#AA4499', '#661100', '#6699CC',
               '#AA4466', '#4477AA']  # ref. personal.sron.nl/~pault/
     color_counter = 0
-    with PdfPages(pdf_name) as pdf:
-        for metric_no, metric in enumerate(all_metrics):
-            # If this metric is an err metric of a variable, color it the same
-            if all_metrics[metric_no-1] == metric.replace("_err", ""):
-                color_counter -= 1
-            orga.history.plot_metric(
-                metric, color=colors[color_counter % len(colors)])
-            color_counter += 1
-            pdf.savefig()
-            plt.clf()
-
-        orga.history.plot_lr()
+    pages = []
+    for metric_no, metric in enumerate(all_metrics):
+        # If this metric is an err metric of a variable, color it the same
+        if all_metrics[metric_no-1] == metric.replace("_err", ""):
+            color_counter -= 1
+        pages.append((metric, history.plot_metric, dict(
+            metric_name=metric, color=colors[color_counter % len(colors)],
+            summary_data=summary_data, full_train_data=full_train_data)))
         color_counter += 1
-        pdf.savefig()
+    pages.append(("lr", history.plot_lr,
+                  dict(summary_data=summary_data)))
+
+    pdf_name = plots_folder + "/summary_plot.pdf"
+    pdf = PdfPages(pdf_name + ".tmp") if "pdf" in formats else None
+    try:
+        for page_name, plot_function, kwargs in pages:
+            plot_function(**kwargs)
+            if pdf is not None:
+                pdf.savefig()
+            for plot_format in formats:
+                if plot_format == "pdf":
+                    continue
+                plot_name = "{}/summary_plot_{}.{}".format(
+                    plots_folder, page_name, plot_format)
+                plt.savefig(plot_name + ".tmp", format=plot_format)
+                os.replace(plot_name + ".tmp", plot_name)
+            plt.clf()
+    finally:
+        if pdf is not None:
+            pdf.close()
         plt.close()
+    if pdf is not None:
+        os.replace(pdf_name + ".tmp", pdf_name)
 
 
 def sort_metrics(metric_names):
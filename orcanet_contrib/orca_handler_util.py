@@ -4,13 +4,72 @@
 Michael's orcanet utility stuff.
 
 """
+import threading
 import numpy as np
 import toml
 
 from orcanet_contrib.custom_objects import get_custom_objects
 
-
-def update_objects(orga, model_file):
+# assuming input is bxyzt
+XYZT_PERMUTE = {'yzt-x': (0, 2, 3, 4, 1),
+                'xyt-z': (0, 1, 2, 4, 3),
+                't-xyz': (0, 4, 1, 2, 3),
+                'tyz-x': (0, 4, 2, 3, 1)}
+
+# Sample modifiers, given as specs for the SampleModifier
+ORCA_SAMPLE_SPECS = {
+    # Use xyz-t, and also transpose it to yzt-x and use that, too.
+    'xyz-t_and_yzt-x': {
+        'xyz-t': 'xyz-t',
+        'yzt-x': ('transpose', 'xyz-t', XYZT_PERMUTE['yzt-x']),
+    },
+    # Concatenate xyz-t and xyz-c to a single input,
+    # and transpose xyz-t to yzt-x and use that, too.
+    'xyz-t_and_xyz-c_single_input_and_yzt-x': {
+        'xyz-t_and_xyz-c_single_input_net_0':
+            ('concat', ('xyz-t', 'xyz-c'), -1),
+        'input_1_net_1': ('transpose', 'xyz-t', XYZT_PERMUTE['yzt-x']),
+    },
+    # Use xyz-t in two different time cuts, and also transpose them to
+    # yzt-x and use these, too.
+    'xyz-t_and_yzt-x_multi_input_single_train_tight-1_tight-2': {
+        'xyz-t_tight-1': 'xyz-t_tight-1',
+        'xyz-t_tight-2': 'xyz-t_tight-2',
+        'yzt-x_tight-1': ('transpose', 'xyz-t_tight-1', XYZT_PERMUTE['yzt-x']),
+        'yzt-x_tight-2': ('transpose', 'xyz-t_tight-2', XYZT_PERMUTE['yzt-x']),
+    },
+    # Concatenate xyz-t and xyz-c to a single input
+    'xyz-t_and_xyz-c_single_input': {
+        'xyz-t_and_xyz-c_single_input': ('concat', ('xyz-t', 'xyz-c'), -1),
+    },
+}
+
+# Label modifiers, given as specs for the LabelModifier
+ORCA_LABEL_SPECS = {
+    'energy_dir_bjorken-y_vtx_errors': {
+        'columns': {
+            'dx': 'dir_x', 'dx_err': 'dir_x',
+            'dy': 'dir_y', 'dy_err': 'dir_y',
+            'dz': 'dir_z', 'dz_err': 'dir_z',
+            'e': 'energy', 'e_err': 'energy',
+            'by': 'bjorkeny', 'by_err': 'bjorkeny',
+            'vx': 'vertex_pos_x', 'vx_err': 'vertex_pos_x',
+            'vy': 'vertex_pos_y', 'vy_err': 'vertex_pos_y',
+            'vz': 'vertex_pos_z', 'vz_err': 'vertex_pos_z',
+            'vt': 'time_residual_vertex', 'vt_err': 'time_residual_vertex',
+        },
+        'overrides': [{
+            # elec NC events: correct energy to visible energy,
+            # and set their bjorkeny label to 1
+            'where': [('particle_type', 'abs==', 12), ('is_cc', '==', 0)],
+            'set': {'energy': ('energy', 'bjorkeny'), 'bjorkeny': 1},
+        }],
+        'dtype': 'float32',
+    },
+}
+
+
+def update_objects(orga, model_file, n_buffers=None):
     """
     Update the organizer for using the model.
 
@@ -26,6 +85,11 @@ def update_objects(orga, model_file):
     model_file : str
         Path to a toml file which has the infos about which modifiers
         to use.
+    n_buffers : int or None
+        Let the compiled sample and label modifiers reuse this many output
+        arrays in turn, e.g. get_n_buffers(orga). Only safe if the batches
+        are consumed in order through bounded queues, like in inference.
+        None for new arrays for each batch.
 
     """
     file_content = toml.load(model_file)
@@ -53,10 +117,12 @@ def update_objects(orga, model_file):
 
     if sample_modifier is not None:
         print("Using orga sample modifier: ", sample_modifier)
-        orga.cfg.sample_modifier = orca_sample_modifiers(sample_modifier)
+        orga.cfg.sample_modifier = orca_sample_modifiers(
+            sample_modifier, n_buffers=n_buffers)
     if label_modifier is not None:
         print("Using orga label modifier: ", label_modifier)
-        orga.cfg.label_modifier = orca_label_modifiers(label_modifier)
+        orga.cfg.label_modifier = orca_label_modifiers(
+            label_modifier, n_buffers=n_buffers)
     if dataset_modifier is not None:
         print("Using orga dataset modifier: ", dataset_modifier)
         orga.cfg.dataset_modifier = orca_dataset_modifiers(dataset_modifier)
@@ -64,15 +130,15 @@ def update_objects(orga, model_file):
     orga.cfg.custom_objects = get_custom_objects()
 
 
-def orca_sample_modifiers(name):
+def orca_sample_modifiers(name, n_buffers=None):
     """
     Returns one of the sample modifiers used for Orca networks.
 
     They will permute columns, and/or add permuted columns to xs.
 
     The input to the functions is:
-        xs_files : dict
-            Dict that contains the input samples from the file(s).
+        info_blob : dict
+            The x_values in it contain the input samples from the file(s).
             The keys are the names of the inputs in the toml list file.
             The values are a single batch of data from each corresponding file.
 
@@ -86,6 +152,9 @@ def orca_sample_modifiers(name):
     ----------
     name : None/str
         Name of the sample modifier to return.
+    n_buffers : int or None
+        For the modifiers given as a spec in ORCA_SAMPLE_SPECS:
+        How many output buffers to reuse in turn (see SampleModifier).
 
     Returns
     -------
@@ -93,75 +162,35 @@ def orca_sample_modifiers(name):
         The sample modifier function.
 
     """
-    # assuming input is bxyzt
-    xyzt_permute = {'yzt-x': (0, 2, 3, 4, 1),
-                    'xyt-z': (0, 1, 2, 4, 3),
-                    't-xyz': (0, 4, 1, 2, 3),
-                    'tyz-x': (0, 4, 2, 3, 1)}
-
-    if name in xyzt_permute:
-        def swap_columns(xs_files):
+    if name in ORCA_SAMPLE_SPECS:
+        return SampleModifier(ORCA_SAMPLE_SPECS[name], n_buffers=n_buffers)
+
+    elif name in XYZT_PERMUTE:
+        def swap_columns(info_blob):
             # Transpose dimensions
+            xs_files = info_blob["x_values"]
             xs_layer = dict()
             keys = list(xs_files.keys())
-            xs_layer[keys[0]] = np.transpose(xs_files[keys[0]], xyzt_permute[name])
+            xs_layer[keys[0]] = np.transpose(xs_files[keys[0]], XYZT_PERMUTE[name])
             return xs_layer
         sample_modifier = swap_columns
 
     elif name == "sum_last":
-        def sample_modifier(xs_files):
+        def sample_modifier(info_blob):
             # sum over the last dimension
             # e.g. shape (10,20,30) --> (10,20,1)
             xs_layer = dict()
-            for l_name, x in xs_files.items():
+            for l_name, x in info_blob["x_values"].items():
                 xs_layer[l_name] = np.sum(x, axis=-1, keepdims=True)
             return xs_layer
 
-    elif name == 'xyz-t_and_yzt-x':
-        def sample_modifier(xs_files):
-            # Use xyz-t, and also transpose it to yzt-x and use that, too.
-            xs_layer = dict()
-            xs_layer['xyz-t'] = xs_files['xyz-t']
-            xs_layer['yzt-x'] = np.transpose(xs_files['xyz-t'], xyzt_permute['yzt-x'])
-            return xs_layer
-
-    elif name == 'xyz-t_and_xyz-c_single_input_and_yzt-x':
-        def sample_modifier(xs_files):
-            # Concatenate xyz-t and xyz-c to a single input
-            xs_layer = dict()
-            xs_layer['xyz-t_and_xyz-c_single_input_net_0'] = np.concatenate(
-                [xs_files['xyz-t'], xs_files['xyz-c']], axis=-1)
-            # Transpose xyz-t to yzt-x and use that, too.
-            xs_layer['input_1_net_1'] = np.transpose(xs_files['xyz-t'], xyzt_permute['yzt-x'])
-            return xs_layer
-
-    elif name == 'xyz-t_and_yzt-x_multi_input_single_train_tight-1_tight-2':
-        def sample_modifier(xs_files):
-            # Use xyz-t in two different time cuts, and also transpose them to yzt-x and use these, too.
-            xs_layer = dict()
-            xs_layer['xyz-t_tight-1'] = xs_files['xyz-t_tight-1']
-            xs_layer['xyz-t_tight-2'] = xs_files['xyz-t_tight-2']
-            xs_layer['yzt-x_tight-1'] = np.transpose(xs_files['xyz-t_tight-1'],
-                                                     xyzt_permute['yzt-x'])
-            xs_layer['yzt-x_tight-2'] = np.transpose(xs_files['xyz-t_tight-2'],
-                                                     xyzt_permute['yzt-x'])
-            return xs_layer
-
-    elif name == 'xyz-t_and_xyz-c_single_input':
-        def sample_modifier(xs_files):
-            # Concatenate xyz-t and xyz-c to a single input
-            xs_layer = dict()
-            xs_layer['xyz-t_and_xyz-c_single_input'] = np.concatenate(
-                [xs_files['xyz-t'], xs_files['xyz-c']], axis=-1)
-            return xs_layer
-
     else:
         raise ValueError('Unknown input_type: ' + str(name))
 
     return sample_modifier
 
 
-def orca_label_modifiers(name):
+def orca_label_modifiers(name, n_buffers=None):
     """
     Returns one of the label modifiers used for Orca networks.
 
@@ -195,6 +224,9 @@ def orca_label_modifiers(name):
     ----------
     name : str
         Name of the label modifier that should be used.
+    n_buffers : int or None
+        For the modifiers given as a spec in ORCA_LABEL_SPECS:
+        How many output buffers to reuse in turn (see LabelModifier).
 
     Returns
     -------
@@ -203,45 +235,18 @@ def orca_label_modifiers(name):
 
     """
 
-    if name == 'energy_dir_bjorken-y_vtx_errors':
-        def label_modifier(y_values):
-            ys = dict()
-            particle_type, is_cc = y_values['particle_type'], y_values['is_cc']
-            elec_nc_bool_idx = np.logical_and(np.abs(particle_type) == 12,
-                                              is_cc == 0)
-
-            # correct energy to visible energy
-            visible_energy = y_values[elec_nc_bool_idx]['energy'] * y_values[elec_nc_bool_idx]['bjorkeny']
-            # make a copy of the y_values array, since we modify it now
-            y_values_copy = np.copy(y_values)
-            # fix energy to visible energy
-            np.place(y_values_copy['energy'], elec_nc_bool_idx, visible_energy)
-            # set bjorkeny label of nc events to 1
-            np.place(y_values_copy['bjorkeny'], elec_nc_bool_idx, 1)
-
-            ys['dx'], ys['dx_err'] = y_values_copy['dir_x'], y_values_copy['dir_x']
-            ys['dy'], ys['dy_err'] = y_values_copy['dir_y'], y_values_copy['dir_y']
-            ys['dz'], ys['dz_err'] = y_values_copy['dir_z'], y_values_copy['dir_z']
-            ys['e'], ys['e_err'] = y_values_copy['energy'], y_values_copy['energy']
-            ys['by'], ys['by_err'] = y_values_copy['bjorkeny'], y_values_copy['bjorkeny']
-
-            ys['vx'], ys['vx_err'] = y_values_copy['vertex_pos_x'], y_values_copy['vertex_pos_x']
-            ys['vy'], ys['vy_err'] = y_values_copy['vertex_pos_y'], y_values_copy['vertex_pos_y']
-            ys['vz'], ys['vz_err'] = y_values_copy['vertex_pos_z'], y_values_copy['vertex_pos_z']
-            ys['vt'], ys['vt_err'] = y_values_copy['time_residual_vertex'], y_values_copy['time_residual_vertex']
-
-            for key_label in ys:
-                ys[key_label] = ys[key_label].astype(np.float32)
-            return ys
+    if name in ORCA_LABEL_SPECS:
+        return LabelModifier(n_buffers=n_buffers, **ORCA_LABEL_SPECS[name])
 
     elif name == 'ts_classifier':
-        def label_modifier(y_values):
+        def label_modifier(info_blob):
             # for every sample, [0,1] for shower, or [1,0] for track
 
             # {(12, 0): 0, (12, 1): 1, (14, 1): 2, (16, 1): 3}
             # 0: elec_NC, 1: elec_CC, 2: muon_CC, 3: tau_CC
             # label is always shower, except if muon-CC
             ys = dict()
+            y_values = info_blob["y_values"]
             particle_type, is_cc = y_values['particle_type'], y_values['is_cc']
             is_muon_cc = np.logical_and(np.abs(particle_type) == 14, is_cc == 1)
             is_not_muon_cc = np.invert(is_muon_cc)
@@ -257,11 +262,12 @@ def orca_label_modifiers(name):
             return ys
 
     elif name == 'bg_classifier':
-        def label_modifier(y_values):
+        def label_modifier(info_blob):
             # for every sample, [1,0,0] for neutrinos, [0,1,0] for mupage
             # and [0,0,1] for random_noise
             # particle types: mupage: np.abs(13), random_noise = 0, neutrinos =
             ys = dict()
+            y_values = info_blob["y_values"]
             particle_type = y_values['particle_type']
             is_mupage = np.abs(particle_type) == 13
             is_random_noise = np.abs(particle_type == 0)
@@ -279,11 +285,12 @@ def orca_label_modifiers(name):
             return ys
 
     elif name == 'bg_classifier_2_class':
-        def label_modifier(y_values):
+        def label_modifier(info_blob):
             # for every sample, [1,0,0] for neutrinos, [0,1,0] for mupage
             # and [0,0,1] for random_noise
             # particle types: mupage: np.abs(13), random_noise = 0, neutrinos =
             ys = dict()
+            y_values = info_blob["y_values"]
             particle_type = y_values['particle_type']
             is_mupage = np.abs(particle_type) == 13
             is_random_noise = np.abs(particle_type == 0)
@@ -307,6 +314,233 @@ def orca_label_modifiers(name):
     return label_modifier
 
 
+class SampleModifier:
+    """
+    Sample modifier compiled from a declarative spec.
+
+    All layers are written directly into output arrays, which are reused
+    for later batches if n_buffers is given. This is only safe if the
+    batches are consumed synchronously, so new arrays are used per default.
+
+    Parameters
+    ----------
+    layers : dict
+        Keys are the names of the input layers of the network.
+        Values describe how to get the samples of this layer from the
+        x_values, and can be one of:
+            name : str
+                Use the input set with this name unchanged.
+            ('transpose', name, axes)
+                Transpose the input set with this name. axes includes the
+                batch dimension, like in np.transpose.
+            ('concat', names, axis)
+                Concatenate the input sets with these names along the
+                given axis.
+    dtype : str or None
+        Dtype of the output arrays. None for the dtype of the inputs.
+    n_buffers : int or None
+        How many output arrays per layer are reused in turn. Has to be
+        larger than the number of batches alive at the same time.
+        None for new arrays for each batch.
+
+    """
+    def __init__(self, layers, dtype=None, n_buffers=None):
+        self.layers = layers
+        self.dtype = dtype
+        self._buffers = _BufferRing(n_buffers)
+        self._plan = [self._compile(name, spec)
+                      for name, spec in layers.items()]
+
+    def __call__(self, info_blob):
+        x_values = info_blob["x_values"]
+        return {name: step(x_values) for name, step in self._plan}
+
+    def _compile(self, name, spec):
+        """ Get a function that makes the samples of one layer. """
+        if isinstance(spec, str):
+            def step(x_values):
+                return x_values[spec]
+
+        elif spec[0] == "transpose":
+            input_name, axes = spec[1:]
+
+            def step(x_values):
+                x = np.transpose(x_values[input_name], axes)
+                out = self._get_out(name, x.shape, x.dtype)
+                np.copyto(out, x, casting="unsafe")
+                return out
+
+        elif spec[0] == "concat":
+            input_names, axis = spec[1:]
+
+            def step(x_values):
+                xs = [x_values[input_name] for input_name in input_names]
+                shape = list(xs[0].shape)
+                shape[axis] = sum([x.shape[axis] for x in xs])
+                out = self._get_out(name, tuple(shape), np.result_type(*xs))
+                np.concatenate(xs, axis=axis, out=out, casting="unsafe")
+                return out
+
+        else:
+            raise ValueError("Unknown operation {} for layer {}".format(
+                spec[0], name))
+        return name, step
+
+    def _get_out(self, name, shape, dtype):
+        if self.dtype is not None:
+            dtype = self.dtype
+        return self._buffers.get(name, shape, dtype)
+
+
+class LabelModifier:
+    """
+    Label modifier compiled from a declarative spec.
+
+    Selects fields of the structured y_values as the labels, with
+    optional conditional overrides. All used fields are converted with a
+    single pass into one output array, which is reused for later batches
+    if n_buffers is given (only safe if the batches are consumed
+    synchronously). No copy of y_values is made.
+
+    Parameters
+    ----------
+    columns : dict
+        Keys are the names of the output layers of the network. Values
+        are the names of the fields in y_values used as their labels.
+        Outputs with the same field get the same array.
+    overrides : List
+        Conditional overrides of fields, applied in order. Each is a dict
+        with the keys
+            where : List
+                The override is applied to samples which fulfill all
+                conditions in here. Each is a tuple (field, op, value),
+                with op one of ==, !=, <, <=, >, >=. Prefix op with abs
+                to compare the absolute value of the field (e.g. abs==).
+            set : dict
+                Keys are fields, values what to set them to. Can be a
+                number, the name of a field, or a tuple of field names
+                to use their product.
+        Conditions and values always refer to the original y_values.
+    dtype : str
+        Dtype of the labels.
+    n_buffers : int or None
+        How many output arrays are reused in turn. Has to be
+        larger than the number of batches alive at the same time.
+        None for a new array for each batch.
+
+    Attributes
+    ----------
+    y_field_names : List
+        All fields of the y_values that are used. Only these are read
+        from the files.
+
+    """
+    def __init__(self, columns, overrides=(), dtype="float32",
+                 n_buffers=None):
+        self.columns = columns
+        self.overrides = overrides
+        self.dtype = dtype
+        self._buffers = _BufferRing(n_buffers)
+
+        # every field is converted only once
+        self._fields = []
+        for field in columns.values():
+            if field not in self._fields:
+                self._fields.append(field)
+        self._rows = {name: self._fields.index(field)
+                      for name, field in columns.items()}
+        self.y_field_names = list(self._fields)
+        for override in overrides:
+            used = [term[0] for term in override["where"]]
+            for value in override["set"].values():
+                if isinstance(value, str):
+                    used.append(value)
+                elif isinstance(value, (tuple, list)):
+                    used.extend(value)
+            for field in used:
+                if field not in self.y_field_names:
+                    self.y_field_names.append(field)
+            for term in override["where"]:
+                if term[1].replace("abs", "", 1) not in _COMPARISONS:
+                    raise ValueError("Unknown comparison {}".format(term[1]))
+
+    def __call__(self, info_blob):
+        y_values = info_blob["y_values"]
+        out = self._buffers.get(
+            "labels", (len(self._fields), len(y_values)), self.dtype)
+        for row, field in zip(out, self._fields):
+            np.copyto(row, y_values[field], casting="unsafe")
+
+        for override in self.overrides:
+            mask = self._get_mask(y_values, override["where"])
+            for field, value in override["set"].items():
+                if field not in self._fields:
+                    continue
+                row = out[self._fields.index(field)]
+                if isinstance(value, str):
+                    np.copyto(row, y_values[value], casting="unsafe",
+                              where=mask)
+                elif isinstance(value, (tuple, list)):
+                    np.multiply(y_values[value[0]], y_values[value[1]],
+                                out=row, where=mask, casting="unsafe")
+                    for other in value[2:]:
+                        np.multiply(row, y_values[other], out=row,
+                                    where=mask, casting="unsafe")
+                else:
+                    np.copyto(row, value, casting="unsafe", where=mask)
+
+        return {name: out[row] for name, row in self._rows.items()}
+
+    @staticmethod
+    def _get_mask(y_values, where):
+        """ Get which samples fulfill all given conditions. """
+        mask = np.ones(len(y_values), dtype=bool)
+        for field, op, value in where:
+            values = y_values[field]
+            if op.startswith("abs"):
+                values = np.abs(values)
+                op = op[3:]
+            mask &= _COMPARISONS[op](values, value)
+        return mask
+
+
+_COMPARISONS = {
+    "==": np.equal,
+    "!=": np.not_equal,
+    "<": np.less,
+    "<=": np.less_equal,
+    ">": np.greater,
+    ">=": np.greater_equal,
+}
+
+
+class _BufferRing:
+    """ Output arrays of the compiled modifiers, which are reused in turn. """
+    def __init__(self, n_buffers=None):
+        self.n_buffers = n_buffers
+        self._buffers = {}
+        self._pos = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, shape, dtype):
+        """ Get the next output array with the given shape and dtype. """
+        if self.n_buffers is None:
+            return np.empty(shape, dtype=dtype)
+        dtype = np.dtype(dtype)
+        with self._lock:
+            buffers = self._buffers.get(key)
+            if buffers is None or buffers[0].shape != shape or \
+                    buffers[0].dtype != dtype:
+                # e.g. a smaller last batch
+                buffers = [np.empty(shape, dtype=dtype)
+                           for i in range(self.n_buffers)]
+                self._buffers[key] = buffers
+                self._pos[key] = 0
+            buffer = buffers[self._pos[key]]
+            self._pos[key] = (self._pos[key] + 1) % self.n_buffers
+        return buffer
+
+
 def orca_dataset_modifiers(name):
     """
     Returns one of the dataset modifiers used for predicting with OrcaNet.
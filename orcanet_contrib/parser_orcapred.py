@@ -30,6 +30,7 @@ from docopt import docopt
 import toml
 
 from orcanet.core import Organizer
+from orcanet.h5_generator import get_n_buffers
 from orcanet_contrib.eval_nn import make_performance_plots
 from orcanet_contrib.orca_handler_util import update_objects
 
@@ -65,8 +66,9 @@ def orca_pred(output_folder, list_file, config_file, model_file,
     orga = Organizer(output_folder, list_file, config_file, tf_log_level=1)
 
     # When predicting with a orga model, the right modifiers and custom
-    # objects need to be given
-    update_objects(orga, model_file)
+    # objects need to be given. Inference consumes the batches in order,
+    # so the modifiers can reuse their output arrays.
+    update_objects(orga, model_file, n_buffers=get_n_buffers(orga))
 
     # Per default, a prediction will be done for the model with the
     # highest epoch and filenumber.
@@ -32,6 +32,8 @@ setup(
     entry_points={
         'console_scripts': [
             'summarize=orcanet.utilities.summarize_training:main',
+            'orcabench=orcanet.utilities.benchmark:main',
+            'orcalaunch=orcanet.distributed:main',
             'orcatrain=orcanet_contrib.parser_orcatrain:main',
             'orcapred=orcanet_contrib.parser_orcapred:main',
         ]